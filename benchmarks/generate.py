@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright (c) 2019, The Children's Hospital of Philadelphia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+#   disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Writes a reproducible tree of synthetic DICOM files for benchmarking.
+
+The tree is laid out as <root>/<patient>/<study>/<series>/<instance>.dcm. Every value is derived from the
+arguments and the seed, so the same arguments always give byte-identical files.
+"""
+
+import os
+import random
+import argparse
+import struct
+from datetime import datetime, timedelta
+from dicom.dataset import Dataset, FileDataset
+from dicom.sequence import Sequence
+
+# Made up root for the identified UIDs, it only has to be stable
+UID_ROOT = '1.2.826.0.1.3680043.9.7311'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+
+SOP_CLASSES = {
+    'CR': '1.2.840.10008.5.1.4.1.1.1',
+    'CT': '1.2.840.10008.5.1.4.1.1.2',
+    'MR': '1.2.840.10008.5.1.4.1.1.4',
+    'US': '1.2.840.10008.5.1.4.1.1.6.1',
+    'OT': '1.2.840.10008.5.1.4.1.1.7',
+}
+
+FIRST_NAMES = ['JOHN', 'JANE', 'ALEX', 'MARIA', 'WEI', 'FATIMA', 'OLIVER', 'PRIYA']
+LAST_NAMES = ['DOE', 'SMITH', 'GARCIA', 'CHEN', 'KHAN', 'MILLER', 'NGUYEN', 'JONES']
+STUDY_DESCRIPTIONS = ['CT CHEST W/CONTRAST', 'NECK STUDY', 'MRI BRAIN WO', 'WRIST RIGHT']
+SERIES_DESCRIPTIONS = ['3D HEAD BONE', 'ST HEAD', 'AX T1', 'SAG T2 FLAIR', 'LOCALIZER']
+
+
+def person_name(rng):
+    # PN values are written as unicode, pydicom 0.9.9 cannot encode plain str names
+    return u'%s^%s' % (rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES))
+
+
+def pixel_bytes(rng, length):
+    # Repeats a random block, random enough to defeat run length tricks and quick to build
+    block = struct.pack('<256H', *[rng.randint(0, 4095) for i in range(256)])
+    return (block * (length // len(block) + 1))[:length]
+
+
+def make_dataset(rng, filename, patient, study, series, instance, modality, options):
+    uid = '%s.%d.%d.%d.%d' % (UID_ROOT, options['seed'], patient, study, series)
+    sop_uid = '%s.%d' % (uid, instance)
+
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = SOP_CLASSES.get(modality, SOP_CLASSES['OT'])
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = EXPLICIT_VR_LITTLE_ENDIAN
+    meta.ImplementationClassUID = UID_ROOT
+    ds = FileDataset(filename, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    study_date = datetime(2000, 1, 1) + timedelta(days=rng.randint(0, 7000))
+    birth_date = study_date - timedelta(days=rng.randint(365, 30000))
+    ds.SpecificCharacterSet = 'ISO_IR 100'
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = sop_uid
+    ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = ds.ContentDate = study_date.strftime('%Y%m%d')
+    ds.StudyTime = ds.SeriesTime = '%02d%02d%02d' % (rng.randint(7, 19), rng.randint(0, 59), rng.randint(0, 59))
+    ds.AccessionNumber = 'ACC%d%04d' % (patient, study)
+    ds.Modality = modality
+    ds.Manufacturer = rng.choice(['ACME MEDICAL', 'SIEMENS', 'GE MEDICAL SYSTEMS'])
+    ds.InstitutionName = 'GENERAL HOSPITAL'
+    ds.ReferringPhysicianName = person_name(rng)
+    ds.StudyDescription = STUDY_DESCRIPTIONS[study % len(STUDY_DESCRIPTIONS)]
+    ds.SeriesDescription = SERIES_DESCRIPTIONS[series % len(SERIES_DESCRIPTIONS)]
+    ds.PatientName = options['names'][patient]
+    ds.PatientID = 'PID%06d' % patient
+    ds.PatientBirthDate = birth_date.strftime('%Y%m%d')
+    ds.PatientSex = rng.choice(['M', 'F', 'O'])
+    ds.ProtocolName = 'PROTOCOL %d' % rng.randint(1, 20)
+    ds.StudyInstanceUID = '%s.%d.%d.%d' % (UID_ROOT, options['seed'], patient, study)
+    ds.SeriesInstanceUID = uid
+    ds.StudyID = str(study)
+    ds.SeriesNumber = series + 1
+    ds.InstanceNumber = instance + 1
+    ds.FrameOfReferenceUID = uid + '.0'
+
+    if options['sequences']:
+        code = Dataset()
+        code.CodeValue = 'C%04d' % study
+        code.CodingSchemeDesignator = 'LOCAL'
+        code.CodeMeaning = ds.StudyDescription
+        ds.ProcedureCodeSequence = Sequence([code])
+        reference = Dataset()
+        reference.ReferencedSOPClassUID = ds.SOPClassUID
+        reference.ReferencedSOPInstanceUID = '%s.%d' % (uid, max(instance - 1, 0))
+        ds.ReferencedImageSequence = Sequence([reference])
+
+    if options['private_tags']:
+        ds.add_new((0x0009, 0x0010), 'LO', 'BENCHMARK PRIVATE')
+        ds.add_new((0x0009, 0x1001), 'LO', 'private %s' % ds.PatientID)
+        ds.add_new((0x0009, 0x1002), 'OB', pixel_bytes(rng, 512))
+        ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA HEADER')
+        ds.add_new((0x0029, 0x1010), 'OB', pixel_bytes(rng, 2048))
+        ds.add_new((0x0029, 0x1020), 'OB', pixel_bytes(rng, 2048))
+
+    rows, columns, frames = options['rows'], options['columns'], options['frames']
+    if options['overlays']:
+        ds.add_new((0x6000, 0x0010), 'US', rows)
+        ds.add_new((0x6000, 0x0011), 'US', columns)
+        ds.add_new((0x6000, 0x0040), 'CS', 'G')
+        ds.add_new((0x6000, 0x0050), 'SS', [1, 1])
+        ds.add_new((0x6000, 0x0100), 'US', 1)
+        ds.add_new((0x6000, 0x0102), 'US', 0)
+        ds.add_new((0x6000, 0x0022), 'LO', 'MEASUREMENTS FOR %s' % ds.PatientName)
+        ds.add_new((0x6000, 0x3000), 'OW', pixel_bytes(rng, (rows * columns + 15) // 16 * 2))
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.add_new((0x7fe0, 0x0010), 'OW', pixel_bytes(rng, rows * columns * frames * 2))
+    return ds
+
+
+def generate(root, patients=4, studies=2, series=3, instances=10, modalities=('MR', 'CT'), private_tags=True,
+             sequences=True, overlays=True, frames=1, rows=256, columns=256, seed=0):
+    """Writes the tree under root and returns (number of files, total bytes)."""
+    rng = random.Random(seed)
+    options = {
+        'seed': seed, 'private_tags': private_tags, 'sequences': sequences, 'overlays': overlays,
+        'frames': frames, 'rows': rows, 'columns': columns,
+        'names': [person_name(rng) for i in range(patients)],
+    }
+    count = 0
+    size = 0
+    for patient in range(patients):
+        for study in range(studies):
+            for number in range(series):
+                modality = modalities[(study * series + number) % len(modalities)].upper()
+                target = os.path.join(root, 'patient%04d' % patient, 'study%03d' % study,
+                                      'series%03d' % number)
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                for instance in range(instances):
+                    filename = os.path.join(target, 'image%05d.dcm' % instance)
+                    make_dataset(rng, filename, patient, study, number, instance, modality, options).save_as(filename)
+                    count += 1
+                    size += os.path.getsize(filename)
+    return count, size
+
+
+def add_arguments(parser):
+    parser.add_argument('--patients', type=int, default=4, help='Number of patients')
+    parser.add_argument('--studies', type=int, default=2, help='Studies per patient')
+    parser.add_argument('--series', type=int, default=3, help='Series per study')
+    parser.add_argument('--instances', type=int, default=10, help='Instances per series')
+    parser.add_argument('--modalities', type=str, nargs='+', default=['MR', 'CT'],
+                        help='Modalities given to the series in turn. Modalities the run does not allow end up in '
+                             'quarantine.')
+    parser.add_argument('--no_private_tags', dest='private_tags', action='store_false', default=True,
+                        help='Leave out private tags and CSA headers')
+    parser.add_argument('--no_sequences', dest='sequences', action='store_false', default=True,
+                        help='Leave out sequences')
+    parser.add_argument('--no_overlays', dest='overlays', action='store_false', default=True,
+                        help='Leave out the overlay plane')
+    parser.add_argument('--frames', type=int, default=1, help='Frames per instance')
+    parser.add_argument('--rows', type=int, default=256, help='Rows per frame')
+    parser.add_argument('--columns', type=int, default=256, help='Columns per frame')
+    parser.add_argument('--seed', type=int, default=0, help='Seed, the same seed gives the same files')
+
+
+def corpus_options(args):
+    return {name: getattr(args, name) for name in ['patients', 'studies', 'series', 'instances', 'modalities',
+                                                   'private_tags', 'sequences', 'overlays', 'frames', 'rows',
+                                                   'columns', 'seed']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a tree of synthetic DICOM files for benchmarks.')
+    parser.add_argument(dest='root', type=str, help='Directory to write the files to')
+    add_arguments(parser)
+    args = parser.parse_args()
+    count, size = generate(args.root, **corpus_options(args))
+    print('%d files, %.1f MB written to %s' % (count, size / 1048576.0, args.root))
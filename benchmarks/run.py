@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Copyright (c) 2019, The Children's Hospital of Philadelphia
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+#   disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Times DicomAnon.run on a synthetic corpus, see benchmarks/generate.py.
+
+Each case runs in its own process so the peak resident set size belongs to that case alone. Results are printed
+as a table and can be appended to a JSON lines file to compare releases:
+
+    python -m benchmarks.run --label 1.4 --results benchmarks.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+import dicom
+import dicom_anon
+from benchmarks import generate
+
+# (profile, relative_dates) pairs run by default
+CASES = [('basic', False), ('basic', True), ('clean', False), ('clean', True)]
+# Dates the default spec keeps, relative dates cannot be applied to removed tags
+RELATIVE_DATES = [(0x0008, 0x0020), (0x0008, 0x0023), (0x0010, 0x0030)]
+WHITE_LIST = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'white_list.json')
+COLUMNS = ['profile', 'relative_dates', 'files', 'cleaned', 'quarantined', 'seconds', 'files_per_second',
+           'mb_per_second', 'peak_rss_mb', 'audit_mb', 'audit_kb_per_file']
+
+
+def tree_size(root):
+    count = 0
+    size = 0
+    for path, _, files in os.walk(root):
+        for name in files:
+            count += 1
+            size += os.path.getsize(os.path.join(path, name))
+    return count, size
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, worker processes count as children
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def run_case(corpus, work, profile, relative_dates, options, results):
+    audit_file = os.path.join(work, 'identity.db')
+    anon = dicom_anon.DicomAnon(profile=profile, white_list=WHITE_LIST if profile == 'clean' else None,
+                                audit_file=audit_file, log_file=os.path.join(work, 'dicom_anon.log'),
+                                quarantine=os.path.join(work, 'quarantine'),
+                                relative_dates=RELATIVE_DATES if relative_dates else None, **options)
+    start = time.time()
+    completed = anon.run(corpus, os.path.join(work, 'clean'))
+    seconds = time.time() - start
+    # Every shard of the audit trail with its write-ahead log, nothing for the memory backend
+    audit_size = sum(os.path.getsize(os.path.join(work, name)) for name in os.listdir(work)
+                     if name.startswith('identity.') and not name.endswith('-shm'))
+    results.put({'completed': completed, 'seconds': seconds, 'peak_rss': peak_rss(), 'audit_size': audit_size})
+
+
+def measure(corpus, corpus_files, corpus_size, profile, relative_dates, options):
+    work = tempfile.mkdtemp(prefix='dicom_anon_bench_')
+    try:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_case,
+                                          args=(corpus, work, profile, relative_dates, options, results))
+        process.start()
+        process.join()
+        result = None if results.empty() else results.get()
+        if result is None or not result['completed']:
+            sys.stderr.write('%s profile%s failed\n' % (profile, ' with relative dates' if relative_dates else ''))
+            return None
+        cleaned = tree_size(os.path.join(work, 'clean'))[0]
+        quarantined = tree_size(os.path.join(work, 'quarantine'))[0]
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    seconds = result['seconds']
+    return {
+        'profile': profile,
+        'relative_dates': relative_dates,
+        'files': corpus_files,
+        'cleaned': cleaned,
+        'quarantined': quarantined,
+        'seconds': round(seconds, 3),
+        'files_per_second': round(corpus_files / seconds, 1),
+        'mb_per_second': round(corpus_size / 1048576.0 / seconds, 2),
+        'peak_rss_mb': round(result['peak_rss'] / 1048576.0, 1),
+        'audit_mb': round(result['audit_size'] / 1048576.0, 2),
+        'audit_kb_per_file': round(result['audit_size'] / 1024.0 / max(cleaned, 1), 2),
+    }
+
+
+def write_table(rows, handle):
+    if not rows:
+        return
+    widths = [max(len(column), max(len(str(row[column])) for row in rows)) for column in COLUMNS]
+    handle.write('  '.join(column.rjust(width) for column, width in zip(COLUMNS, widths)) + '\n')
+    for row in rows:
+        handle.write('  '.join(str(row[column]).rjust(width) for column, width in zip(COLUMNS, widths)) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures files/s, MB/s, peak RSS and audit database growth of '
+                                                 'dicom_anon on a synthetic corpus.')
+    parser.add_argument('--corpus', type=str, default=None,
+                        help='Existing corpus to use. By default a corpus is generated in a temporary directory '
+                             'from the options below and removed afterwards.')
+    parser.add_argument('--profiles', type=str, nargs='+', default=['basic', 'clean'], choices=['basic', 'clean'],
+                        help='Profiles to run')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for each run')
+    parser.add_argument('--audit_backend', type=str, default='sqlite', choices=['sqlite', 'memory', 'sharded'],
+                        help='Audit backend for each run, "memory" leaves the audit trail out of the measurements')
+    parser.add_argument('--engine', type=str, default='dataset', choices=dicom_anon.ENGINES,
+                        help='How cleaned files are written, see dicom_anon.py --engine')
+    parser.add_argument('--label', type=str, default=None, help='Label stored with the results, e.g. a release')
+    parser.add_argument('--results', type=str, default=None,
+                        help='JSON lines file the results are appended to, one line per case')
+    generate.add_arguments(parser)
+    args = parser.parse_args()
+
+    corpus = args.corpus
+    if corpus is None:
+        corpus = tempfile.mkdtemp(prefix='dicom_anon_corpus_')
+        generate.generate(corpus, **generate.corpus_options(args))
+    try:
+        corpus_files, corpus_size = tree_size(corpus)
+        rows = [measure(corpus, corpus_files, corpus_size, profile, relative_dates,
+                        {'workers': args.workers, 'modalities': ['mr', 'ct'], 'audit_backend': args.audit_backend,
+                         'engine': args.engine})
+                for profile, relative_dates in CASES if profile in args.profiles]
+        rows = [row for row in rows if row is not None]
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus, ignore_errors=True)
+
+    write_table(rows, sys.stdout)
+    if args.results:
+        environment = {
+            'label': args.label, 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+            'dicom': dicom.__version__, 'workers': args.workers, 'audit_backend': args.audit_backend,
+            'engine': args.engine, 'megabytes': round(corpus_size / 1048576.0, 2),
+            'corpus': args.corpus or generate.corpus_options(args),
+        }
+        with open(args.results, 'a') as handle:
+            for row in rows:
+                row.update(environment)
+                handle.write(json.dumps(row, sort_keys=True) + '\n')
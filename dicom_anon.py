@@ -20,34 +20,181 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import sys
 import dicom
 from dicom.errors import InvalidDicomError
+from dicom.filereader import read_partial
 from dicom.tag import Tag
 from dicom.dataelem import DataElement
 from dicom.dataset import Dataset
 from dicom.sequence import Sequence
 from dicom.multival import MultiValue
-from dicom.valuerep import DS
-from datetime import datetime
+from dicom.valuerep import DS, PersonName
+from dicom.datadict import dictionary_description, dictionaryVR
+from datetime import datetime, timedelta
 import logging
 import json
+import csv
 import re
 import sqlite3
 import shutil
+import tarfile
+import zipfile
+import time
+import hashlib
+import hmac
+import struct
+import zlib
+import uuid
+import multiprocessing
+import threading
+import Queue
+from collections import deque
+from io import BytesIO
+from multiprocessing.managers import BaseManager
 from functools import partial
+from itertools import islice
+from collections import OrderedDict
 import argparse
-
+from abc import ABCMeta, abstractmethod
+import signal
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows, reflinks fall back to copies there
+    fcntl = None
+
+try:
+    import pyinotify
+except ImportError:  # Optional, spool directories are polled without it
+    pyinotify = None
+
+# Version 2 of the audit schema keeps every mapping in one indexed table keyed by the integer tag.
+# Version 1 (user_version 0) lazily created one unindexed table per tag name, see migrate_audit.
+# Later versions are reached from version 2 by the statements in UPGRADE_SCHEMA.
+SCHEMA_VERSION = 5
+CREATE_SCHEMA = [
+    'CREATE TABLE mapping (id INTEGER PRIMARY KEY AUTOINCREMENT, tag_group INTEGER NOT NULL, '
+    'tag_element INTEGER NOT NULL, original, cleaned, study INTEGER, FOREIGN KEY(study) REFERENCES mapping(id))',
+    'CREATE INDEX mapping_original ON mapping (original, tag_group, tag_element, study, cleaned)',
+    'CREATE INDEX mapping_cleaned ON mapping (cleaned, tag_group, tag_element, study)',
+    'CREATE TABLE counter (tag_group INTEGER NOT NULL, tag_element INTEGER NOT NULL, value INTEGER NOT NULL, '
+    'PRIMARY KEY (tag_group, tag_element))',
+    'PRAGMA user_version = 2',
+]
+# Statements that take an audit file from the version in the key to the next one
+UPGRADE_SCHEMA = {
+    2: ['CREATE TABLE uid_counter (namespace INTEGER NOT NULL, next INTEGER NOT NULL)'],
+    3: ['CREATE INDEX mapping_study ON mapping (study)'],
+    4: ['CREATE TABLE date_offset (scope TEXT NOT NULL, key TEXT NOT NULL, days INTEGER NOT NULL, '
+        'PRIMARY KEY (scope, key))'],
+}
 TABLE_EXISTS = 'SELECT name FROM sqlite_master WHERE name=?'
-CREATE_NON_LINKED_TABLE = 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, original, cleaned)'
-CREATE_LINKED_TABLE = 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, original, cleaned, study INTEGER, ' \
-                      'FOREIGN KEY(study) REFERENCES studyinstanceuid(id))'
-INSERT_OTHER = 'INSERT INTO %s (original, cleaned) VALUES (?, ?)'
-INSERT_LINKED = 'INSERT INTO %s (original, cleaned, study) VALUES (?, ?, ?)'
-GET_NON_LINKED = 'SELECT cleaned FROM %s WHERE original = ?'
-GET_LINKED = 'SELECT cleaned FROM %s WHERE original = ? AND study = ?'
-UPDATE_LINKED = 'UPDATE %s SET cleaned = ? WHERE cleaned = ? AND study = ?'
-STUDY_PK = 'SELECT id FROM studyinstanceuid WHERE cleaned = ?'
-NEXT_ID = 'SELECT max(id) FROM %s'
+INSERT_MAPPING = 'INSERT INTO mapping (tag_group, tag_element, original, cleaned, study) VALUES (?, ?, ?, ?, ?)'
+INSERT_MISSING_MAPPING = 'INSERT INTO mapping (tag_group, tag_element, original, cleaned, study) ' \
+                         'SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM mapping WHERE original = ? ' \
+                         'AND tag_group = ? AND tag_element = ? AND study IS ?)'
+GET_NON_LINKED = 'SELECT cleaned FROM mapping WHERE original = ? AND tag_group = ? AND tag_element = ? ' \
+                 'AND study IS NULL'
+GET_LINKED = 'SELECT cleaned FROM mapping WHERE original = ? AND tag_group = ? AND tag_element = ? AND study = ?'
+UPDATE_LINKED = 'UPDATE mapping SET cleaned = ? WHERE cleaned = ? AND tag_group = ? AND tag_element = ? ' \
+                'AND study = ?'
+STUDY_PK = 'SELECT id FROM mapping WHERE cleaned = ? AND tag_group = ? AND tag_element = ? AND study IS NULL'
+NEXT_ID = 'SELECT value FROM counter WHERE tag_group = ? AND tag_element = ?'
+GET_UID_COUNTER = 'SELECT namespace, next FROM uid_counter'
+INIT_UID_COUNTER = 'INSERT INTO uid_counter SELECT ?, 1 WHERE NOT EXISTS (SELECT 1 FROM uid_counter)'
+RESERVE_UIDS = 'UPDATE uid_counter SET next = next + ?'
+INCREMENT_COUNTER = 'UPDATE counter SET value = value + ? WHERE tag_group = ? AND tag_element = ?'
+INSERT_COUNTER = 'INSERT INTO counter (tag_group, tag_element, value) VALUES (?, ?, ?)'
+MERGE_STUDIES = 'SELECT id, tag_group, tag_element, original, cleaned FROM mapping WHERE study IS NULL ORDER BY id'
+MERGE_LINKED = 'SELECT tag_group, tag_element, original, cleaned, study FROM mapping WHERE study IS NOT NULL ' \
+               'ORDER BY id'
+MERGE_COUNTERS = 'SELECT tag_group, tag_element, value FROM counter'
+MERGE_DATE_OFFSETS = 'SELECT scope, key, days FROM date_offset'
+GET_DATE_OFFSETS = 'SELECT key, days FROM date_offset WHERE scope = ?'
+SAVE_DATE_OFFSET = 'INSERT OR IGNORE INTO date_offset (scope, key, days) VALUES (?, ?, ?)'
+SCAN_STUDY_PK = 'SELECT id FROM mapping WHERE original = ? AND tag_group = ? AND tag_element = ? AND study IS NULL'
+# Bulk lookups join the mapping with the looked up values, loaded into a temporary table batch by batch.
+# CROSS JOIN keeps the values as the outer loop, so each one is a search in the mapping indexes.
+CREATE_LOOKUP = ['CREATE TEMP TABLE IF NOT EXISTS lookup_value (value PRIMARY KEY)', 'DELETE FROM lookup_value']
+INSERT_LOOKUP = 'INSERT OR IGNORE INTO lookup_value (value) VALUES (?)'
+LOOKUP = {
+    column: 'SELECT m.tag_group, m.tag_element, m.original, m.cleaned, s.original, s.cleaned FROM lookup_value '
+            'CROSS JOIN mapping m ON m.%s = lookup_value.value LEFT JOIN mapping s ON s.id = m.study' % column
+    for column in ['original', 'cleaned']
+}
+LOOKUP_STUDIES = {
+    column: 'SELECT s.id, s.original, s.cleaned FROM lookup_value CROSS JOIN mapping s '
+            'ON s.%s = lookup_value.value AND s.tag_group = ? AND s.tag_element = ? AND s.study IS NULL' % column
+    for column in ['original', 'cleaned']
+}
+STUDY_ROWS = 'SELECT tag_group, tag_element, original, cleaned FROM mapping WHERE study = ? ORDER BY id'
+LOOKUP_BATCH = 10000
+LOOKUP_COLUMNS = ['tag', 'name', 'original', 'cleaned', 'study_original', 'study_cleaned']
+
+CREATE_MANIFEST = 'CREATE TABLE IF NOT EXISTS manifest (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, ' \
+                  'hash TEXT, outcome TEXT, destination TEXT)'
+GET_MANIFEST = 'SELECT size, mtime, hash FROM manifest WHERE path = ?'
+SAVE_MANIFEST = 'INSERT OR REPLACE INTO manifest (path, size, mtime, hash, outcome, destination) ' \
+                'VALUES (?, ?, ?, ?, ?, ?)'
+
+# Duplicate inputs, see DuplicateIndex
+CREATE_DUPLICATE_INDEX = 'CREATE TABLE IF NOT EXISTS duplicate (sop_uid TEXT, fingerprint TEXT, path TEXT, ' \
+                         'destination TEXT, PRIMARY KEY (sop_uid, fingerprint)) WITHOUT ROWID'
+CLAIM_DUPLICATE = 'INSERT OR IGNORE INTO duplicate (sop_uid, fingerprint, path) VALUES (?, ?, ?)'
+GET_DUPLICATE = 'SELECT path, destination FROM duplicate WHERE sop_uid = ? AND fingerprint = ?'
+SAVE_DUPLICATE = 'UPDATE duplicate SET destination = ? WHERE sop_uid = ? AND fingerprint = ?'
+FORGET_DUPLICATE = 'DELETE FROM duplicate WHERE sop_uid = ? AND fingerprint = ?'
+DUPLICATE_MODES = ['process', 'skip', 'link']
+# Bytes hashed from the start and from the end of a file for its fingerprint
+DUPLICATE_SAMPLE_SIZE = 16 * 1024
+DUPLICATE_COMMIT_EVERY = 1000
+
+# Quarantine index, see QuarantineIndex
+CREATE_QUARANTINE_INDEX = 'CREATE TABLE IF NOT EXISTS quarantine (path TEXT PRIMARY KEY, destination TEXT, ' \
+                          'reason TEXT, modality TEXT, manufacturer TEXT, model TEXT, series_description TEXT, ' \
+                          'burnt_in TEXT, rows INTEGER, columns INTEGER, frames INTEGER, study_uid TEXT, ' \
+                          'series_uid TEXT, sop_instance_uid TEXT, bytes INTEGER, quarantined REAL)'
+SAVE_QUARANTINE_INDEX = 'INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+# Header catalog, see Catalog. Dates are kept as the raw strings, YYYYMMDD sorts like the date.
+CREATE_CATALOG = [
+    'CREATE TABLE IF NOT EXISTS catalog (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, study_uid TEXT, '
+    'patient_id TEXT, modality TEXT, quarantine TEXT)',
+    'CREATE INDEX IF NOT EXISTS catalog_study ON catalog (study_uid)',
+    'CREATE TABLE IF NOT EXISTS catalog_date (path TEXT NOT NULL, tag_group INTEGER NOT NULL, '
+    'tag_element INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (path, tag_group, tag_element))',
+    'CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT)',
+]
+GET_CATALOG_FINGERPRINT = "SELECT value FROM catalog_info WHERE key = 'fingerprint'"
+SAVE_CATALOG_FINGERPRINT = "INSERT OR REPLACE INTO catalog_info (key, value) VALUES ('fingerprint', ?)"
+CATALOG_FILES = 'SELECT path, size, mtime FROM catalog'
+CATALOG_QUARANTINED = 'SELECT path, quarantine FROM catalog WHERE quarantine IS NOT NULL'
+CATALOG_STUDIES = 'SELECT path, patient_id, study_uid FROM catalog'
+SAVE_CATALOG = 'INSERT OR REPLACE INTO catalog (path, size, mtime, study_uid, patient_id, modality, quarantine) ' \
+               'VALUES (?, ?, ?, ?, ?, ?, ?)'
+DELETE_CATALOG = 'DELETE FROM catalog WHERE path = ?'
+DELETE_CATALOG_DATES = 'DELETE FROM catalog_date WHERE path = ?'
+SAVE_CATALOG_DATE = 'INSERT INTO catalog_date (path, tag_group, tag_element, value) VALUES (?, ?, ?, ?)'
+FIRST_CATALOG_DATE = "SELECT MIN(value) FROM catalog_date JOIN catalog USING (path) " \
+                     "WHERE quarantine IS NULL AND tag_group = ? AND tag_element = ? " \
+                     "AND value GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'"
+# Earliest date of a tag for every patient or study, the date part of DT values counts
+FIRST_CATALOG_DATES_BY = {
+    scope: "SELECT %s, MIN(substr(value, 1, 8)) FROM catalog_date JOIN catalog USING (path) "
+           "WHERE quarantine IS NULL AND %s IS NOT NULL AND tag_group = ? AND tag_element = ? "
+           "AND substr(value, 1, 8) GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]' GROUP BY %s" % ((column,) * 3)
+    for scope, column in [('patient', 'patient_id'), ('study', 'study_uid')]
+}
+
+
+# Version 1 layout, see migrate_audit
+LEGACY_CREATE_NON_LINKED_TABLE = 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, original, cleaned)'
+LEGACY_CREATE_LINKED_TABLE = 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, original, cleaned, ' \
+                             'study INTEGER, FOREIGN KEY(study) REFERENCES studyinstanceuid(id))'
+LEGACY_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'"
+LEGACY_NON_LINKED = 'SELECT id, original, cleaned FROM %s ORDER BY id'
+LEGACY_LINKED = 'SELECT id, original, cleaned, study FROM %s ORDER BY id'
 
 MEDIA_STORAGE_SOP_INSTANCE_UID = (0x2, 0x3)
 STUDY_INSTANCE_UID = (0x20, 0xD)
@@ -56,6 +203,7 @@ SERIES_INSTANCE_UID = (0x20, 0xE)
 SERIES_DESCR = (0x8, 0x103E)
 SOP_CLASS_UID = (0x8, 0x16)
 SOP_INSTANCE_UID = (0x8, 0x18)
+SOP_INSTANCE_UID_TAG = Tag(SOP_INSTANCE_UID)
 PIXEL_SPACING = (0x28, 0x30)
 IMAGER_PIXEL_SPACING = (0x18, 0x1164)
 WINDOW_CENTER = (0x28, 0x1050)
@@ -69,6 +217,22 @@ MANUFACTURER = (0x8, 0x70)
 MANUFACTURER_MODEL_NAME = (0x8, 0x1090)
 PIXEL_DATA = (0x7fe0, 0x10)
 PHOTOMETRIC_INTERPRETATION = (0x28, 0x4)
+PATIENT_ID = (0x10, 0x20)
+
+# Repeating groups, (0x50xx,xxxx) is curve data and (0x60xx,xxxx) overlays
+GROUP_RANGE_MASK = 0xFF00
+CURVE_GROUP = 0x5000
+OVERLAY_GROUP = 0x6000
+# Group 0x1000 contains personal information
+PERSONAL_GROUP = 0x1000
+
+# Elements the spec file does not cover are removed if they have one of these VRs
+REMOVED_VRS = frozenset(['PN', 'CS', 'UI', 'DA', 'DT', 'LT', 'UN', 'UT', 'ST', 'AE', 'LO', 'TM', 'SH', 'AS', 'OB',
+                         'OW'])
+
+# Actions for elements without an entry in the compiled plan, see DicomAnon.compile_plan
+KEEP = 'keep'
+DELETE = 'delete'
 
 REMOVED_TEXT = '^^Audit Trail - Removed by dicom-anon - Audit Trail^^'
 
@@ -105,26 +269,254 @@ AUDIT = {
     (0x10, 0x30): 1,  # Patient's Birth Date
 }
 
+# Quarantine rules as (tag, test, values, reason), checked in this order. Values are compared stripped and
+# lower cased, item by item for multi-valued elements. 'contains' matches an item containing any of the
+# values and 'equals' an item equal to one of them. 'not_in' matches an item that is missing or not one of
+# the values, with None standing for the allowed modalities. 'missing' matches when the element is absent.
+# The following were partly taken from https://wiki.cancerimagingarchive.net/download/attachments/
+# 3539047/pixel-checker-filter.script?version=1&modificationDate=1333114118541&api=v2
+QUARANTINE_RULES = [
+    (SERIES_DESCR, 'contains', ['patient protocol'], 'patient protocol'),
+    (SERIES_DESCR, 'contains', ['save'], 'Likely screen capture'),
+    (MODALITY, 'not_in', None, 'modality not allowed'),
+    (MODALITY, 'missing', None, 'Modality missing'),
+    (BURNT_IN, 'equals', ['yes', 'y'], 'burnt-in data'),
+    (IMAGE_TYPE, 'contains', ['save'], 'Likely screen capture'),
+    (MANUFACTURER, 'contains', ['north american imaging, inc', 'pacsgear'], 'Manufacturer is suspect'),
+    (MANUFACTURER_MODEL_NAME, 'contains', ['the dicom box'], 'Manufacturer model name is suspect'),
+]
+
+# White list values are compared without case, surrounding or repeated spaces and these characters
+WHITE_LIST_IGNORED = re.compile('[-_,.]')
+WHITE_LIST_SPACES = re.compile(' +')
+# Values whose white list check is remembered, per tag
+WHITE_LIST_MEMO_SIZE = 10000
+
+# Number of removed values of each white listed tag listed in a scan report
+SCAN_REPORT_VALUES = 20
+
+# Explicit VR elements with these VRs have a 4 byte length after 2 reserved bytes, a 12 byte element header
+LONG_LENGTH_VRS = frozenset(['OB', 'OW', 'OF', 'SQ', 'UT', 'UN'])
+# Chunk size for copying values from the source file into the cleaned file with the stream engine
+SPLICE_CHUNK_SIZE = 1024 * 1024
+ENGINES = ['dataset', 'stream']
+
+# Transfer syntaxes cleaned files can be written in with --output_syntax, see encode_dataset. Only files in one of
+# the native little endian syntaxes are re-encoded, the others keep theirs.
+OUTPUT_SYNTAXES = ['keep', 'deflate', 'rle']
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+RLE_LOSSLESS = '1.2.840.10008.1.2.5'
+NATIVE_LITTLE_ENDIAN = frozenset([IMPLICIT_VR_LITTLE_ENDIAN, EXPLICIT_VR_LITTLE_ENDIAN,
+                                  DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN])
+DEFLATE_LEVEL = 6
+# Runs of 3 to 128 equal bytes, PackBits as used by RLE Lossless (PS3.5 G.3)
+RLE_RUN = re.compile(b'(.)\\1{2,127}', re.DOTALL)
+RLE_MAX_SEGMENTS = 15
+ITEM_TAG = (0xFFFE, 0xE000)
+
+# Shortest secret accepted for keyed pseudonyms, and the number of hex digits in a keyed token
+PSEUDONYM_KEY_MIN_LENGTH = 16
+PSEUDONYM_TOKEN_LENGTH = 12
+# Files whose mappings can wait for the audit log thread before cleaning blocks
+AUDIT_LOG_QUEUE_SIZE = 10000
+
+# Header fields of quarantined files kept in the quarantine index, in column order
+QUARANTINE_SUMMARY = [
+    ('modality', MODALITY), ('manufacturer', MANUFACTURER), ('model', MANUFACTURER_MODEL_NAME),
+    ('series_description', SERIES_DESCR), ('burnt_in', BURNT_IN), ('rows', (0x28, 0x10)), ('columns', (0x28, 0x11)),
+    ('frames', (0x28, 0x8)), ('study_uid', STUDY_INSTANCE_UID), ('series_uid', SERIES_INSTANCE_UID),
+    ('sop_instance_uid', SOP_INSTANCE_UID),
+]
+
+# Linux ioctl that makes target share the blocks of source, on file systems with copy on write
+FICLONE = 0x40049409
+
 CLEANED_DATE = '19010101'
 CLEANED_TIME = '000000.00'
 
+# Relative dates count from here, the first date of a tag, patient or study becomes this date
+RELATIVE_EPOCH = datetime(1970, 1, 1)
+# global shifts every date of a tag by the same amount for all files, patient and study use one offset for
+# all relative_dates tags of a patient or study, kept in the audit trail
+DATE_OFFSET_SCOPES = ['global', 'patient', 'study']
+
+# Dates always kept in the header catalog, on top of the relative_dates tags
+CATALOG_DATES = [(0x0008, 0x0020), (0x0008, 0x0021), (0x0008, 0x0022), (0x0008, 0x0023), (0x0010, 0x0030)]
+
+# Stages of DicomAnon.process_file that are timed for hooks, in the order they run
+STAGES = ['read', 'quarantine', 'relative_dates', 'anonymize', 'encode', 'save']
+
+# Sources and destinations with these endings are read and written as archives, see DicomAnon.run_archive
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.zip')
+TAR_WRITE_MODES = {'.tar': 'w|', '.tar.gz': 'w|gz', '.tgz': 'w|gz', '.tar.bz2': 'w|bz2', '.tbz2': 'w|bz2'}
+
+# Outcomes of processing a single file
+CLEANED = 'cleaned'
+QUARANTINED = 'quarantined'
+FAILED = 'failed'
+
 logger = logging.getLogger('dicom_anon')
 logger.setLevel(logging.INFO)
 
 
-class Audit(object):
+def normalize_white_list_value(value):
+    return WHITE_LIST_SPACES.sub(' ', WHITE_LIST_IGNORED.sub('', value.lower().strip()))
 
-    def __init__(self, filename):
-        self.db = sqlite3.connect(filename)
-        self.cursor = self.db.cursor()
-        if not os.path.isfile(filename):
-            with self.db as db:
-                # create the table that holds the studyintance because others will refer to it
-                db.execute(CREATE_NON_LINKED_TABLE % 'studyinstanceuid')
+
+class WhiteListMatcher(object):
+    """The allowed values of one white listed tag, checked against the normalized value.
+
+    Plain entries are kept in a set. Entries given as {"prefix": ...} or {"regex": ...} are combined into one
+    pattern: prefixes are normalized like plain entries, regular expressions have to match the whole normalized
+    value and ignore case. The outcome for each value is remembered, descriptions repeat within a series.
+    """
+
+    def __init__(self, entries):
+        values = set()
+        alternatives = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                values.add(normalize_white_list_value(entry))
+            elif 'prefix' in entry:
+                alternatives.append(re.escape(normalize_white_list_value(entry['prefix'])))
+            elif 'regex' in entry:
+                alternatives.append(r'(?:%s)\Z' % entry['regex'])
+            else:
+                raise Exception('White list entries must be strings or have a "prefix" or "regex" key.')
+        self.values = frozenset(values)
+        self.pattern = None
+        if alternatives:
+            try:
+                self.pattern = re.compile('|'.join(alternatives), re.IGNORECASE)
+            except re.error as e:
+                raise Exception('Invalid regular expression in white list: %s' % e)
+        self.memo = dict()
+
+    def matches(self, value):
+        allowed = self.memo.get(value)
+        if allowed is None:
+            normalized = normalize_white_list_value(value)
+            allowed = normalized in self.values or (self.pattern is not None and
+                                                    self.pattern.match(normalized) is not None)
+            if len(self.memo) >= WHITE_LIST_MEMO_SIZE:
+                self.memo.clear()
+            self.memo[value] = allowed
+        return allowed
+
+
+class AuditBackend(object):
+    """What DicomAnon needs from an audit trail, see Audit, MemoryAudit and ShardedAudit.
+
+    Cleaned values are looked up by tag and original value. Study Instance UIDs stand on their own, every
+    other tag is linked to the primary key of its study as returned by get_study_pk. get_next_pk numbers the
+    replacement values of a tag and reserve_uids hands out blocks of UID numbers, see UIDAllocator.
+    Backends may hold writes back until flush. checkpoint is called after every file and returns whether
+    everything saved so far is committed. A backend that leaves out one of the abstract methods cannot be
+    created.
+    """
+
+    __metaclass__ = ABCMeta
 
     @staticmethod
-    def tag_to_table(tag):
-        return re.sub('\W+', '', tag.name.lower())
+    def tag_key(tag):
+        return tag.tag.group, tag.tag.element
+
+    @staticmethod
+    def original_value(tag):
+        if tag.VM > 1:
+            original = [str(val) for val in tag.value]
+            return '/'.join(original)
+        return tag.value
+
+    @staticmethod
+    def is_study_uid(tag):
+        return (tag.tag.group, tag.tag.element) == STUDY_INSTANCE_UID
+
+    def close(self):
+        pass
+
+    def checkpoint(self):
+        return True
+
+    def flush(self):
+        pass
+
+    @abstractmethod
+    def get(self, tag, study_uid_pk=None):
+        raise NotImplementedError
+
+    # Day offsets of relative dates for a scope of DATE_OFFSET_SCOPES, keyed by original Patient ID or
+    # Study Instance UID
+    @abstractmethod
+    def get_date_offsets(self, scope):
+        raise NotImplementedError
+
+    # Stores {key: days} offsets, a key that already has an offset keeps it
+    @abstractmethod
+    def save_date_offsets(self, scope, offsets):
+        raise NotImplementedError
+
+    def save(self, tag, cleaned, study_uid_pk=None):
+        study_uid_pk = None if self.is_study_uid(tag) else study_uid_pk
+        self.save_many([(self.tag_key(tag), self.original_value(tag), cleaned, study_uid_pk)])
+
+    # Inserts ((group, element), original, cleaned, study_uid_pk) rows, study_uid_pk is None for studies
+    @abstractmethod
+    def save_many(self, rows):
+        raise NotImplementedError
+
+    # Replaces cleaned values equal to the current value of tag in one study
+    @abstractmethod
+    def update(self, tag, cleaned, study_uid_pk):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_study_pk(self, cleaned):
+        raise NotImplementedError
+
+    # The next number for a replacement value of tag in the study study_uid_pk
+    @abstractmethod
+    def get_next_pk(self, tag, study_uid_pk=None):
+        raise NotImplementedError
+
+    # Reserves count consecutive UID numbers, returns the namespace and the first number
+    @abstractmethod
+    def reserve_uids(self, count, study_uid_pk=None):
+        raise NotImplementedError
+
+
+class Audit(AuditBackend):
+    """The audit trail in a sqlite file."""
+
+    def __init__(self, filename, check_same_thread=True):
+        self.db = sqlite3.connect(filename, check_same_thread=check_same_thread)
+        self.cursor = self.db.cursor()
+        self.cursor.execute('PRAGMA user_version')
+        version = self.cursor.fetchone()[0]
+        if version == 0 and self.table_exists('studyinstanceuid'):
+            self.db.close()
+            raise Exception('Audit file %s uses the old one table per tag layout, convert it with '
+                            '--migrate_audit first.' % filename)
+        if version == 0:
+            with self.db as db:
+                for statement in CREATE_SCHEMA:
+                    db.execute(statement)
+            version = 2
+        while version in UPGRADE_SCHEMA:
+            with self.db as db:
+                for statement in UPGRADE_SCHEMA[version]:
+                    db.execute(statement)
+                version += 1
+                db.execute('PRAGMA user_version = %d' % version)
+        if version != SCHEMA_VERSION:
+            self.db.close()
+            raise Exception('Audit file %s has unknown schema version %d.' % (filename, version))
+        with self.db as db:
+            # Microseconds since the epoch keep the UIDs of separate audit files apart
+            db.execute(INIT_UID_COUNTER, (int(time.time() * 1000000),))
+        self.cursor.execute('PRAGMA journal_mode=WAL').fetchall()
 
     def close(self):
         self.db.close()
@@ -135,84 +527,1739 @@ class Audit(object):
         return len(results) > 0
 
     def get_study_pk(self, cleaned):
-        self.cursor.execute(STUDY_PK, (cleaned,))
+        self.cursor.execute(STUDY_PK, (cleaned,) + STUDY_INSTANCE_UID)
         results = self.cursor.fetchall()
         return results[0][0]
 
-    def get_next_pk(self, tag):
-        table_name = self.tag_to_table(tag)
-        if not self.table_exists(table_name):
-            return 1
-        self.cursor.execute(NEXT_ID % table_name)
+    def get_next_pk(self, tag, study_uid_pk=None):
+        self.cursor.execute(NEXT_ID, self.tag_key(tag))
         results = self.cursor.fetchall()
-        if results[0][0]:
+        if results:
             return int(results[0][0] + 1)
         else:
             return 1
 
     def get(self, tag, study_uid_pk=None):
-        table_name = self.tag_to_table(tag)
         value = None
-        if tag.VM > 1:
-            original = [str(val) for val in tag.value]
-            original = '/'.join(original)
+        original = self.original_value(tag)
+
+        if self.is_study_uid(tag):
+            self.cursor.execute(GET_NON_LINKED, (original,) + self.tag_key(tag))
         else:
-            original = tag.value
+            self.cursor.execute(GET_LINKED, (original,) + self.tag_key(tag) + (study_uid_pk,))
+        results = self.cursor.fetchall()
+        if len(results):
+            value = results[0][0]
 
-        if not self.table_exists(table_name):
-            return None
+        return value
+
+    def update(self, tag, cleaned, study_uid_pk):
+        original = self.original_value(tag)
+        with self.db as db:
+            db.execute(UPDATE_LINKED, (cleaned, original) + self.tag_key(tag) + (study_uid_pk,))
+
+    # Reserves count consecutive UID numbers, returns the namespace of this audit file and the first number.
+    # The update and read share a transaction, so processes with their own connections get disjoint blocks.
+    def reserve_uids(self, count, study_uid_pk=None):
+        with self.db as db:
+            db.execute(RESERVE_UIDS, (count,))
+            namespace, end = db.execute(GET_UID_COUNTER).fetchall()[0]
+        return namespace, end - count
+
+    def get_date_offsets(self, scope):
+        return {str(key): days for key, days in self.db.execute(GET_DATE_OFFSETS, (scope,))}
+
+    def save_date_offsets(self, scope, offsets):
+        with self.db as db:
+            db.executemany(SAVE_DATE_OFFSET, ((scope, key, days) for key, days in offsets.items()))
+
+    # Inserts ((group, element), original, cleaned, study_uid_pk) rows in one transaction
+    def save_many(self, rows):
+        counts = dict()
+        for row in rows:
+            counts[row[0]] = counts.get(row[0], 0) + 1
+        with self.db as db:
+            db.executemany(INSERT_MAPPING, (row[0] + row[1:] for row in rows))
+            for key, count in counts.items():
+                if db.execute(INCREMENT_COUNTER, (count,) + key).rowcount == 0:
+                    db.execute(INSERT_COUNTER, key + (count,))
+
+
+class MemoryAudit(AuditBackend):
+    """Audit trail that only lives as long as the process, for tests, benchmarks and header scans."""
+
+    def __init__(self):
+        # ((group, element), original, study pk) to cleaned value, the first value saved wins like in Audit
+        self.mappings = dict()
+        # Study pk to the keys of the mappings linked to it, for update
+        self.linked = dict()
+        self.study_pks = dict()
+        self.counters = dict()
+        self.next_id = 1
+        self.namespace = int(time.time() * 1000000)
+        self.next_uid = 1
+        self.date_offsets = dict()
+
+    def get(self, tag, study_uid_pk=None):
+        study_uid_pk = None if self.is_study_uid(tag) else study_uid_pk
+        return self.mappings.get((self.tag_key(tag), self.original_value(tag), study_uid_pk))
+
+    def get_date_offsets(self, scope):
+        return dict(self.date_offsets.get(scope, {}))
+
+    def save_date_offsets(self, scope, offsets):
+        stored = self.date_offsets.setdefault(scope, dict())
+        for key, days in offsets.items():
+            stored.setdefault(key, days)
+
+    def save_many(self, rows):
+        for key, original, cleaned, study_uid_pk in rows:
+            if (key, original, study_uid_pk) not in self.mappings:
+                self.mappings[(key, original, study_uid_pk)] = cleaned
+                if study_uid_pk is not None:
+                    self.linked.setdefault(study_uid_pk, []).append((key, original, study_uid_pk))
+            if key == STUDY_INSTANCE_UID and study_uid_pk is None:
+                self.study_pks.setdefault(cleaned, self.next_id)
+            self.next_id += 1
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def update(self, tag, cleaned, study_uid_pk):
+        tag_key = self.tag_key(tag)
+        original = self.original_value(tag)
+        for key in self.linked.get(study_uid_pk, []):
+            if key[0] == tag_key and self.mappings[key] == original:
+                self.mappings[key] = cleaned
+
+    def get_study_pk(self, cleaned):
+        return self.study_pks[cleaned]
+
+    def get_next_pk(self, tag, study_uid_pk=None):
+        return self.counters.get(self.tag_key(tag), 0) + 1
+
+    def reserve_uids(self, count, study_uid_pk=None):
+        self.next_uid += count
+        return self.namespace, self.next_uid - count
+
+
+class SharedAudit(Audit):
+    """An audit file that processes on other nodes write to at the same time, a shard of a ShardedAudit.
+
+    Nothing is cached or held back, every lookup sees what the other nodes have committed. get_next_pk moves
+    the counter of its tag on in the transaction that reads it, so two nodes never hand out the same number,
+    and save_many leaves the counters alone. A row another node saved first is kept and the new one dropped.
+    """
+
+    def __init__(self, filename, check_same_thread=True):
+        Audit.__init__(self, filename, check_same_thread)
+        # WAL needs memory shared by every connection, nodes on other hosts do not have it
+        self.cursor.execute('PRAGMA journal_mode=DELETE').fetchall()
+
+    def get_next_pk(self, tag, study_uid_pk=None):
+        key = self.tag_key(tag)
+        with self.db as db:
+            if db.execute(INCREMENT_COUNTER, (1,) + key).rowcount == 0:
+                db.execute(INSERT_COUNTER, key + (1,))
+            return int(db.execute(NEXT_ID, key).fetchall()[0][0])
+
+    def save_many(self, rows):
+        with self.db as db:
+            db.executemany(INSERT_MISSING_MAPPING, (row[0] + row[1:] + (row[1],) + row[0] + (row[3],)
+                                                    for row in rows))
 
-        if tag.name.lower() == 'study instance uid':
-            self.cursor.execute(GET_NON_LINKED % table_name, (original,))
-            results = self.cursor.fetchall()
-            if len(results):
-                value = results[0][0]
+
+# File names of the shards of a sharded audit file, identity.db becomes identity.0.db, identity.1.db, ...
+def shard_files(filename, count):
+    if filename == ':memory:':
+        return [filename] * count
+    base, extension = os.path.splitext(filename)
+    return ['%s.%d%s' % (base, number, extension) for number in range(count)]
+
+
+class ShardedAudit(AuditBackend):
+    """Audit trail split over several sqlite files by a hash of the original Study Instance UID.
+
+    A study and everything linked to it live in one shard, so nodes that work on different studies mostly
+    write to different files, and merge_audit combines the shards into one audit file afterwards. Study
+    primary keys carry their shard (pk * shards + shard) and the numbers from get_next_pk are interleaved
+    the same way, so neither clashes across shards. get_next_pk goes to the shard of the study it is given.
+    Each shard is a SharedAudit, read and written directly rather than through a CachedAudit, so nodes
+    sharing the files see each other's rows and numbers.
+
+    UID blocks come from the first shard. UIDAllocator reserves them without a study, and the reservation is
+    one transaction, so every node gets blocks of its own under that shard's namespace, taking the counter
+    once every block_size UIDs.
+    """
+
+    def __init__(self, filenames, check_same_thread=True):
+        self.shards = [SharedAudit(filename, check_same_thread) for filename in filenames]
+        # Shard of every cleaned Study Instance UID seen, for get_study_pk
+        self.study_shards = dict()
+
+    # Stable across processes and nodes, unlike hash()
+    def shard_of(self, study_uid):
+        return int(hashlib.sha1(str(study_uid)).hexdigest(), 16) % len(self.shards)
+
+    # Shard and shard primary key of a study primary key
+    def split(self, study_uid_pk):
+        if study_uid_pk is None:
+            return 0, None
+        return study_uid_pk % len(self.shards), study_uid_pk // len(self.shards)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def checkpoint(self):
+        return all([shard.checkpoint() for shard in self.shards])
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def get(self, tag, study_uid_pk=None):
+        if self.is_study_uid(tag):
+            number = self.shard_of(self.original_value(tag))
+            cleaned = self.shards[number].get(tag)
+            if cleaned is not None:
+                self.study_shards[cleaned] = number
+            return cleaned
+        number, study_uid_pk = self.split(study_uid_pk)
+        return self.shards[number].get(tag, study_uid_pk=study_uid_pk)
+
+    def save(self, tag, cleaned, study_uid_pk=None):
+        if self.is_study_uid(tag):
+            number = self.shard_of(self.original_value(tag))
+            self.study_shards[cleaned] = number
+            self.shards[number].save(tag, cleaned)
         else:
-            self.cursor.execute(GET_LINKED % table_name, (original, study_uid_pk))
-            results = self.cursor.fetchall()
-            if len(results):
-                value = results[0][0]
+            number, study_uid_pk = self.split(study_uid_pk)
+            self.shards[number].save(tag, cleaned, study_uid_pk=study_uid_pk)
+
+    def save_many(self, rows):
+        by_shard = dict()
+        for key, original, cleaned, study_uid_pk in rows:
+            if key == STUDY_INSTANCE_UID and study_uid_pk is None:
+                number = self.shard_of(original)
+                self.study_shards[cleaned] = number
+            else:
+                number, study_uid_pk = self.split(study_uid_pk)
+            by_shard.setdefault(number, []).append((key, original, cleaned, study_uid_pk))
+        for number, shard_rows in by_shard.items():
+            self.shards[number].save_many(shard_rows)
+
+    def update(self, tag, cleaned, study_uid_pk):
+        number, study_uid_pk = self.split(study_uid_pk)
+        self.shards[number].update(tag, cleaned, study_uid_pk)
+
+    # Date offsets are few and set before a run starts, they all live in the first shard
+    def get_date_offsets(self, scope):
+        return self.shards[0].get_date_offsets(scope)
+
+    def save_date_offsets(self, scope, offsets):
+        self.shards[0].save_date_offsets(scope, offsets)
+
+    def get_study_pk(self, cleaned):
+        number = self.study_shards[cleaned]
+        return self.shards[number].get_study_pk(cleaned) * len(self.shards) + number
+
+    def get_next_pk(self, tag, study_uid_pk=None):
+        number, study_uid_pk = self.split(study_uid_pk)
+        return (self.shards[number].get_next_pk(tag, study_uid_pk) - 1) * len(self.shards) + number + 1
+
+    def reserve_uids(self, count, study_uid_pk=None):
+        # Every shard has its own namespace
+        number, study_uid_pk = self.split(study_uid_pk)
+        return self.shards[number].reserve_uids(count, study_uid_pk)
+
+
+def merge_audit(filename, shards):
+    """Combines the shard files of a ShardedAudit, in shard order, into the audit file filename.
+
+    filename must not have any mappings yet. Study primary keys are renumbered and the counters are set past
+    every number the shards handed out, so the merged file carries on without clashes. UIDs made from the
+    merged file get a namespace of their own. The shards are only read.
+    """
+    for shard_file in shards:
+        if not os.path.exists(shard_file):
+            raise Exception('Audit shard %s does not exist.' % shard_file)
+    target = Audit(filename)
+    try:
+        if target.db.execute('SELECT COUNT(*) FROM mapping').fetchall()[0][0]:
+            raise Exception('Audit file %s already has mappings, merge into a new file.' % filename)
+        counters = dict()
+        with target.db as db:
+            for number, shard_file in enumerate(shards):
+                # A plain connection, Audit would upgrade the shard and set up its UID counter
+                source = sqlite3.connect(shard_file)
+                try:
+                    if source.execute(TABLE_EXISTS, ('mapping',)).fetchall() == []:
+                        raise Exception('Audit shard %s has no mapping table.' % shard_file)
+                    studies = dict()
+                    for row in source.execute(MERGE_STUDIES).fetchall():
+                        studies[row[0]] = db.execute(INSERT_MAPPING, row[1:] + (None,)).lastrowid
+                    rows = source.execute(MERGE_LINKED).fetchall()
+                    db.executemany(INSERT_MAPPING, (row[:4] + (studies[row[4]],) for row in rows))
+                    for group, element, value in source.execute(MERGE_COUNTERS).fetchall():
+                        # The largest number this shard handed out, see ShardedAudit.get_next_pk
+                        value = (value - 1) * len(shards) + number + 1
+                        counters[(group, element)] = max(counters.get((group, element), 0), value)
+                    # Shards from before relative dates were kept in the audit trail have no offsets
+                    if source.execute(TABLE_EXISTS, ('date_offset',)).fetchall():
+                        db.executemany(SAVE_DATE_OFFSET, source.execute(MERGE_DATE_OFFSETS).fetchall())
+                finally:
+                    source.close()
+                logger.info('Merged %d studies and %d linked values from %s' % (len(studies), len(rows), shard_file))
+            db.executemany(INSERT_COUNTER, (key + (value,) for key, value in counters.items()))
+    finally:
+        target.close()
+
+
+# The sqlite files an audit backend keeps its trail in
+def audit_files(filename, backend='sqlite', shards=4):
+    if backend == 'sqlite':
+        return [filename]
+    if backend == 'sharded':
+        return shard_files(filename, shards)
+    return []
+
+
+class AuditReader(object):
+    """Read only lookups in the files of an audit trail, for scan reports and bulk re-identification. Files
+    that do not exist yet are not created, they just have no mappings.
+
+    Bulk lookups yield (tag_group, tag_element, original, cleaned, study original, study cleaned) rows, the
+    study being the Study Instance UID the row belongs to, None for the study rows themselves.
+    """
+
+    def __init__(self, filenames):
+        self.dbs = [sqlite3.connect(filename) for filename in filenames
+                    if filename != ':memory:' and os.path.exists(filename)]
+        for db in self.dbs:
+            # Values come back as the bytes they were saved from, ready to be written out
+            db.text_factory = str
+            if db.execute(TABLE_EXISTS, ('mapping',)).fetchall() == []:
+                self.close()
+                raise Exception('Audit file has no mapping table, convert it with --migrate_audit first.')
+
+    # The database and primary key of a study, None if the study is not in the audit trail yet
+    def study(self, study_uid):
+        for db in self.dbs:
+            rows = db.execute(SCAN_STUDY_PK, (study_uid,) + STUDY_INSTANCE_UID).fetchall()
+            if rows:
+                return db, rows[0][0]
+        return None
+
+    @staticmethod
+    def has(study, key, original):
+        db, study_pk = study
+        return len(db.execute(GET_LINKED, (original,) + key + (study_pk,)).fetchall()) > 0
+
+    # Every row whose cleaned value, or original value when column is 'original', is one of values
+    def lookup(self, values, column='cleaned', batch=LOOKUP_BATCH):
+        missing = 0
+        for values in self.batches(values, batch):
+            found = set()
+            for db in self.dbs:
+                self.load_values(db, values)
+                for row in db.execute(LOOKUP[column]):
+                    found.add(row[3] if column == 'cleaned' else row[2])
+                    yield row
+            missing += len(set(values) - found)
+        if missing:
+            logger.info('%d values are not in the audit trail' % missing)
+
+    # Every row of the studies whose cleaned Study Instance UIDs, or original ones when column is 'original',
+    # are in study_uids. Each study starts with its own row and the rest follow in the order they were saved.
+    def export(self, study_uids, column='cleaned', batch=LOOKUP_BATCH):
+        for study_uids in self.batches(study_uids, batch):
+            for db in self.dbs:
+                self.load_values(db, study_uids)
+                studies = db.execute(LOOKUP_STUDIES[column], STUDY_INSTANCE_UID).fetchall()
+                for study_pk, original, cleaned in studies:
+                    yield STUDY_INSTANCE_UID + (original, cleaned, None, None)
+                    for row in db.execute(STUDY_ROWS, (study_pk,)):
+                        yield row + (original, cleaned)
+
+    @staticmethod
+    def batches(values, batch):
+        values = iter(values)
+        while True:
+            chunk = list(islice(values, batch))
+            if not chunk:
+                return
+            yield chunk
 
+    @staticmethod
+    def load_values(db, values):
+        with db:
+            for statement in CREATE_LOOKUP:
+                db.execute(statement)
+            db.executemany(INSERT_LOOKUP, ((value,) for value in values))
+
+    def close(self):
+        for db in self.dbs:
+            db.close()
+
+
+# Values to look up, one per line, blank lines are skipped
+def read_values(filename):
+    with open(filename, 'r') as handle:
+        for line in handle:
+            value = line.rstrip('\r\n')
+            if value:
+                yield value
+
+
+# Writes rows from AuditReader.lookup or AuditReader.export as CSV with a header line, see LOOKUP_COLUMNS
+def write_mapping(rows, handle):
+    writer = csv.writer(handle)
+    writer.writerow(LOOKUP_COLUMNS)
+    for tag_group, tag_element, original, cleaned, study_original, study_cleaned in rows:
+        try:
+            name = dictionary_description((tag_group, tag_element))
+        except KeyError:
+            name = ''
+        writer.writerow(['%04X,%04X' % (tag_group, tag_element), name, original, cleaned, study_original,
+                         study_cleaned])
+
+
+def migrate_audit(filename):
+    """Converts an audit file from the one table per tag layout to the current schema, in place.
+
+    Study rows keep their ids so the study column of every other row stays valid. Tables that do
+    not belong to a tag in AUDIT are left alone and reported.
+    """
+    # Each tag used to get a table named after its description
+    tables = dict((re.sub('\W+', '', dictionary_description(tag).lower()), tag) for tag in AUDIT.keys())
+    db = sqlite3.connect(filename, isolation_level=None)
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] != 0 or not \
+                db.execute(TABLE_EXISTS, ('studyinstanceuid',)).fetchall():
+            raise Exception('Audit file %s does not use the old one table per tag layout.' % filename)
+        legacy = [row[0] for row in db.execute(LEGACY_TABLES).fetchall()]
+        db.execute('BEGIN')
+        for statement in CREATE_SCHEMA:
+            db.execute(statement)
+        # Studies first so their ids are still free
+        legacy.remove('studyinstanceuid')
+        legacy.insert(0, 'studyinstanceuid')
+        for table_name in legacy:
+            if table_name not in tables:
+                logger.warning('Table %s in %s is not an audited tag, leaving it as it is' % (table_name, filename))
+                continue
+            key = tables[table_name]
+            if key == STUDY_INSTANCE_UID:
+                rows = db.execute(LEGACY_NON_LINKED % table_name).fetchall()
+                db.executemany('INSERT INTO mapping (id, tag_group, tag_element, original, cleaned) '
+                               'VALUES (?, ?, ?, ?, ?)', ((row[0],) + key + row[1:] for row in rows))
+            else:
+                rows = db.execute(LEGACY_LINKED % table_name).fetchall()
+                db.executemany(INSERT_MAPPING, (key + row[1:] for row in rows))
+            if rows:
+                db.execute(INSERT_COUNTER, key + (rows[-1][0],))
+            db.execute('DROP TABLE %s' % table_name)
+            logger.info('Migrated %d rows of %s' % (len(rows), table_name))
+        db.execute('COMMIT')
+        db.execute('VACUUM')
+    finally:
+        db.close()
+
+
+class CachedAudit(object):
+    """Write-back cache in front of an Audit.
+
+    Lookups are kept in a bounded LRU keyed by (tag, original, study pk), misses included.
+    New linked mappings are buffered and committed in one transaction every `batch_files` files
+    or `batch_seconds` seconds, whichever comes first, and on close. Study Instance UIDs are
+    written through right away because their primary keys are needed to link everything else.
+    This is only correct while this object is the sole writer of the database.
+    """
+
+    def __init__(self, audit, size=10000, batch_files=100, batch_seconds=5.0):
+        self.audit = audit
+        self.size = size
+        self.batch_files = batch_files
+        self.batch_seconds = batch_seconds
+        self.cache = OrderedDict()
+        self.study_pks = OrderedDict()
+        self.next_pks = dict()
+        self.pending = []
+        self.files = 0
+        self.last_flush = time.time()
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+
+    def _key(self, tag, study_uid_pk):
+        study_uid_pk = None if self.audit.is_study_uid(tag) else study_uid_pk
+        return self.audit.tag_key(tag), self.audit.original_value(tag), study_uid_pk
+
+    def close(self):
+        self.flush()
+        self.audit.close()
+
+    def checkpoint(self):
+        self.files += 1
+        if self.files >= self.batch_files or time.time() - self.last_flush >= self.batch_seconds:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self.pending:
+            self.audit.save_many(self.pending)
+            self.pending = []
+        self.files = 0
+        self.last_flush = time.time()
+
+    def get_study_pk(self, cleaned):
+        pk = self.study_pks.pop(cleaned, None)
+        if pk is None:
+            pk = self.audit.get_study_pk(cleaned)
+        self._remember(self.study_pks, cleaned, pk)
+        return pk
+
+    def reserve_uids(self, count, study_uid_pk=None):
+        return self.audit.reserve_uids(count, study_uid_pk)
+
+    def get_date_offsets(self, scope):
+        return self.audit.get_date_offsets(scope)
+
+    def save_date_offsets(self, scope, offsets):
+        self.audit.save_date_offsets(scope, offsets)
+
+    def get_next_pk(self, tag, study_uid_pk=None):
+        key = self.audit.tag_key(tag)
+        if key not in self.next_pks:
+            self.next_pks[key] = self.audit.get_next_pk(tag, study_uid_pk)
+        return self.next_pks[key]
+
+    def get(self, tag, study_uid_pk=None):
+        key = self._key(tag, study_uid_pk)
+        if key in self.cache:
+            value = self.cache.pop(key)
+        else:
+            value = self.audit.get(tag, study_uid_pk=study_uid_pk)
+        self._remember(self.cache, key, value)
         return value
 
     def update(self, tag, cleaned, study_uid_pk):
-        table_name = self.tag_to_table(tag)
-        if tag.VM > 1:
-            original = [str(val) for val in tag.value]
-            original = '/'.join(original)
+        self.flush()
+        self.audit.update(tag, cleaned, study_uid_pk)
+        tag_key, original, _ = self._key(tag, study_uid_pk)
+        for key, value in self.cache.items():
+            if key[0] == tag_key and key[2] == study_uid_pk and value == original:
+                self.cache[key] = cleaned
+
+    # Bulk inserts bypass the buffer, the cache and counters start over
+    def save_many(self, rows):
+        self.flush()
+        self.audit.save_many(rows)
+        self.cache = OrderedDict()
+        self.next_pks = dict()
+
+    def save(self, tag, cleaned, study_uid_pk=None):
+        key = self._key(tag, study_uid_pk)
+        if self.audit.is_study_uid(tag):
+            self.audit.save(tag, cleaned, study_uid_pk=study_uid_pk)
         else:
-            original = tag.value
+            # Keep the counters behind get_next_pk in step with the rows that are not written yet
+            self.get_next_pk(tag, study_uid_pk)
+            self.next_pks[key[0]] += 1
+            self.pending.append((key[0], key[1], cleaned, study_uid_pk))
+        self.cache.pop(key, None)
+        self._remember(self.cache, key, cleaned)
+
+
+class Manifest(object):
+    """Record of the input files that have been cleaned or quarantined, so later runs can skip them.
+
+    Files are keyed by their path relative to the source directory. A file counts as unchanged when its
+    size and modification time match, or, if hashing is on, when its size and SHA-1 match. Records are
+    buffered until flush, which the caller does once the audit rows of those files are committed.
+    In a parallel run the pool's task thread checks files while the main thread records them.
+    """
+
+    def __init__(self, filename, use_hash=False):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db as db:
+            db.execute(CREATE_MANIFEST)
+        self.use_hash = use_hash
+        self.pending = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as handle:
+            for chunk in iter(partial(handle.read, 1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_unchanged(self, key, path):
+        with self.lock:
+            row = self.db.execute(GET_MANIFEST, (key,)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(path)
+        if row[0] != stat.st_size:
+            return False
+        if row[1] == stat.st_mtime:
+            return True
+        return self.use_hash and row[2] is not None and row[2] == self.file_hash(path)
+
+    def record(self, key, path, outcome, destination):
+        stat = os.stat(path)
+        digest = self.file_hash(path) if self.use_hash else None
+        self.pending.append((key, stat.st_size, stat.st_mtime, digest, outcome, destination))
+
+    def flush(self):
+        if self.pending:
+            with self.lock:
+                with self.db as db:
+                    db.executemany(SAVE_MANIFEST, self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class DuplicateIndex(object):
+    """The first copy of every SOP instance a run has seen, so further copies are not cleaned again.
+
+    Copies are keyed by their SOP Instance UID and a fingerprint: a SHA-1 of the file size and of the first and
+    last DUPLICATE_SAMPLE_SIZE bytes. The first copy's path relative to the source directory is kept with
+    where it was cleaned to. The index lives in a sqlite file, so copies in later runs are found too. As with
+    the Manifest the pool's task thread claims files while the main thread records them.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db as db:
+            db.execute(CREATE_DUPLICATE_INDEX)
+        self.lock = threading.Lock()
+        # (sop_uid, fingerprint) of the files claimed but not done yet, by path
+        self.claimed = dict()
+        self.changes = 0
+
+    # Only the file meta and the elements up to SOP Instance UID are read
+    @staticmethod
+    def sop_instance_uid(path):
+        with open(path, 'rb') as handle:
+            ds = read_partial(handle, stop_when=lambda tag, vr, length: tag > SOP_INSTANCE_UID_TAG)
+        return ds.get('SOPInstanceUID', None)
+
+    @staticmethod
+    def fingerprint(path, size):
+        digest = hashlib.sha1(str(size))
+        with open(path, 'rb') as handle:
+            digest.update(handle.read(DUPLICATE_SAMPLE_SIZE))
+            if size > DUPLICATE_SAMPLE_SIZE:
+                handle.seek(max(DUPLICATE_SAMPLE_SIZE, size - DUPLICATE_SAMPLE_SIZE))
+                digest.update(handle.read())
+        return digest.hexdigest()
+
+    # Returns the first copy's (sop_uid, fingerprint, path) when key is a further copy, otherwise claims key as
+    # the first copy and returns None. A file seen again under its own path is not a copy of itself.
+    def first_copy(self, key, sop_uid, fingerprint):
+        with self.lock:
+            if self.db.execute(CLAIM_DUPLICATE, (sop_uid, fingerprint, key)).rowcount == 1:
+                self.changed()
+                self.claimed[key] = (sop_uid, fingerprint)
+                return None
+            path, destination = self.db.execute(GET_DUPLICATE, (sop_uid, fingerprint)).fetchone()
+            if path == key:
+                self.claimed[key] = (sop_uid, fingerprint)
+                return None
+            return sop_uid, fingerprint, path
+
+    # Where the first copy was cleaned to, None while it is not done or when it was not cleaned
+    def cleaned_path(self, sop_uid, fingerprint):
+        with self.lock:
+            row = self.db.execute(GET_DUPLICATE, (sop_uid, fingerprint)).fetchone()
+        return row[1] if row is not None else None
+
+    # A first copy that failed is forgotten, so a copy the walk reaches later, or the next run, is cleaned in its
+    # place. Copies that were already skipped in this run are not tried again until the next run.
+    def done(self, key, outcome, destination):
+        with self.lock:
+            sop_uid_fingerprint = self.claimed.pop(key, None)
+            if sop_uid_fingerprint is None:
+                return
+            if outcome == FAILED:
+                self.db.execute(FORGET_DUPLICATE, sop_uid_fingerprint)
+            else:
+                self.db.execute(SAVE_DUPLICATE, (destination if outcome == CLEANED else None,) + sop_uid_fingerprint)
+            self.changed()
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= DUPLICATE_COMMIT_EVERY:
+            self.db.commit()
+            self.changes = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class Catalog(object):
+    """Header fields of every input file, gathered by one header-only pre-scan before the main pass.
+
+    Files are keyed by their path relative to the source directory and kept with their size and modification
+    time, so a catalog file that is reused only re-reads files that changed and forgets files that are gone.
+    The quarantine decision is made
+    during the scan as well. A fingerprint of the source directory, quarantine rules and date tags is stored
+    with the catalog and the catalog is emptied when it no longer matches.
+    """
+
+    def __init__(self, filename, fingerprint):
+        self.db = sqlite3.connect(filename)
+        with self.db as db:
+            for statement in CREATE_CATALOG:
+                db.execute(statement)
+            row = db.execute(GET_CATALOG_FINGERPRINT).fetchone()
+            if row is None or row[0] != fingerprint:
+                db.execute('DELETE FROM catalog')
+                db.execute('DELETE FROM catalog_date')
+                db.execute(SAVE_CATALOG_FINGERPRINT, (fingerprint,))
+
+    # Size and modification time of every catalogued file
+    def files(self):
+        return {path: (size, mtime) for path, size, mtime in self.db.execute(CATALOG_FILES)}
+
+    # Reason for every file that the scan decided to quarantine
+    def quarantined(self):
+        return dict(self.db.execute(CATALOG_QUARANTINED).fetchall())
+
+    # Saves (key, size, mtime, study_uid, patient_id, modality, quarantine, dates) rows, dates maps tags to values
+    def save_many(self, rows):
+        with self.db as db:
+            for row in rows:
+                db.execute(SAVE_CATALOG, row[:7])
+                db.execute(DELETE_CATALOG_DATES, (row[0],))
+                db.executemany(SAVE_CATALOG_DATE, [(row[0], tag[0], tag[1], value) for tag, value in row[7].items()])
+
+    # Drops files that are no longer in the source directory, so their dates stop counting
+    def remove(self, keys):
         with self.db as db:
-            db.execute(UPDATE_LINKED % table_name, (cleaned, original, study_uid_pk))
+            db.executemany(DELETE_CATALOG, ((key,) for key in keys))
+            db.executemany(DELETE_CATALOG_DATES, ((key,) for key in keys))
+
+    # Patient ID and study UID of every file, None for files that could not be read
+    def studies(self):
+        return {path: (patient_id, study_uid) for path, patient_id, study_uid in self.db.execute(CATALOG_STUDIES)}
+
+    # Earliest valid date of each tag over the files that are not quarantined, None if there is none
+    def first_dates(self, tags):
+        first = dict()
+        for tag in tags:
+            value = self.db.execute(FIRST_CATALOG_DATE, tag).fetchone()[0]
+            first[tag] = datetime.strptime(value, '%Y%m%d') if value else None
+        return first
+
+    # Earliest valid date over all tags for every patient or study, keyed by original Patient ID or Study
+    # Instance UID. Keys without any valid date are left out.
+    def first_dates_by(self, scope, tags):
+        first = dict()
+        for tag in tags:
+            for key, value in self.db.execute(FIRST_CATALOG_DATES_BY[scope], tag):
+                try:
+                    date = datetime.strptime(value, '%Y%m%d')
+                except ValueError:
+                    continue
+                key = str(key)
+                if key not in first or date < first[key]:
+                    first[key] = date
+        return first
+
+    def close(self):
+        self.db.close()
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class ArchiveReader(object):
+    """Reads the files of a tar or zip archive one at a time, without unpacking it to disk.
+
+    Tar archives, compressed or not, are read as a stream. Members are named by their path inside the archive,
+    directories, links and hidden files are skipped like they are when walking a directory, and so are names
+    that would point outside of it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    # Yields (name, mtime, data) for every file in the archive, in archive order
+    def members(self):
+        if self.filename.lower().endswith('.zip'):
+            archive = zipfile.ZipFile(self.filename, 'r')
+            try:
+                for info in archive.infolist():
+                    name = self.member_name(info.filename)
+                    if name is not None:
+                        yield name, time.mktime(info.date_time + (0, 0, -1)), archive.read(info)
+            finally:
+                archive.close()
+        else:
+            archive = tarfile.open(self.filename, 'r|*')
+            try:
+                for info in archive:
+                    name = self.member_name(info.name) if info.isfile() else None
+                    if name is not None:
+                        yield name, float(info.mtime), archive.extractfile(info).read()
+            finally:
+                archive.close()
+
+    @staticmethod
+    def member_name(name):
+        if name.endswith('/') or os.path.basename(name).startswith('.'):
+            return None
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+            logger.warning('Skipping archive member %s, it points outside of the archive' % name)
+            return None
+        return name
+
+
+class ArchiveWriter(object):
+    """Writes files one at a time into a new tar or zip archive, the kind given by the file name ending."""
 
+    def __init__(self, filename):
+        self.filename = filename
+        self.tar = self.zip = None
+        if filename.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            suffix = [suffix for suffix in TAR_WRITE_MODES if filename.lower().endswith(suffix)][0]
+            self.tar = tarfile.open(filename, TAR_WRITE_MODES[suffix])
+
+    # Adds data under name and returns where it went, for the log and manifest
+    def add(self, name, data):
+        if self.zip is not None:
+            self.zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.tar.addfile(info, BytesIO(data))
+        return os.path.join(self.filename, name)
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+
+class UIDAllocator(object):
+    """Hands out UIDs of the form <org_root>.<namespace>.<number> without looking at the clock.
+
+    Numbers are reserved from the audit file in blocks, so any number of processes sharing an audit file
+    (directly or through the AuditService) never hand out the same UID. The namespace is fixed when the
+    audit file is created, which keeps UIDs from different audit files apart.
+    """
+
+    def __init__(self, org_root, audit, block_size=1000):
+        self.org_root = org_root
+        self.audit = audit
+        self.block_size = block_size
+        self.prefix = None
+        self.next = 0
+        self.end = 0
+
+    def generate(self):
+        if self.next >= self.end:
+            namespace, self.next = self.audit.reserve_uids(self.block_size)
+            self.end = self.next + self.block_size
+            self.prefix = '%s.%d.' % (self.org_root, namespace)
+            if len(self.prefix) + len(str(self.end)) > 64:
+                raise Exception('UIDs under org root %s would be longer than 64 characters' % self.org_root)
+        uid = self.prefix + str(self.next)
+        self.next += 1
+        return uid
+
+
+class UUIDAllocator(object):
+    """Hands out UUID derived UIDs (2.25.<uuid as an integer>), unique without any coordination."""
+
+    @staticmethod
+    def generate():
+        return '2.25.%d' % uuid.uuid4().int
+
+
+class Pseudonymizer(object):
+    """Cleaned values computed from the original value and a secret key instead of looked up in the audit file.
+
+    The same key gives the same values in every process and every run, so nothing has to be shared while
+    cleaning. UIDs are <org_root>.<HMAC of the original UID as a decimal number>, references between files
+    stay intact. Tokens replace audited text values with the tag name and an HMAC of the tag, the study and the
+    original value, the same value in another study gets another token like the linked rows of the audit file.
+    """
+
+    def __init__(self, key, org_root):
+        if len(key) < PSEUDONYM_KEY_MIN_LENGTH:
+            raise Exception('The pseudonym key must be at least %d bytes long' % PSEUDONYM_KEY_MIN_LENGTH)
+        self.key = key
+        self.org_root = org_root
+        # 128 bits of the HMAC, cut to what fits in 64 characters
+        self.uid_digits = min(39, 64 - len(org_root) - 1)
+        if self.uid_digits < 20:
+            raise Exception('Keyed UIDs under org root %s would be too short' % org_root)
+
+    @staticmethod
+    def read_key(filename):
+        try:
+            with open(filename, 'rb') as key_handle:
+                return key_handle.read().strip()
+        except IOError:
+            raise Exception('Error opening pseudonym key file.')
+
+    def digest(self, *parts):
+        return hmac.new(self.key, '\0'.join(parts), hashlib.sha256).hexdigest()
+
+    def uid(self, original):
+        return '%s.%s' % (self.org_root, str(int(self.digest('UI', original)[:32], 16))[:self.uid_digits])
+
+    def token(self, e, study_uid):
+        tag = '%04X%04X' % (e.tag.group, e.tag.element)
+        token = self.digest(tag, study_uid, str(AuditBackend.original_value(e)))[:PSEUDONYM_TOKEN_LENGTH]
+        return ('%s %s' % (e.name, token.upper())).encode('ascii')
+
+
+def open_audit(filename, cache_size=0, batch_files=1, batch_seconds=0.0, check_same_thread=True, backend='sqlite',
+               shards=4):
+    if backend == 'memory':
+        return MemoryAudit()
+    if backend == 'sharded':
+        # Other nodes write to the shards too, there is nothing a cache could safely keep
+        return ShardedAudit(shard_files(filename, shards), check_same_thread)
+    audit = Audit(filename, check_same_thread=check_same_thread)
+    if cache_size:
+        audit = CachedAudit(audit, cache_size, batch_files, batch_seconds)
+    return audit
+
+
+class AuditElement(object):
+    """Picklable copy of the parts of a DataElement that Audit looks at."""
+
+    def __init__(self, e):
+        self.tag = Tag(e.tag)
+        self.name = e.name
+        self.VR = e.VR
+        self.VM = e.VM
+        if e.VM > 1:
+            self.value = [str(val) for val in e.value]
+        elif isinstance(e.value, str):
+            # PersonName, UID etc. are str subclasses that do not pickle cleanly
+            self.value = str(e.value)
+        else:
+            self.value = e.value
+
+
+class AuditService(object):
+    """Owns the only connection to the audit database during a parallel run.
+
+    Every call from every worker is serialized here, so there is exactly one writer.
+    """
+
+    def __init__(self, filename, cache_size=0, batch_files=1, batch_seconds=0.0, backend='sqlite', shards=4):
+        self.audit = open_audit(filename, cache_size, batch_files, batch_seconds, False, backend, shards)
+        self.lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            return getattr(self.audit, method)(*args, **kwargs)
+
+
+class AuditLog(threading.Thread):
+    """Writes the mappings of keyed pseudonymization runs to the audit file in the background.
+
+    Entries are (study element, cleaned study UID, [(element, cleaned), ...]) as AuditElements, one per cleaned
+    file, put on queue by the main process or the workers. Rows already in the audit file are left alone, so
+    running the same files twice with the same key adds nothing. The thread owns its own audit connection.
+    """
+
+    FLUSH = 'flush'
+
+    def __init__(self, queue, filename, cache_size=0, batch_files=1, batch_seconds=0.0, backend='sqlite', shards=4):
+        super(AuditLog, self).__init__(name='audit-log')
+        self.daemon = True
+        self.queue = queue
+        self.audit_args = (filename, cache_size, batch_files, batch_seconds, True, backend, shards)
+        self.study_pks = dict()
+        self.conflicts = 0
+
+    def run(self):
+        audit = open_audit(*self.audit_args)
+        try:
+            while True:
+                entry = self.queue.get()
+                try:
+                    if entry is None:
+                        break
+                    if entry == self.FLUSH:
+                        audit.flush()
+                        continue
+                    self.save(audit, *entry)
+                    audit.checkpoint()
+                except Exception as e:
+                    logger.error('Error writing to the audit log: %s' % e)
+                finally:
+                    self.queue.task_done()
+        finally:
+            audit.close()
+
+    def save(self, audit, study, cleaned_study_uid, rows):
+        study_pk = self.study_pks.get(cleaned_study_uid)
+        if study_pk is None:
+            existing = audit.get(study)
+            if existing is None:
+                audit.save(study, cleaned_study_uid)
+            elif str(existing) != cleaned_study_uid:
+                self.conflict(study, existing)
+            study_pk = self.study_pks[cleaned_study_uid] = audit.get_study_pk(existing or cleaned_study_uid)
+        for e, cleaned in rows:
+            existing = audit.get(e, study_uid_pk=study_pk)
+            if existing is None:
+                audit.save(e, cleaned, study_uid_pk=study_pk)
+            elif str(existing) != cleaned:
+                self.conflict(e, existing)
+
+    # The audit file was written by a run with another key or without one
+    def conflict(self, e, existing):
+        self.conflicts += 1
+        if self.conflicts == 1:
+            logger.warning('The audit file already has other cleaned values, %s first, the cleaned files do not '
+                           'match it' % e.name)
+
+    # Waits until every entry queued so far is committed
+    def flush(self):
+        self.queue.put(self.FLUSH)
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.conflicts:
+            logger.warning('%d mappings did not match the audit file' % self.conflicts)
+
+
+class AuditManager(BaseManager):
+    pass
+
+AuditManager.register('AuditService', AuditService)
+
+
+class AuditClient(object):
+    """Stands in for Audit inside worker processes, forwarding calls to the AuditService."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def close(self):
+        self.service.call('close')
+
+    def checkpoint(self):
+        return self.service.call('checkpoint')
+
+    def flush(self):
+        self.service.call('flush')
+
+    def get_study_pk(self, cleaned):
+        return self.service.call('get_study_pk', cleaned)
+
+    def reserve_uids(self, count, study_uid_pk=None):
+        return self.service.call('reserve_uids', count, study_uid_pk)
+
+    def get_next_pk(self, tag, study_uid_pk=None):
+        return self.service.call('get_next_pk', AuditElement(tag), study_uid_pk)
+
+    def get(self, tag, study_uid_pk=None):
+        return self.service.call('get', AuditElement(tag), study_uid_pk=study_uid_pk)
+
+    def update(self, tag, cleaned, study_uid_pk):
+        self.service.call('update', AuditElement(tag), cleaned, study_uid_pk)
 
     def save(self, tag, cleaned, study_uid_pk=None):
-        table_name = self.tag_to_table(tag)
-        if not self.table_exists(table_name):
-            with self.db as db:
-                if tag.name.lower() == 'study instance uid':
-                    db.execute(CREATE_NON_LINKED_TABLE % table_name)
-                else:
-                    db.execute(CREATE_LINKED_TABLE % table_name)
+        self.service.call('save', AuditElement(tag), cleaned, study_uid_pk=study_uid_pk)
 
-        if tag.VM > 1:
-            original = [str(val) for val in tag.value]
-            original = '/'.join(original)
+
+class NullLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# Size of a file, 0 if it cannot be read so the error is reported where the file is read
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Moves a DA or DT value back by days, DT values keep their time. A shift by whole days leaves TM values
+# as they are. None for values that are not dates.
+def shift_date(value, vr, days):
+    if vr == 'TM':
+        return value
+    try:
+        date = datetime.strptime(value[:8], '%Y%m%d') - timedelta(days=days)
+    except (ValueError, TypeError):
+        return None
+    # strftime does not take years before 1900
+    return '%04d%02d%02d' % (date.year, date.month, date.day) + (value[8:] if vr == 'DT' else '')
+
+
+# Whether a dataset element is still a deferred read, its value left in the source file
+def is_deferred(element):
+    return isinstance(element, tuple) and element.value is None
+
+
+# Copies the element a deferred raw element points to, header and value, from the source file to the end of
+# handle, chunk by chunk. The element is written exactly as it is encoded in the source.
+def splice_element(source_path, raw, handle, chunk_size=SPLICE_CHUNK_SIZE):
+    header = 12 if not raw.is_implicit_VR and raw.VR in LONG_LENGTH_VRS else 8
+    remaining = header + raw.length
+    with open(source_path, 'rb') as source:
+        source.seek(raw.value_tell - header)
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError('%s ended before the value of %s' % (source_path, raw.tag))
+            handle.write(chunk)
+            remaining -= len(chunk)
+
+
+# Ambiguous VRs of elements read from implicit VR files, see explicit_vrs
+def explicit_vr(ds, e):
+    if e.VR == 'OB or OW':
+        return 'OW' if ds.get('BitsAllocated', 16) > 8 else 'OB', e.value
+    if e.VR in ('US or OW', 'US or SS or OW'):
+        return 'OW', e.value
+    if e.VR == 'US or SS' and isinstance(e.value, bytes):
+        vr, number = ('SS', 'h') if ds.get('PixelRepresentation', 0) == 1 else ('US', 'H')
+    elif e.VR == 'US\\US or SS\\US' and isinstance(e.value, bytes):
+        vr, number = 'US', 'H'
+    else:
+        return e.VR, e.value
+    values = list(struct.unpack('<%d%s' % (len(e.value) // 2, number), e.value[:len(e.value) // 2 * 2]))
+    return vr, values[0] if len(values) == 1 else values
+
+
+# Gives the elements of a dataset read with implicit VRs, which may be ambiguous, a VR an explicit VR file can hold
+def explicit_vrs(ds):
+    for e in list(ds):
+        if e.VR == 'SQ':
+            for item in e.value:
+                explicit_vrs(item)
+        elif len(e.VR) != 2:
+            e.VR, e.value = explicit_vr(ds, e)
+
+
+def packbits(data):
+    out = bytearray()
+    literal_start = 0
+    for run in RLE_RUN.finditer(data):
+        for start in range(literal_start, run.start(), 128):
+            literal = data[start:min(start + 128, run.start())]
+            out.append(len(literal) - 1)
+            out.extend(literal)
+        out.append(257 - (run.end() - run.start()))
+        out.extend(run.group(1))
+        literal_start = run.end()
+    for start in range(literal_start, len(data), 128):
+        literal = data[start:start + 128]
+        out.append(len(literal) - 1)
+        out.extend(literal)
+    return bytes(out)
+
+
+# One RLE Lossless fragment of a frame of single sample pixels, a segment per byte of the samples, most
+# significant first, with every row encoded on its own
+def rle_frame(frame, rows, columns, sample_bytes):
+    segments = []
+    for byte in reversed(range(sample_bytes)):
+        plane = frame[byte::sample_bytes]
+        segment = b''.join(packbits(plane[row * columns:(row + 1) * columns]) for row in range(rows))
+        segments.append(segment + b'\0' * (len(segment) % 2))
+    offsets = []
+    offset = 64
+    for segment in segments:
+        offsets.append(offset)
+        offset += len(segment)
+    header = struct.pack('<16L', len(segments), *(offsets + [0] * (RLE_MAX_SEGMENTS - len(offsets))))
+    return header + b''.join(segments)
+
+
+def encapsulate(fragments):
+    items = [struct.pack('<HHL', ITEM_TAG[0], ITEM_TAG[1], 0)]
+    for fragment in fragments:
+        items.append(struct.pack('<HHL', ITEM_TAG[0], ITEM_TAG[1], len(fragment)))
+        items.append(fragment)
+    return b''.join(items)
+
+
+# Replaces native single sample pixel data by its RLE Lossless encapsulation, returns False where that is not
+# possible and leaves ds alone
+def rle_encode_pixel_data(ds):
+    if PIXEL_DATA not in ds or ds.get('SamplesPerPixel', 1) != 1 or ds.get('BitsAllocated') not in (8, 16, 32):
+        return False
+    e = ds[PIXEL_DATA]
+    if getattr(e, 'is_undefined_length', False) or not isinstance(e.value, bytes):
+        return False
+    rows, columns, sample_bytes = ds.Rows, ds.Columns, ds.BitsAllocated // 8
+    frame_size = rows * columns * sample_bytes
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    if frame_size == 0 or len(e.value) < frames * frame_size:
+        return False
+    fragments = [rle_frame(e.value[frame * frame_size:(frame + 1) * frame_size], rows, columns, sample_bytes)
+                 for frame in range(frames)]
+    pixels = DataElement(PIXEL_DATA, 'OB', encapsulate(fragments))
+    pixels.is_undefined_length = True
+    ds[PIXEL_DATA] = pixels
+    return True
+
+
+# The cleaned file as bytes in the transfer syntax output_syntax asks for, or None when the file keeps its own:
+# files that are not native little endian, and for rle files without single sample pixel data. The transfer
+# syntax in the file meta clean_meta left is updated to match.
+def encode_dataset(ds, output_syntax):
+    if output_syntax not in ['deflate', 'rle']:
+        return None
+    if ds.file_meta.get('TransferSyntaxUID', None) not in NATIVE_LITTLE_ENDIAN:
+        return None
+    if ds.is_implicit_VR:
+        explicit_vrs(ds)
+    if output_syntax == 'rle':
+        if not rle_encode_pixel_data(ds):
+            return None
+        ds.file_meta.TransferSyntaxUID = RLE_LOSSLESS
+    else:
+        ds.file_meta.TransferSyntaxUID = DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN
+    ds.is_implicit_VR = False
+    ds.is_little_endian = True
+    if not getattr(ds, 'preamble', None):
+        ds.preamble = b'\0' * 128
+    buffer = BytesIO()
+    ds.save_as(buffer)
+    data = buffer.getvalue()
+    # pydicom keeps the file like object it wraps buffer in alive on Python 2, closing it frees the copy
+    buffer.close()
+    if output_syntax == 'deflate':
+        # The file meta, preamble, DICM and its group length element included, stays as it is
+        meta_end = 144 + struct.unpack('<L', data[140:144])[0]
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data[meta_end:]) + compressor.flush()
+        data = data[:meta_end] + deflated + b'\0' * (len(deflated) % 2)
+    return data
+
+
+class FileRecord(object):
+    """Wall time per stage and audit lookups for one file, handed to the hooks when the file is done.
+
+    Stages are read, quarantine, relative_dates, anonymize, encode and save. Files that end up in quarantine
+    only have the first two. bytes_out is the size of the cleaned or quarantined file written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.outcome = None
+        self.modality = None
+        self.bytes = file_size(path)
+        self.bytes_out = 0
+        self.stages = dict()
+        self.audit_hits = 0
+        self.audit_misses = 0
+        self.seconds = 0.0
+        # Where the file went, and for quarantined files why and a summary of the header, see QuarantineIndex
+        self.destination = None
+        self.reason = None
+        self.summary = None
+        # Only set for spooled files, see DicomAnon.watch: seconds from arrival in the spool until the output
+        # was written, and the number of files still waiting in the spool
+        self.latency = None
+        self.queued = None
+        self.started = self.last = time.time()
+
+    # Adds the time since the previous lap to stage
+    def lap(self, stage):
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def audit_lookup(self, hit):
+        if hit:
+            self.audit_hits += 1
         else:
-            original = tag.value
+            self.audit_misses += 1
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.seconds = time.time() - self.started
+
+
+class Hook(object):
+    """Base class for hooks passed to DicomAnon(hooks=[...]).
+
+    Once hooks are given every file is timed, and file_done gets its FileRecord in the main process,
+    also in parallel runs. Without hooks nothing is timed.
+    """
+
+    def run_started(self):
+        pass
+
+    def file_done(self, record):
+        pass
+
+    def run_done(self):
+        pass
+
 
-        # Table exists
+class StageStats(Hook):
+    """Adds up the file records of a run, in total, per modality and per audit outcome.
+
+    Files with at least one audit miss count as 'miss', the others as 'hit'. When filename ends in .csv
+    one row per file is written to it, otherwise the totals are written to it as JSON when the run ends.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.total = self.new_group()
+        self.by_modality = dict()
+        self.by_audit = dict()
+        self.started = None
+        self.wall_seconds = 0.0
+        self.handle = None
+        self.writer = None
+        if filename is not None and filename.lower().endswith('.csv'):
+            self.handle = open(filename, 'wb')
+            self.writer = csv.writer(self.handle)
+            self.writer.writerow(['path', 'outcome', 'modality', 'bytes', 'bytes_out', 'seconds', 'audit_hits',
+                                  'audit_misses'] + STAGES)
+
+    @staticmethod
+    def new_group():
+        return {'files': 0, 'bytes': 0, 'bytes_out': 0, 'seconds': 0.0, 'audit_hits': 0, 'audit_misses': 0,
+                'outcomes': dict(), 'stages': dict()}
+
+    @staticmethod
+    def add(group, record):
+        group['files'] += 1
+        group['bytes'] += record.bytes
+        group['bytes_out'] += record.bytes_out
+        group['seconds'] += record.seconds
+        group['audit_hits'] += record.audit_hits
+        group['audit_misses'] += record.audit_misses
+        group['outcomes'][record.outcome] = group['outcomes'].get(record.outcome, 0) + 1
+        for stage, seconds in record.stages.items():
+            totals = group['stages'].setdefault(stage, {'files': 0, 'seconds': 0.0})
+            totals['files'] += 1
+            totals['seconds'] += seconds
+
+    def run_started(self):
+        self.started = time.time()
+
+    def file_done(self, record):
+        self.add(self.total, record)
+        self.add(self.by_modality.setdefault(record.modality or 'unknown', self.new_group()), record)
+        self.add(self.by_audit.setdefault('miss' if record.audit_misses else 'hit', self.new_group()), record)
+        if self.writer is not None:
+            self.writer.writerow([record.path, record.outcome, record.modality, record.bytes, record.bytes_out,
+                                  '%.6f' % record.seconds, record.audit_hits, record.audit_misses] +
+                                 ['%.6f' % record.stages[stage] if stage in record.stages else ''
+                                  for stage in STAGES])
+
+    def summary(self):
+        return {'wall_seconds': self.wall_seconds, 'run': self.total, 'by_modality': self.by_modality,
+                'by_audit': self.by_audit}
+
+    def run_done(self):
+        if self.started is not None:
+            self.wall_seconds = time.time() - self.started
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        elif self.filename is not None:
+            with open(self.filename, 'w') as handle:
+                json.dump(self.summary(), handle, indent=4, sort_keys=True)
+
+
+class QuarantineIndex(Hook):
+    """Keeps the source, destination, reason and a header summary of every quarantined file in a sqlite file,
+    so reviewers can query them without reading the files. Rows are written in batches and replace the rows
+    of earlier runs for the same path."""
+
+    def __init__(self, filename, batch=1000):
+        self.filename = filename
+        self.batch = batch
+        self.pending = []
+        self.db = None
+
+    def run_started(self):
+        self.db = sqlite3.connect(self.filename)
         with self.db as db:
-            if tag.name.lower() == 'study instance uid':
-                db.execute(INSERT_OTHER % table_name, (original, cleaned))
-            else:
-                db.execute(INSERT_LINKED % table_name, (original, cleaned, study_uid_pk))
+            db.execute(CREATE_QUARANTINE_INDEX)
+
+    def file_done(self, record):
+        if record.outcome != QUARANTINED:
+            return
+        summary = record.summary or dict()
+        self.pending.append((record.path, record.destination, record.reason) +
+                            tuple(summary.get(name) for name, _ in QUARANTINE_SUMMARY) + (record.bytes, time.time()))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.db as db:
+                db.executemany(SAVE_QUARANTINE_INDEX, self.pending)
+            self.pending = []
+
+    def run_done(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+
+class SpoolStatus(Hook):
+    """Rewrites a small JSON status file after every spooled file: how many files are waiting, the outcomes so
+    far and the latency of the last file, on average and at most. Meant to be polled by monitoring."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.status = None
+
+    def run_started(self):
+        self.status = {'started': time.time(), 'updated': None, 'queued': 0, 'files': 0, 'outcomes': dict(),
+                       'latency': {'last': None, 'mean': None, 'max': None}}
+        self.write()
+
+    def file_done(self, record):
+        status = self.status
+        status['updated'] = time.time()
+        status['files'] += 1
+        status['outcomes'][record.outcome] = status['outcomes'].get(record.outcome, 0) + 1
+        if record.queued is not None:
+            status['queued'] = record.queued
+        if record.latency is not None:
+            latency = status['latency']
+            latency['mean'] = ((latency['mean'] or 0.0) * (status['files'] - 1) + record.latency) / status['files']
+            latency['max'] = max(latency['max'] or 0.0, record.latency)
+            latency['last'] = record.latency
+        self.write()
+
+    # Written to a temporary file first so readers never see half a status
+    def write(self):
+        with open(self.filename + '.tmp', 'w') as handle:
+            json.dump(self.status, handle, indent=4, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+class Progress(Hook):
+    """Logs throughput, the quarantine rate and the time left every interval seconds, and keeps the same numbers
+    in a Prometheus text format file for a node exporter's textfile collector when metrics_file is given.
+
+    The files and bytes under ident_dir are counted on a thread while the run starts, the time left is only
+    known once they are. file_done only adds up the record, reports are rate limited to one per interval.
+    """
+
+    def __init__(self, ident_dir=None, metrics_file=None, interval=30.0):
+        self.ident_dir = ident_dir
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.input_files = self.input_bytes = None
+        self.started = self.reported = None
+        self.files = dict()
+        self.bytes_in = self.bytes_out = 0
+        self.audit_hits = self.audit_misses = 0
+
+    def run_started(self):
+        self.started = self.reported = time.time()
+        if self.ident_dir is not None:
+            counter = threading.Thread(target=self.count_inputs, name='progress-count')
+            counter.daemon = True
+            counter.start()
+
+    def count_inputs(self):
+        files = size = 0
+        for path in DicomAnon.walk(self.ident_dir):
+            files += 1
+            size += file_size(path)
+        self.input_files, self.input_bytes = files, size
+        logger.info('%d files, %.1f MB to process' % (files, size / 1048576.0))
+
+    def file_done(self, record):
+        self.files[record.outcome] = self.files.get(record.outcome, 0) + 1
+        self.bytes_in += record.bytes
+        self.bytes_out += record.bytes_out
+        self.audit_hits += record.audit_hits
+        self.audit_misses += record.audit_misses
+        now = time.time()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report(now)
+
+    def run_done(self):
+        if self.started is not None:
+            self.report(time.time())
+
+    def rates(self, now):
+        seconds = max(now - self.started, 1e-6)
+        done = sum(self.files.values())
+        remaining = None
+        if self.input_bytes is not None and self.bytes_in:
+            remaining = max(self.input_bytes - self.bytes_in, 0) * seconds / self.bytes_in
+        lookups = self.audit_hits + self.audit_misses
+        return {
+            'files': done,
+            'seconds': seconds,
+            'files_per_second': done / seconds,
+            'bytes_per_second': self.bytes_in / seconds,
+            'quarantine_ratio': float(self.files.get(QUARANTINED, 0)) / done if done else 0.0,
+            'audit_hit_ratio': float(self.audit_hits) / lookups if lookups else 0.0,
+            'remaining_seconds': remaining,
+        }
+
+    def report(self, now):
+        rates = self.rates(now)
+        done = '%d' % rates['files']
+        if self.input_files is not None:
+            done += ' of %d' % self.input_files
+        left = 'unknown'
+        if rates['remaining_seconds'] is not None:
+            left = str(timedelta(seconds=int(rates['remaining_seconds'])))
+        logger.info('%s files done, %.1f files/s, %.1f MB/s, %.1f%% quarantined, %d failed, %s left' %
+                    (done, rates['files_per_second'], rates['bytes_per_second'] / 1048576.0,
+                     rates['quarantine_ratio'] * 100, self.files.get(FAILED, 0), left))
+        if self.metrics_file is not None:
+            self.write_metrics(now, rates)
+
+    def metrics(self, now, rates):
+        lines = [
+            '# HELP dicom_anon_files_total Files done by outcome.',
+            '# TYPE dicom_anon_files_total counter',
+        ]
+        lines += ['dicom_anon_files_total{outcome="%s"} %d' % (outcome, self.files.get(outcome, 0))
+                  for outcome in [CLEANED, QUARANTINED, FAILED]]
+        values = [
+            ('bytes_read_total', 'counter', 'Bytes of the input files done.', self.bytes_in),
+            ('bytes_written_total', 'counter', 'Bytes of the cleaned and quarantined files written.', self.bytes_out),
+            ('audit_hits_total', 'counter', 'Audit lookups that found a cleaned value.', self.audit_hits),
+            ('audit_misses_total', 'counter', 'Audit lookups that did not.', self.audit_misses),
+            ('audit_hit_ratio', 'gauge', 'Share of audit lookups that found a cleaned value.',
+             rates['audit_hit_ratio']),
+            ('quarantine_ratio', 'gauge', 'Share of the files done that were quarantined.', rates['quarantine_ratio']),
+            ('files_per_second', 'gauge', 'Files done per second since the run started.', rates['files_per_second']),
+            ('bytes_per_second', 'gauge', 'Input bytes done per second since the run started.',
+             rates['bytes_per_second']),
+            ('input_files', 'gauge', 'Files found in the source directory.', self.input_files),
+            ('input_bytes', 'gauge', 'Bytes of the files found in the source directory.', self.input_bytes),
+            ('remaining_seconds', 'gauge', 'Estimated seconds until the run is done.', rates['remaining_seconds']),
+            ('run_started_seconds', 'gauge', 'Unix time the run started.', self.started),
+            ('last_update_seconds', 'gauge', 'Unix time of this update.', now),
+        ]
+        for name, metric_type, description, value in values:
+            if value is None:
+                continue
+            lines += ['# HELP dicom_anon_%s %s' % (name, description), '# TYPE dicom_anon_%s %s' % (name, metric_type),
+                      'dicom_anon_%s %s' % (name, repr(float(value)) if metric_type == 'gauge' else value)]
+        return '\n'.join(lines) + '\n'
+
+    # Written to a temporary file first so the exporter never reads half a file
+    def write_metrics(self, now, rates):
+        with open(self.metrics_file + '.tmp', 'w') as handle:
+            handle.write(self.metrics(now, rates))
+        os.rename(self.metrics_file + '.tmp', self.metrics_file)
+
+
+class PendingFile(object):
+    """A file on its way through the reader, anonymizer and writer stages of DicomAnon.run_pipeline."""
+
+    def __init__(self, source_path, ident_dir, reason, record):
+        self.source_path = source_path
+        self.ident_dir = ident_dir
+        self.reason = reason
+        self.record = record
+        self.size = file_size(source_path)
+        self.ds = None
+        self.read_error = None
+        self.exception = None
+        self.read = threading.Event()
+        self.outcome = None
+        self.destination = None
+
+
+class ByteBudget(object):
+    """Limits the bytes of the files in a pipeline, a file bigger than the limit still goes through on its own."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, block=True):
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                if not block:
+                    return False
+                self.condition.wait()
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class Spool(object):
+    """Files dropped into a spool directory, handed out once they are complete.
+
+    A file is complete once its size and modification time have not changed for settle_seconds. With pyinotify
+    installed a file is also complete as soon as it is closed after writing or moved into the spool, and the
+    directory is only walked at start up, otherwise it is walked on every call to ready. Hidden files are
+    ignored, so senders can write to a dot file and rename it when they are done.
+    """
+
+    def __init__(self, spool_dir, settle_seconds=5.0, use_inotify=True):
+        self.spool_dir = spool_dir
+        self.settle_seconds = settle_seconds
+        # Path to (size, mtime) and the time it arrived with that size and mtime
+        self.waiting = dict()
+        # Path to the (size, mtime) it failed with, it is only tried again once it changes
+        self.failed = dict()
+        self.closed = set()
+        self.rescan = True
+        self.notifier = None
+        if use_inotify and pyinotify is not None:
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(manager, self.notified)
+            manager.add_watch(spool_dir, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO, rec=True, auto_add=True)
+
+    def notified(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW or (event.dir and event.mask & pyinotify.IN_MOVED_TO):
+            # Events were lost or a whole directory arrived, walk the spool again
+            self.rescan = True
+        elif not event.dir and event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO) and \
+                not os.path.basename(event.pathname).startswith('.'):
+            self.closed.add(event.pathname)
+
+    # Waits up to timeout seconds, or with inotify until something happens in the spool
+    def wait(self, timeout):
+        if self.notifier is None:
+            time.sleep(timeout)
+        elif self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    # Complete files, oldest first
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        paths = set(self.waiting)
+        if self.notifier is None or self.rescan:
+            paths.update(DicomAnon.walk(self.spool_dir))
+            self.rescan = False
+        closed, self.closed = self.closed, set()
+        paths.update(closed)
+        ready = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:  # Gone again
+                self.waiting.pop(path, None)
+                self.failed.pop(path, None)
+                continue
+            key = (stat.st_size, stat.st_mtime)
+            if self.failed.get(path) == key:
+                continue
+            self.failed.pop(path, None)
+            if path not in self.waiting or self.waiting[path][0] != key:
+                self.waiting[path] = (key, min(now, stat.st_mtime))
+            arrived = self.waiting[path][1]
+            if path in closed or now - arrived >= self.settle_seconds:
+                ready.append((arrived, path))
+        return [path for arrived, path in sorted(ready)]
+
+    # When path arrived, see ready
+    def arrived(self, path):
+        return self.waiting[path][1]
+
+    # Files seen that are not done yet
+    def queued(self):
+        return len(self.waiting)
+
+    def done(self, path, failed=False):
+        key, arrived = self.waiting.pop(path)
+        if failed:
+            self.failed[path] = key
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+
+# State of a worker process in a parallel run, see DicomAnon.run_parallel
+_worker = None
+
+
+def _init_worker(options, service, lock, date_adjust, timing, audit_log_queue):
+    global _worker
+    _worker = DicomAnon(audit=AuditClient(service), **options)
+    _worker.audit_log_queue = audit_log_queue
+    _worker.audit_lock = lock
+    _worker.date_adjust = date_adjust
+    _worker.timing = timing
+
 
+def _init_scanner(options):
+    global _worker
+    _worker = DicomAnon(audit=MemoryAudit(), **options)
+
+
+def _scan_file(job):
+    return _worker.scan_header(*job)
+
+
+def _scan_report_file(source_path):
+    return _worker.scan_report_file(source_path)
+
+
+def _process_file(job):
+    return (job[0],) + _worker.process_file(*job) + (_worker.record,)
+
+
+def _process_group(job):
+    return _worker.process_group(*job)
 
 
 class DicomAnon(object):
 
     def __init__(self, **kwargs):
+        audit = kwargs.pop('audit', None)
+        # Hooks only run in this process, worker processes just time their files
+        self.hooks = list(kwargs.pop('hooks', None) or [])
+        self.stats_file = kwargs.pop('stats', None)
+        if self.stats_file is not None:
+            self.hooks.append(StageStats(self.stats_file))
+        self.quarantine_index_file = kwargs.pop('quarantine_index', None)
+        if self.quarantine_index_file is not None:
+            self.hooks.append(QuarantineIndex(self.quarantine_index_file))
+        # Kept so worker processes can build an identical instance. Only this process records to the manifest,
+        # and workers log through the handler this process sets up below, so they get neither.
+        self.options = dict(kwargs, manifest=None, log_handler=False)
         self.profile = kwargs.get('profile', 'basic')
         self.spec_file = kwargs.get('spec_file', os.path.join(os.path.dirname(__file__), 'spec_files',
                                                               'annexe_ext.dat'))
@@ -220,6 +2267,7 @@ class DicomAnon(object):
         self.audit_file = kwargs.get('audit_file', 'identity.db')
         self.log_file = kwargs.get('log_file', 'dicom_anon.log')
         self.quarantine = kwargs.get('quarantine', 'quarantine')
+        self.quarantine_mode = kwargs.get('quarantine_mode', 'copy')
         self.modalities = [string.lower() for string in kwargs.get('modalities', ['mr', 'ct'])]
         self.org_root = kwargs.get('org_root', '5.555.5')
         self.rename = kwargs.get('rename', False)
@@ -227,7 +2275,44 @@ class DicomAnon(object):
         self.keep_private_tags = kwargs.get('keep_private_tags', False)
         self.keep_csa_headers = kwargs.get('keep_csa_headers', False)
         self.relative_dates = kwargs.get('relative_dates', None)
-
+        self.date_offsets = kwargs.get('date_offsets', 'global')
+        if self.date_offsets not in DATE_OFFSET_SCOPES:
+            raise Exception('Unknown date offset scope %s' % self.date_offsets)
+        self.workers = kwargs.get('workers', 1) or 1
+        self.uid_scheme = kwargs.get('uid_scheme', 'counter')
+        self.uid_block_size = kwargs.get('uid_block_size', 1000)
+        self.defer_size = kwargs.get('defer_size', 64 * 1024)
+        self.quarantine_rules_file = kwargs.get('quarantine_rules', None)
+        self.manifest_file = kwargs.get('manifest', None)
+        self.manifest_hash = kwargs.get('manifest_hash', False)
+        self.catalog_file = kwargs.get('catalog', None)
+        self.group_by = kwargs.get('group_by', None)
+        self.read_threads = kwargs.get('read_threads', 0)
+        self.write_threads = kwargs.get('write_threads', None)
+        if self.write_threads is None:
+            self.write_threads = self.read_threads
+        self.queue_depth = kwargs.get('queue_depth', 16)
+        self.queue_memory = kwargs.get('queue_memory', 256)
+        self.audit_cache_size = kwargs.get('audit_cache_size', 10000)
+        self.audit_batch_files = kwargs.get('audit_batch_files', 100)
+        self.audit_batch_seconds = kwargs.get('audit_batch_seconds', 5.0)
+        self.audit_backend = kwargs.get('audit_backend', 'sqlite')
+        self.audit_shards = kwargs.get('audit_shards', 4)
+        self.engine = kwargs.get('engine', 'dataset')
+        if self.engine not in ENGINES:
+            raise Exception('Unknown engine %s' % self.engine)
+        self.output_syntax = kwargs.get('output_syntax', 'keep')
+        if self.output_syntax not in OUTPUT_SYNTAXES:
+            raise Exception('Unknown output syntax %s' % self.output_syntax)
+        self.pseudonym_key_file = kwargs.get('pseudonym_key', None)
+        self.pseudonymizer = None
+        if self.pseudonym_key_file is not None:
+            self.pseudonymizer = Pseudonymizer(Pseudonymizer.read_key(self.pseudonym_key_file), self.org_root)
+        # Files are only timed when someone is listening
+        self.timing = len(self.hooks) > 0
+        self.record = None
+
+        self.white_list = dict()
         if self.white_list_file is not None:
             try:
                 with open(self.white_list_file, 'r') as white_list_handle:
@@ -236,29 +2321,79 @@ class DicomAnon(object):
                 raise Exception('Error opening white list file.')
 
         self.spec = self.parse_spec_file(self.spec_file)
+        self.plan = self.compile_plan()
+        self.default_actions = dict()
 
-        self.audit = Audit(self.audit_file)
-
-        self.current_uid = None
-
-        logger.handlers = []
-        if not self.log_file:
-            self.log = logging.StreamHandler()
+        rules = QUARANTINE_RULES
+        if self.quarantine_rules_file is not None:
+            try:
+                with open(self.quarantine_rules_file, 'r') as rules_handle:
+                    rules = self.convert_json_quarantine_rules(json.load(rules_handle))
+            except IOError:
+                raise Exception('Error opening quarantine rules file.')
+        self.quarantine_rules = self.compile_quarantine_rules(rules)
+
+        self.audit = audit or open_audit(self.audit_file, self.audit_cache_size, self.audit_batch_files,
+                                         self.audit_batch_seconds, backend=self.audit_backend,
+                                         shards=self.audit_shards)
+        self.manifest = None
+        if self.manifest_file is not None:
+            if self.quarantine_mode == 'move':
+                raise Exception('Quarantined files cannot be moved when a manifest records their source')
+            self.manifest = Manifest(self.manifest_file, self.manifest_hash)
+        self.duplicates = kwargs.get('duplicates', 'process')
+        if self.duplicates not in DUPLICATE_MODES:
+            raise Exception('Unknown duplicates mode %s' % self.duplicates)
+        self.duplicate_index_file = kwargs.get('duplicate_index', None)
+        # Opened by inputs, so workers never open it. The copies to link to their first copy's cleaned file
+        # are kept as (source_path, ident_dir, clean_dir, sop_uid, fingerprint) until the run ends.
+        self.duplicate_index = None
+        self.duplicate_links = []
+        self.duplicate_counts = {'files': 0, 'bytes': 0}
+        # Set once a hard link or reflink could not be made and a copy was used instead
+        self.transfer_fallback = False
+        # Held around every read-modify-write of the audit trail, only a real lock in parallel runs
+        self.audit_lock = NullLock()
+
+        if self.uid_scheme == 'uuid':
+            self.uid_allocator = UUIDAllocator()
         else:
-            self.log = logging.FileHandler(self.log_file)
+            self.uid_allocator = UIDAllocator(self.org_root, self.audit, self.uid_block_size)
+        self.date_adjust = None
+        for tag in self.removed_relative_dates():
+            logger.warning('Relative date %s is removed by the spec file, it is left out of the cleaned files' %
+                           Tag(tag))
+        self.catalog_dates = sorted(set(CATALOG_DATES) | set(self.relative_dates or []))
+        # Quarantine reasons the catalog already knows, keyed by path relative to the source directory
+        self.quarantined = dict()
+        # Opened by the first scan_report_file
+        self.audit_reader = None
+        # Keyed pseudonymization only: the thread writing the audit file and the queue it reads, workers only
+        # get the queue. pending_mappings collects the rows of the file being cleaned.
+        self.audit_log = None
+        self.audit_log_queue = None
+        self.pending_study = None
+        self.pending_mappings = None
+
+        self.log = None
+        if kwargs.get('log_handler', True):
+            logger.handlers = []
+            if not self.log_file:
+                self.log = logging.StreamHandler()
+            else:
+                self.log = logging.FileHandler(self.log_file)
 
-        self.log.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.log.setFormatter(formatter)
-        logger.addHandler(self.log)
+            self.log.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            self.log.setFormatter(formatter)
+            logger.addHandler(self.log)
 
     @staticmethod
     def get_first_date(target_dir, tags=((0x0010, 0x0030),)):
         min_date = {tag: datetime(3000, 1, 1) for tag in tags}
-        for root, _, files in os.walk(target_dir):
-            filename = sorted(files)[0]
+        for path in DicomAnon.walk(target_dir):
             try:
-                ds = dicom.read_file(open(os.path.join(root, filename)), stop_before_pixels=True)
+                ds = dicom.read_file(path, stop_before_pixels=True)
             except (IOError, InvalidDicomError):
                 continue
             for tag in tags:
@@ -276,9 +2411,30 @@ class DicomAnon(object):
         for tag in h.keys():
             a, b = tag.split(',')
             t = (int(a, 16), int(b, 16))
-            value[t] = [re.sub(' +', ' ', re.sub('[-_,.]', '', x.lower().strip())) for x in h[tag]]
+            value[t] = WhiteListMatcher(h[tag])
         return value
 
+    @staticmethod
+    def convert_json_quarantine_rules(h):
+        rules = []
+        for rule in h:
+            a, b = rule['tag'].split(',')
+            rules.append(((int(a, 16), int(b, 16)), rule['test'], rule.get('values', None), rule['reason']))
+        return rules
+
+    # Groups the rules by tag so each element is fetched and normalized once, keeping the
+    # position of every rule so the first matching rule in the original order still wins
+    def compile_quarantine_rules(self, rules):
+        compiled = OrderedDict()
+        for index, (tag, test, values, reason) in enumerate(rules):
+            if test not in ('contains', 'equals', 'not_in', 'missing'):
+                raise Exception('Unknown quarantine test %s' % test)
+            if values is None and test == 'not_in':
+                values = self.modalities
+            values = [value.strip().lower() for value in values or []]
+            compiled.setdefault(Tag(tag), []).append((index, test, values, reason))
+        return compiled.items()
+
     @staticmethod
     def parse_spec_file(filename):
         spec_dict = dict()
@@ -294,10 +2450,17 @@ class DicomAnon(object):
         return spec_dict
 
     def close_all(self):
-        if self.log_file:
+        self.stop_audit_log()
+        if self.duplicate_index is not None:
+            self.close_duplicates()
+        if self.log_file and self.log is not None:
             self.log.flush()
             self.log.close()
         self.audit.close()
+        if self.manifest is not None:
+            self.manifest.close()
+        for hook in self.hooks:
+            hook.run_done()
 
     # Determines destination of cleaned/quarantined file based on
     # source folder
@@ -309,13 +2472,77 @@ class DicomAnon(object):
             raise Exception('The file to be moved must be in the root directory')
         return os.path.normpath(os.path.join(dest, os.path.relpath(os.path.dirname(source), root)))
 
+    # Workers of a parallel run may race to create the same directory
+    @staticmethod
+    def make_dirs(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
     def quarantine_file(self, filepath, ident_dir, reason):
         full_quarantine_dir = self.destination(filepath, self.quarantine, ident_dir)
         if not os.path.exists(full_quarantine_dir):
-            os.makedirs(full_quarantine_dir)
+            self.make_dirs(full_quarantine_dir)
         quarantine_name = os.path.join(full_quarantine_dir, os.path.basename(filepath))
         logger.info('%s will be moved to quarantine directory due to: %s' % (filepath, reason))
-        shutil.copyfile(filepath, quarantine_name)
+        self.transfer(filepath, quarantine_name)
+        return quarantine_name
+
+    # Puts source at target as quarantine_mode says: copy, hardlink, reflink or move. Sources are never
+    # modified, so a hard link or reflink is as good as a copy. Both fall back to a copy where the file
+    # system cannot make them, across devices for instance.
+    def transfer(self, source, target):
+        if self.quarantine_mode == 'move':
+            shutil.move(source, target)
+            return
+        if self.quarantine_mode in ('hardlink', 'reflink'):
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                if self.quarantine_mode == 'hardlink':
+                    os.link(source, target)
+                else:
+                    self.reflink(source, target)
+                return
+            except (OSError, IOError) as e:
+                if not self.transfer_fallback:
+                    logger.warning('Could not %s %s, copying to quarantine instead: %s' %
+                                   (self.quarantine_mode, source, e))
+                    self.transfer_fallback = True
+        shutil.copyfile(source, target)
+
+    @staticmethod
+    def reflink(source, target):
+        if fcntl is None:
+            raise OSError('Reflinks are not supported on this platform')
+        with open(source, 'rb') as source_handle:
+            with open(target, 'wb') as target_handle:
+                fcntl.ioctl(target_handle.fileno(), FICLONE, source_handle.fileno())
+
+    # Header fields for the quarantine index, as plain strings and numbers
+    @staticmethod
+    def header_summary(ds):
+        summary = dict()
+        for name, tag in QUARANTINE_SUMMARY:
+            if tag not in ds or ds[tag].value is None:
+                continue
+            value = ds[tag].value
+            if ds[tag].VM > 1:
+                summary[name] = '\\'.join(str(item) for item in value)
+            elif isinstance(value, int):
+                summary[name] = value
+            else:
+                summary[name] = str(value)
+        return summary
+
+    # Notes why a file is quarantined on its record, ds is the header if it could be read
+    def quarantined_by(self, reason, ds, record):
+        if record is not None:
+            record.reason = reason
+            record.summary = self.header_summary(ds) if ds is not None else None
+        return QUARANTINED, reason
 
     # Return true if file should be quarantined
     # TODO the presence of the following attributes
@@ -329,119 +2556,168 @@ class DicomAnon(object):
     # (0x0018,0x1018) - Secondary Capture Device Manufacturer's Model Name
     # (0x0018,0x1019) - Secondary Capture Device Software Versions
     def check_quarantine(self, ds):
-        if SERIES_DESCR in ds and ds[SERIES_DESCR].value is not None:
-            series_desc = ds[SERIES_DESCR].value.strip().lower()
-            if 'patient protocol' in series_desc:
-                return True, 'patient protocol'
-            elif 'save' in series_desc:  # from link in comment below
-                return True, 'Likely screen capture'
-
-        if MODALITY in ds:
-            modality = ds[MODALITY]
-            if modality.VM == 1:
-                modality = [modality.value]
-            for m in modality:
-                if m is None or not m.lower() in self.modalities:
-                    return True, 'modality not allowed'
-
-        if MODALITY not in ds:
-            return True, 'Modality missing'
-
-        if BURNT_IN in ds and ds[BURNT_IN].value is not None:
-            burnt_in = ds[BURNT_IN].value
-            if burnt_in.strip().lower() in ['yes', 'y']:
-                return True, 'burnt-in data'
-
-        # The following were taken from https://wiki.cancerimagingarchive.net/download/attachments/
-        # 3539047/pixel-checker-filter.script?version=1&modificationDate=1333114118541&api=v2
-        if IMAGE_TYPE in ds:
-            image_type = ds[IMAGE_TYPE]
-            if image_type.VM == 1:
-                image_type = [image_type.value]
-            for i in image_type:
-                if i is not None and 'save' in i.strip().lower():
-                    return True, 'Likely screen capture'
-
-        if MANUFACTURER in ds:
-            manufacturer = ds[MANUFACTURER].value.strip().lower()
-            if 'north american imaging, inc' in manufacturer or 'pacsgear' in manufacturer:
-                return True, 'Manufacturer is suspect'
-
-        if MANUFACTURER_MODEL_NAME in ds:
-            model_name = ds[MANUFACTURER_MODEL_NAME].value.strip().lower()
-            if 'the dicom box' in model_name:
-                return True, 'Manufacturer model name is suspect'
+        match = None
+        for tag, rules in self.quarantine_rules:
+            if match is not None and rules[0][0] > match[0]:
+                break
+            items = None
+            if tag in ds:
+                e = ds[tag]
+                items = [e.value] if e.VM == 1 else e.value
+                items = [None if item is None else item.strip().lower() for item in items]
+            for index, test, values, reason in rules:
+                if match is not None and index > match[0]:
+                    break
+                if test == 'missing':
+                    matched = items is None
+                elif items is None:
+                    matched = False
+                elif test == 'not_in':
+                    matched = any(item is None or item not in values for item in items)
+                elif test == 'equals':
+                    matched = any(item is not None and item in values for item in items)
+                else:
+                    matched = any(item is not None and value in item for item in items for value in values)
+                if matched:
+                    match = index, reason
+                    break
+        if match is not None:
+            return True, match[1]
         return False, ''
 
     def generate_uid(self):
-
-        while True:
-            n = datetime.now()
-            new_guid = '%s.%s.%s.%s.%s.%s.%s' % (self.org_root, n.year, n.month, n.day,
-                                                 n.minute, n.second, n.microsecond)
-            if new_guid != self.current_uid:
-                self.current_uid = new_guid
-                break
-        return self.current_uid
-
-    def clean_cb(self, ds, e, study_pk):
-        if self.enforce_profile(ds, e, study_pk):
-            return
-        if self.vr_handler(ds, e):
-            return
-        if not self.keep_overlay and self.overlay_data_handler(ds, e):
-            return
-        if self.overlay_comment_handler(ds, e):
-            return
-        if self.curve_data_handler(ds, e):
-            return
-        self.personal_handler(ds, e)
-
-    def enforce_profile(self, ds, e, study_pk):
-        white_listed = False
-        cleaned = None
+        return self.uid_allocator.generate()
+
+    def start_audit_log(self, queue):
+        self.audit_log = AuditLog(queue, self.audit_file, self.audit_cache_size, self.audit_batch_files,
+                                  self.audit_batch_seconds, self.audit_backend, self.audit_shards)
+        self.audit_log.start()
+        self.audit_log_queue = queue
+
+    def stop_audit_log(self):
+        if self.audit_log is not None:
+            self.audit_log.close()
+        self.audit_log = self.audit_log_queue = None
+
+    # Hands the mappings of a cleaned file to the audit log thread
+    def log_mappings(self, study, cleaned_study_uid, rows):
+        if self.audit_log_queue is None:
+            self.start_audit_log(Queue.Queue(AUDIT_LOG_QUEUE_SIZE))
+        self.audit_log_queue.put((study, cleaned_study_uid, rows))
+
+    # Works out, once, what happens to each tag the spec file, the white list or the profile has an opinion
+    # about. Entries are (rule, white_listed, audited): rule is the first option of the spec file's basic
+    # profile column or None for tags the spec does not cover, white_listed means the value is checked
+    # against the white list first. Everything else is decided by default_action.
+    def compile_plan(self):
+        plan = dict()
+        candidates = set(self.spec.keys())
         if self.profile == 'clean':
+            candidates.update(self.white_list.keys())
+        for tag in candidates:
+            if not self.keep_private_tags and tag[0] & 1:
+                continue
+            spec = self.spec.get(tag)
             # If it's in the ANNEX, we need to specifically be able to clean it
-            if (e.tag in self.spec.keys() and self.spec[(e.tag.group, e.tag.element)][9] == 'C') \
-                    or not (e.tag in self.spec.keys()):
-                white_listed = self.white_list_handler(e)
-                if not white_listed:
-                    cleaned = self.basic(ds, e, study_pk)
-            else:
-                cleaned = self.basic(ds, e, study_pk)
-        else:
-            cleaned = self.basic(ds, e, study_pk)
-
-        if cleaned is not None and e.tag in ds and ds[e.tag].value is not None:
-            ds[e.tag].value = cleaned
-
-        # Tell our caller if we cleaned this element
-        if e.tag in self.spec.keys() or white_listed:
-            return True
+            white_listed = self.profile == 'clean' and tag in self.white_list and (spec is None or spec[9] == 'C')
+            if spec is None and not white_listed:
+                continue
+            # For now we aren't going to worry about IOD type conformance, just do the first option
+            rule = spec[2][0] if spec is not None else None
+            plan[Tag(tag)] = (rule, white_listed, tag in AUDIT)
+        return plan
+
+    # The relative_dates tags the plan deletes, so there is nothing to shift them back into
+    def removed_relative_dates(self):
+        removed = []
+        for tag in self.relative_dates or []:
+            action = self.plan.get(Tag(tag))
+            if action is not None:
+                rule, white_listed, audited = action
+                if rule == 'X' and not white_listed:
+                    removed.append(tag)
+            elif self.default_action(Tag(tag), dictionaryVR(tag)) == DELETE:
+                removed.append(tag)
+        return removed
+
+    # Whether an element without an entry in the plan is deleted
+    def default_action(self, tag, vr):
+        group = tag.group
+        if not self.keep_private_tags and group & 1:
+            return DELETE
+        if vr in REMOVED_VRS and tag != PIXEL_DATA:
+            return DELETE
+        if not self.keep_overlay and group & GROUP_RANGE_MASK == OVERLAY_GROUP and tag.element == 0x3000:
+            return DELETE
+        if group & GROUP_RANGE_MASK == OVERLAY_GROUP and tag.element == 0x4000:  # Overlay comments
+            return DELETE
+        if group & GROUP_RANGE_MASK == CURVE_GROUP or group == PERSONAL_GROUP:
+            return DELETE
+        return KEEP
+
+    def dump_plan(self, handle):
+        plan = dict(('%04X,%04X' % (tag.group, tag.element),
+                     {'rule': rule, 'white_listed': white_listed, 'audited': audited})
+                    for tag, (rule, white_listed, audited) in self.plan.items())
+        defaults = {
+            'sequences': DELETE,
+            'private_tags': KEEP if self.keep_private_tags else DELETE,
+            'removed_vrs': sorted(REMOVED_VRS),
+            'overlay_data': KEEP if self.keep_overlay else DELETE,
+            'overlay_comments': DELETE,
+            'curve_data': DELETE,
+            'personal_group': DELETE,
+        }
+        removed = self.removed_relative_dates()
+        relative_dates = dict(('%04X,%04X' % tag, DELETE if tag in removed else 'shift')
+                              for tag in self.relative_dates or [])
+        json.dump({'profile': self.profile, 'tags': plan, 'defaults': defaults, 'relative_dates': relative_dates},
+                  handle, indent=4, sort_keys=True)
 
-        return False
+    def clean_cb(self, ds, e, study_pk):
+        action = self.plan.get(e.tag)
+        if action is not None:
+            rule, white_listed, audited = action
+            if white_listed and self.white_list_handler(e):
+                return
+            # Sequences are currently just removed, there is no audit support
+            if e.VR == 'SQ':
+                del ds[e.tag]
+                return
+            if rule is not None:
+                cleaned = self.basic(ds, e, study_pk, rule, audited)
+                if cleaned is not None and e.tag in ds and ds[e.tag].value is not None:
+                    # Person names are written through PersonName, a plain str is not encoded on Python 2
+                    ds[e.tag].value = PersonName(cleaned) if e.VR == 'PN' else cleaned
+                return
+        elif e.VR == 'SQ':
+            del ds[e.tag]
+            return
+        key = (e.tag, e.VR)
+        action = self.default_actions.get(key)
+        if action is None:
+            action = self.default_actions[key] = self.default_action(e.tag, e.VR)
+        if action == DELETE:
+            del ds[e.tag]
 
     # Returning None from this function signifies that e was not altered
-    def basic(self, ds, e, study_pk):
-        # Sequences are currently just removed
-        # there is no audit support
-        if e.VR == 'SQ':
-            del ds[e.tag]
-            return REMOVED_TEXT
+    def basic(self, ds, e, study_pk, rule, audited):
+        if self.pseudonymizer is not None:
+            return self.pseudonymize(ds, e, rule, audited)
         cleaned = None
-        value = ds[e.tag].value
-        prior_cleaned = self.audit.get(e, study_uid_pk=study_pk)
-        # pydicom does not want to write unicode strings back to the files
-        # but sqlite is returning unicode, test and convert
-        if prior_cleaned:
-            prior_cleaned = str(prior_cleaned)
-        if e.tag in self.spec.keys():
-            rule = self.spec[(e.tag.group, e.tag.element)][2][0]  # For now we aren't going to worry about
-            # IOD type conformance, just do the first option
+        value = e.value
+        with self.audit_lock if audited else NullLock():
+            prior_cleaned = self.audit.get(e, study_uid_pk=study_pk) if audited else None
+            if audited and self.record is not None:
+                self.record.audit_lookup(prior_cleaned is not None)
+            # pydicom does not want to write unicode strings back to the files
+            # but sqlite is returning unicode, test and convert
+            if prior_cleaned:
+                prior_cleaned = str(prior_cleaned)
             if rule == 'D':
-                cleaned = prior_cleaned or self.replace_vr(e)
+                cleaned = prior_cleaned or self.replace_vr(e, study_pk)
             if rule == 'Z':
-                cleaned = prior_cleaned or self.replace_vr(e)
+                cleaned = prior_cleaned or self.replace_vr(e, study_pk)
             if rule == 'X':
                 del ds[e.tag]
                 cleaned = prior_cleaned or REMOVED_TEXT
@@ -450,69 +2726,51 @@ class DicomAnon(object):
             if rule == 'U':
                 cleaned = prior_cleaned or self.generate_uid()
 
-        if e.tag in AUDIT.keys():
-            if cleaned is not None and cleaned != value and prior_cleaned is None and not (e.tag == STUDY_INSTANCE_UID):
-                self.audit.save(e, cleaned, study_uid_pk=study_pk)
+            if audited:
+                if cleaned is not None and cleaned != value and prior_cleaned is None and \
+                        not (e.tag == STUDY_INSTANCE_UID):
+                    self.audit.save(e, cleaned, study_uid_pk=study_pk)
 
         return cleaned
 
+    # basic with keyed values: nothing is read from the audit file, the rows are logged once the file is done
+    def pseudonymize(self, ds, e, rule, audited):
+        cleaned = None
+        value = e.value
+        if rule in ('D', 'Z'):
+            cleaned = self.replace_vr(e)
+        if rule == 'X':
+            del ds[e.tag]
+            cleaned = REMOVED_TEXT
+        if rule == 'K':
+            cleaned = value
+        if rule == 'U':
+            cleaned = self.pseudonymizer.uid(str(AuditBackend.original_value(e)))
+        if audited and cleaned is not None and cleaned != value and e.tag != STUDY_INSTANCE_UID:
+            self.pending_mappings.append((AuditElement(e), cleaned))
+        return cleaned
+
     # TODO this needs work, it should be smarter and cover more VRs properly
-    def replace_vr(self, e):
+    def replace_vr(self, e, study_pk=None):
         if e.VR == 'DT':
             cleaned = CLEANED_TIME
         elif e.VR == 'DA':
             cleaned = CLEANED_DATE
         elif e.VR == 'TM':
             cleaned = CLEANED_TIME
+        elif e.VR == 'UI' and self.pseudonymizer is not None:
+            cleaned = self.pseudonymizer.uid(str(AuditBackend.original_value(e)))
         elif e.VR == 'UI':
             cleaned = self.generate_uid()
         else:
-            if e.tag in AUDIT.keys() and e.name and len(e.name):
-                cleaned = ('%s %d' % (e.name, self.audit.get_next_pk(e))).encode('ascii')
+            if e.tag in AUDIT.keys() and e.name and len(e.name) and self.pseudonymizer is not None:
+                cleaned = self.pseudonymizer.token(e, self.pending_study.value)
+            elif e.tag in AUDIT.keys() and e.name and len(e.name):
+                cleaned = ('%s %d' % (e.name, self.audit.get_next_pk(e, study_pk))).encode('ascii')
             else:
                 cleaned = 'CLEANED'
         return cleaned
 
-    @staticmethod
-    def vr_handler(ds, e):
-        if e.VR in ['PN', 'CS', 'UI', 'DA', 'DT', 'LT', 'UN', 'UT', 'ST', 'AE', 'LO', 'TM', 'SH', 'AS', 'OB',
-                    'OW'] and e.tag != PIXEL_DATA:
-            del ds[e.tag]
-            return True
-        return False
-
-    # Remove group 0x1000 which contains personal information
-    @staticmethod
-    def personal_handler(ds, e):
-        if e.tag.group == 0x1000:
-            del ds[e.tag]
-            return True
-        return False
-
-    # Curve data is (0x50xx,0xxxxx)
-    @staticmethod
-    def curve_data_handler(ds, e):
-        if (e.tag.group / 0xFF) == 0x50:
-            del ds[e.tag]
-            return True
-        return False
-
-    # Overlay comment is (0x60xx,0x4000)
-    @staticmethod
-    def overlay_comment_handler(ds, e):
-        if (e.tag.group / 0xFF) == 0x60 and e.tag.element == 0x4000:
-            del ds[e.tag]
-            return True
-        return False
-
-    # Overlay data is and (0x60xx, 0x3000)
-    @staticmethod
-    def overlay_data_handler(ds, e):
-        if (e.tag.group / 0xFF) == 0x60 and e.tag.element == 0x3000:
-            del ds[e.tag]
-            return True
-        return False
-
     @staticmethod
     def clean_meta(ds, e):
         if e.VR == 'SQ':
@@ -522,10 +2780,36 @@ class DicomAnon(object):
         else:
             del ds[e.tag]
 
+    # clean_cb over the top level of ds without reading deferred values the plan does not need: they are
+    # deleted unread or left in the source file for write_output to copy
+    def clean_stream(self, ds, study_pk):
+        callback = partial(self.clean_cb, study_pk=study_pk)
+        for tag in sorted(ds.keys()):
+            raw = dict.__getitem__(ds, tag)
+            if is_deferred(raw) and self.plan.get(tag) == ('K', False, False):
+                continue
+            if is_deferred(raw) and tag not in self.plan:
+                vr = raw.VR
+                if vr is None:
+                    try:
+                        vr = dictionaryVR(tag)
+                    except KeyError:
+                        vr = 'UN'
+                if vr != 'SQ':
+                    if self.default_action(tag, vr) == DELETE:
+                        del ds[tag]
+                    continue
+            e = ds[tag]
+            callback(ds, e)
+            # Sequences kept by the white list are cleaned like ds.walk would
+            if e.VR == 'SQ' and tag in ds:
+                for item in e.value:
+                    item.walk(callback)
+
     def white_list_handler(self, e):
-        if self.white_list.get((e.tag.group, e.tag.element), None):
-            if not re.sub(' +', ' ', re.sub('[-_,.]', '', e.value.lower().strip())) \
-                    in self.white_list[(e.tag.group, e.tag.element)]:
+        matcher = self.white_list.get((e.tag.group, e.tag.element), None)
+        if matcher is not None:
+            if not matcher.matches(e.value):
                 logger.info('%s not in white list for %s' % (e.value, e.name))
                 return False
             return True
@@ -533,19 +2817,18 @@ class DicomAnon(object):
 
     def anonymize(self, ds):
         # anonymize study_uid, save off id
-        cleaned_study_uid = self.audit.get(ds[STUDY_INSTANCE_UID])
-        if cleaned_study_uid is None:
-            cleaned_study_uid = self.generate_uid()
-            self.audit.save(ds[STUDY_INSTANCE_UID], cleaned_study_uid)
-
-        # Get pk of study_uid
-        study_pk = self.audit.get_study_pk(cleaned_study_uid)
-
-        if not self.keep_private_tags:
-            ds.remove_private_tags()
+        if self.pseudonymizer is not None:
+            self.pending_study = AuditElement(ds[STUDY_INSTANCE_UID])
+            self.pending_mappings = []
+            study_pk = None
+        else:
+            study_pk = self.lookup_study(ds)
 
         # Walk entire file
-        ds.walk(partial(self.clean_cb, study_pk=study_pk))
+        if self.engine == 'stream':
+            self.clean_stream(ds, study_pk)
+        else:
+            ds.walk(partial(self.clean_cb, study_pk=study_pk))
 
         # Fix file meta data portion
         if MEDIA_STORAGE_SOP_INSTANCE_UID in ds.file_meta:
@@ -553,103 +2836,971 @@ class DicomAnon(object):
         ds.file_meta.walk(self.clean_meta)
         return ds, study_pk
 
-    def run(self, ident_dir, clean_dir):
-        # Get first date for tags set in relative_dates
-        date_adjust = None
-        audit_date_correct = None
-        if self.relative_dates is not None:
-            date_adjust = {tag: first_date - datetime(1970, 1, 1) for tag, first_date
-                           in self.get_first_date(ident_dir, self.relative_dates).items()}
+    # Primary key of the study of ds in the audit file, the study is added on first sight
+    def lookup_study(self, ds):
+        with self.audit_lock:
+            cleaned_study_uid = self.audit.get(ds[STUDY_INSTANCE_UID])
+            if self.record is not None:
+                self.record.audit_lookup(cleaned_study_uid is not None)
+            if cleaned_study_uid is None:
+                cleaned_study_uid = self.generate_uid()
+                self.audit.save(ds[STUDY_INSTANCE_UID], cleaned_study_uid)
+
+            # Get pk of study_uid
+            return self.audit.get_study_pk(cleaned_study_uid)
+
+    @staticmethod
+    def walk(ident_dir):
         for root, _, files in os.walk(ident_dir):
             for filename in files:
                 if filename.startswith('.'):
                     continue
-                source_path = os.path.join(root, filename)
-                try:
-                    ds = dicom.read_file(source_path)
-                except IOError:
-                    logger.error('Error reading file %s' % source_path)
-                    self.close_all()
-                    return False
-                except InvalidDicomError:  # DICOM formatting error
-                    self.quarantine_file(source_path, ident_dir, 'Could not read DICOM file.')
-                    continue
-
-                move, reason = self.check_quarantine(ds)
+                yield os.path.join(root, filename)
+
+    # Reads only the header of a file and returns its catalog row, see Catalog.save_many.
+    # Files that cannot be read are left for the main pass to report.
+    def scan_header(self, source_path, key):
+        stat = os.stat(source_path)
+        return self.read_header(source_path, key, stat.st_size, stat.st_mtime, self.defer_size)
+
+    # Catalog row of a file given as a path or an open file. Deferred values are read again through the
+    # file name, so they only work for paths.
+    def read_header(self, source, key, size, mtime, defer_size=None):
+        study_uid = patient_id = modality = reason = None
+        dates = dict()
+        try:
+            ds = dicom.read_file(source, defer_size=defer_size, stop_before_pixels=True)
+        except IOError:
+            ds = None
+        except InvalidDicomError:
+            ds = None
+            reason = 'Could not read DICOM file.'
+        if ds is not None:
+            move, reason = self.check_quarantine(ds)
+            if not move:
+                reason = None
+            study_uid = ds[STUDY_INSTANCE_UID].value if STUDY_INSTANCE_UID in ds else None
+            patient_id = ds[PATIENT_ID].value if PATIENT_ID in ds else None
+            modality = ds[MODALITY].value if MODALITY in ds else None
+            for tag in self.catalog_dates:
+                if tag in ds and ds[tag].VM == 1 and ds[tag].value:
+                    dates[tag] = ds[tag].value
+        return key, size, mtime, study_uid, patient_id, modality, reason, dates
+
+    def open_catalog(self, ident_dir):
+        fingerprint = json.dumps([os.path.abspath(ident_dir), self.catalog_dates,
+                                  [[int(tag), rules] for tag, rules in self.quarantine_rules]])
+        return Catalog(self.catalog_file or ':memory:', fingerprint)
+
+    # Brings the catalog of ident_dir up to date, reading the headers of new and changed files in parallel
+    def build_catalog(self, ident_dir):
+        catalog = self.open_catalog(ident_dir)
+        known = catalog.files()
+        jobs = []
+        for source_path in self.walk(ident_dir):
+            key = os.path.relpath(source_path, ident_dir)
+            stat = os.stat(source_path)
+            if known.pop(key, None) != (stat.st_size, stat.st_mtime):
+                jobs.append((source_path, key))
+        # Whatever is left was deleted since the catalog was last built
+        catalog.remove(known)
+        if self.workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self.workers, _init_scanner, (self.options,))
+            try:
+                self.save_catalog(catalog, pool.imap_unordered(_scan_file, jobs, chunksize=64))
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            self.save_catalog(catalog, (self.scan_header(*job) for job in jobs))
+        logger.info('Catalogued %d new or changed files' % len(jobs))
+        return catalog
+
+    # The catalog of an archive, its members are read one at a time and parsed in memory
+    def build_archive_catalog(self, ident_dir):
+        catalog = self.open_catalog(ident_dir)
+        known = catalog.files()
+        self.save_catalog(catalog, self.archive_headers(ident_dir, known))
+        catalog.remove(known)
+        return catalog
+
+    # Catalog rows of the new and changed members of an archive, members seen are taken out of known
+    def archive_headers(self, ident_dir, known):
+        for name, mtime, data in ArchiveReader(ident_dir).members():
+            if known.pop(name, None) != (len(data), mtime):
+                yield self.read_header(BytesIO(data), name, len(data), mtime)
+
+    # Takes the quarantine decisions and first dates from the catalog and closes it. Returns the studies
+    # of the files when grouping by study or patient, None otherwise.
+    def load_catalog(self, catalog):
+        studies = None
+        # The quarantine index wants a summary of the header, so the main pass has to read it after all
+        if self.quarantine_index_file is None:
+            self.quarantined = catalog.quarantined()
+        if self.relative_dates is not None and self.date_offsets != 'global':
+            self.date_adjust = self.load_date_offsets(catalog.first_dates_by(self.date_offsets, self.relative_dates))
+        elif self.relative_dates is not None:
+            # Tags without any valid date keep the far future sentinel get_first_date uses
+            self.date_adjust = {tag: (first_date or datetime(3000, 1, 1)) - RELATIVE_EPOCH
+                                for tag, first_date in catalog.first_dates(self.relative_dates).items()}
+        if self.group_by is not None:
+            studies = catalog.studies()
+        catalog.close()
+        return studies
+
+    # Day offsets of every patient or study, taken from the audit trail. Patients or studies seen for the first
+    # time get the offset that moves their first date to RELATIVE_EPOCH, and keep it in later runs.
+    def load_date_offsets(self, first_dates):
+        offsets = self.audit.get_date_offsets(self.date_offsets)
+        new = {key: (first_date - RELATIVE_EPOCH).days for key, first_date in first_dates.items()
+               if key not in offsets}
+        if new:
+            self.audit.save_date_offsets(self.date_offsets, new)
+            offsets.update(new)
+        logger.info('%d new and %d stored %s date offsets' % (len(new), len(offsets) - len(new), self.date_offsets))
+        return offsets
+
+    # The relative value of every relative_dates tag of ds, before it is anonymized
+    def relative_date_values(self, ds):
+        if self.date_offsets == 'global':
+            return {tag: (datetime.strptime(ds[tag].value, '%Y%m%d') - self.date_adjust[tag]).strftime('%Y%m%d')
+                    for tag in self.relative_dates}
+        key = PATIENT_ID if self.date_offsets == 'patient' else STUDY_INSTANCE_UID
+        days = self.date_adjust.get(str(ds[key].value)) if key in ds else None
+        values = dict()
+        if days is None:
+            return values
+        for tag in self.relative_dates:
+            if tag in ds:
+                value = shift_date(ds[tag].value, ds[tag].VR, days)
+                if value is not None:
+                    values[tag] = value
+        return values
+
+    # Dry run: reads the headers of ident_dir, over the workers, and reports what a real run would do without
+    # writing any files or audit rows. Returns the report and writes it as JSON to report_file if given.
+    def scan(self, ident_dir, report_file=None):
+        start = time.time()
+        report = {'files': 0, 'bytes': 0, 'outcomes': dict(), 'quarantine_reasons': dict(), 'modalities': dict(),
+                  'elements': dict(), 'new_studies': 0, 'new_audit_rows': dict(), 'white_list': dict()}
+        # Audit rows repeat across files, they are counted once by a digest of their key
+        new_rows = dict()
+        paths = self.walk(ident_dir)
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, _init_scanner, (self.options,))
+            results = pool.imap_unordered(_scan_report_file, paths, chunksize=64)
+        else:
+            results = (self.scan_report_file(path) for path in paths)
+        try:
+            for size, outcome, reason, modality, elements, rows, white_listed in results:
+                report['files'] += 1
+                report['bytes'] += size
+                self.count(report['outcomes'], outcome)
+                self.count(report['modalities'], modality or 'unknown')
+                if reason is not None:
+                    self.count(report['quarantine_reasons'], reason)
+                for action, count in elements.items():
+                    self.count(report['elements'], action, count)
+                for name, key in rows:
+                    new_rows.setdefault(name, set()).add(key)
+                for name, value, kept in white_listed:
+                    tag = report['white_list'].setdefault(name, {'kept': 0, 'removed': 0, 'removed_values': dict()})
+                    if kept:
+                        tag['kept'] += 1
+                    else:
+                        tag['removed'] += 1
+                        self.count(tag['removed_values'], value)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if self.audit_reader is not None:
+                self.audit_reader.close()
+                self.audit_reader = None
+        report['new_studies'] = len(new_rows.pop(dictionary_description(STUDY_INSTANCE_UID), []))
+        report['new_audit_rows'] = {name: len(keys) for name, keys in new_rows.items()}
+        for tag in report['white_list'].values():
+            values = sorted(tag['removed_values'].items(), key=lambda item: -item[1])
+            tag['removed_values'] = dict(values[:SCAN_REPORT_VALUES])
+        report['seconds'] = time.time() - start
+        logger.info('Scanned %d files: %s, %d new studies and %d new audit rows' %
+                    (report['files'], ', '.join('%d %s' % (count, outcome)
+                                                for outcome, count in sorted(report['outcomes'].items())),
+                     report['new_studies'], sum(report['new_audit_rows'].values())))
+        if report_file is not None:
+            with open(report_file, 'w') as handle:
+                json.dump(report, handle, indent=4, sort_keys=True)
+        return report
 
-                if move:
-                    self.quarantine_file(source_path, ident_dir, reason)
+    @staticmethod
+    def count(counts, key, count=1):
+        counts[key] = counts.get(key, 0) + count
+
+    # What a real run would do with one file, judged from its header: (size, outcome, quarantine reason,
+    # modality, element actions, new audit rows, white list checks). Element actions count the spec rules,
+    # 'white_list' and the default 'keep' and 'delete'. New audit rows are (tag name, digest) pairs and white
+    # list checks (tag name, value, kept) triples.
+    def scan_report_file(self, source_path):
+        if self.audit_reader is None:
+            self.audit_reader = AuditReader(audit_files(self.audit_file, self.audit_backend, self.audit_shards))
+        size = file_size(source_path)
+        elements = dict()
+        rows = []
+        white_listed = []
+        try:
+            ds = dicom.read_file(source_path, defer_size=self.defer_size, stop_before_pixels=True)
+        except IOError:
+            return size, FAILED, None, None, elements, rows, white_listed
+        except InvalidDicomError:
+            reason = 'Could not read DICOM file.'
+            return size, QUARANTINED, reason, None, elements, rows, white_listed
+        modality = ds[MODALITY].value if MODALITY in ds else None
+        move, reason = self.check_quarantine(ds)
+        if move:
+            return size, QUARANTINED, reason, modality, elements, rows, white_listed
+        study_uid = ds[STUDY_INSTANCE_UID].value if STUDY_INSTANCE_UID in ds else None
+        study = self.audit_reader.study(study_uid)
+        if study is None:
+            rows.append((dictionary_description(STUDY_INSTANCE_UID), self.row_digest(STUDY_INSTANCE_UID, study_uid)))
+        # Same decisions as clean_cb. Values are only converted for the elements that need them, the raw
+        # element already has the VR unless the file is implicit VR.
+        for tag in ds.keys():
+            e = dict.__getitem__(ds, tag)
+            if e.VR is None:
+                e = ds[tag]
+            action = self.plan.get(tag)
+            rule, white_listed_tag, audited = action if action is not None else (None, False, False)
+            if white_listed_tag:
+                e = ds[tag]
+                kept = self.white_list[(tag.group, tag.element)].matches(e.value)
+                white_listed.append((e.name, str(e.value), kept))
+                if kept:
+                    self.count(elements, 'white_list')
                     continue
+            if e.VR == 'SQ':
+                self.count(elements, DELETE)
+                continue
+            if rule is None:
+                self.count(elements, self.default_action(tag, e.VR))
+                continue
+            self.count(elements, rule)
+            # Rows basic would save, the study was counted above and K keeps the value as it is
+            if audited and rule in ('D', 'Z', 'X', 'U') and tag != STUDY_INSTANCE_UID:
+                e = ds[tag]
+                key = (tag.group, tag.element)
+                original = AuditBackend.original_value(e)
+                if study is None or not self.audit_reader.has(study, key, original):
+                    rows.append((e.name, self.row_digest(key, original, study_uid)))
+        return size, CLEANED, None, modality, elements, rows, white_listed
+
+    # Short stand in for an audit row key, the report only counts distinct keys
+    @staticmethod
+    def row_digest(*key):
+        return hashlib.sha1(repr(key)).digest()[:8]
 
-                # Store adjusted dates for recovery
-                obfusc_dates = None
-                if self.relative_dates is not None:
-                    obfusc_dates = {tag: datetime.strptime(ds[tag].value, '%Y%m%d') - date_adjust[tag]
-                                    for tag in self.relative_dates}
-
-                # Keep CSA Headers
-                csa_headers = dict()
-                if self.keep_csa_headers and (0x29, 0x10) in ds:
-                    csa_headers[(0x29, 0x10)] = ds[(0x29, 0x10)]
-                    for offset in [0x10, 0x20]:
-                        elno = (0x10*0x0100) + offset
-                        csa_headers[(0x29, elno)] = ds[(0x29, elno)]
-
-                destination_dir = self.destination(source_path, clean_dir, ident_dir)
-                if not os.path.exists(destination_dir):
-                    os.makedirs(destination_dir)
-                try:
-                    ds, study_pk = self.anonymize(ds)
-                except ValueError as e:
-                    self.quarantine_file(source_path, ident_dir, 'Error running anonymize function. There may be a '
-                                                                 'DICOM element value that does not match the specified'
-                                                                 ' Value Representation (VR). Error was: %s' % e)
+    @staticmethod
+    def save_catalog(catalog, rows, batch=1000):
+        pending = []
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= batch:
+                catalog.save_many(pending)
+                pending = []
+        catalog.save_many(pending)
+
+    # Returns the outcome (CLEANED, QUARANTINED or FAILED) and where the file ended up.
+    # FAILED means an IO error that should stop the run. When timing, self.record describes the file.
+    # A reason means the catalog already decided to quarantine the file, so it is not read again.
+    def process_file(self, source_path, ident_dir, clean_dir, reason=None):
+        if not self.timing:
+            return self.clean_file(source_path, ident_dir, clean_dir, reason)
+        self.record = FileRecord(source_path)
+        outcome, destination = self.clean_file(source_path, ident_dir, clean_dir, reason)
+        self.record.finish(outcome)
+        return outcome, destination
+
+    def clean_file(self, source_path, ident_dir, clean_dir, reason=None):
+        ds = None
+        if reason is None:
+            try:
+                ds = self.read_dataset(source_path, self.record)
+            except IOError:
+                logger.error('Error reading file %s' % source_path)
+                return FAILED, None
+            except InvalidDicomError:  # DICOM formatting error
+                reason = 'Could not read DICOM file.'
+        outcome, output = self.transform(ds, source_path, ident_dir, clean_dir, reason, self.record)
+        return self.write_output(source_path, ident_dir, outcome, output, self.record)
+
+    def read_dataset(self, source_path, record=None, data=None):
+        if data is None:
+            # Values bigger than defer_size, pixel data above all, are only read once they are used,
+            # so only the header of a file that ends up in quarantine is ever read
+            ds = dicom.read_file(source_path, defer_size=self.defer_size)
+        else:
+            # Deferred values are read again through the file name, so a file in memory is parsed whole
+            ds = dicom.read_file(BytesIO(data))
+        if record is not None:
+            record.lap('read')
+            record.modality = ds.get('Modality', None)
+        return ds
+
+    # Everything between reading and writing a file. Returns QUARANTINED and the reason, or CLEANED and
+    # the cleaned dataset with the name it is saved under.
+    def transform(self, ds, source_path, ident_dir, clean_dir, reason=None, record=None):
+        if reason is not None:
+            return self.quarantined_by(reason, ds, record)
+        filename = os.path.basename(source_path)
+
+        move, reason = self.check_quarantine(ds)
+
+        if move:
+            return self.quarantined_by(reason, ds, record)
+        if record is not None:
+            record.lap('quarantine')
+
+        # Store adjusted dates for recovery
+        obfusc_dates = None
+        if self.relative_dates is not None:
+            obfusc_dates = self.relative_date_values(ds)
+            if record is not None:
+                record.lap('relative_dates')
+
+        # Keep CSA Headers
+        csa_headers = dict()
+        if self.keep_csa_headers and (0x29, 0x10) in ds:
+            csa_headers[(0x29, 0x10)] = ds[(0x29, 0x10)]
+            for offset in [0x10, 0x20]:
+                elno = (0x10*0x0100) + offset
+                csa_headers[(0x29, elno)] = ds[(0x29, elno)]
+
+        try:
+            ds, study_pk = self.anonymize(ds)
+        except ValueError as e:
+            # Part of the header is anonymized by now, so it is left out of the summary
+            return self.quarantined_by('Error running anonymize function. There may be a DICOM element value '
+                                       'that does not match the specified Value Representation (VR). Error was: '
+                                       '%s' % e, None, record)
+        if record is not None:
+            record.lap('anonymize')
+
+        # Recover relative dates
+        if self.relative_dates is not None:
+            for tag, value in obfusc_dates.items():
+                # Dates the spec removed stay removed
+                if tag not in ds:
                     continue
+                # Only the first file of a study finds the placeholder the spec left in the audit trail
+                if tag in AUDIT and ds[tag].value != value and self.pseudonymizer is None:
+                    self.audit.update(ds[tag], value, study_pk)
+                ds[tag].value = value
+            if record is not None:
+                record.lap('relative_dates')
+
+        if self.pseudonymizer is not None:
+            self.log_file_mappings(obfusc_dates or dict())
+
+        # Restore CSA Header
+        if len(csa_headers) > 0:
+            for tag in csa_headers:
+                ds[tag] = csa_headers[tag]
+
+        # Set Patient Identity Removed to YES
+        t = Tag((0x12, 0x62))
+        ds[t] = DataElement(t, 'CS', 'YES')
+
+        # Set the De-identification method code sequence
+        method_ds = Dataset()
+        t = dicom.tag.Tag((0x8, 0x102))
+        if self.profile == 'clean':
+            method_ds[t] = DataElement(t, 'DS', MultiValue(DS, ['113100', '113105']))
+        else:
+            method_ds[t] = DataElement(t, 'DS', MultiValue(DS, ['113100']))
+        t = dicom.tag.Tag((0x12, 0x64))
+        ds[t] = DataElement(t, 'SQ', Sequence([method_ds]))
+
+        out_filename = ds[SOP_INSTANCE_UID].value if self.rename else filename
+        return CLEANED, (ds, os.path.join(self.destination(source_path, clean_dir, ident_dir), out_filename))
+
+    # Queues the rows pseudonymize collected for the audit log, with the shifted dates of relative_dates
+    def log_file_mappings(self, dates):
+        dates = dict((Tag(tag), value) for tag, value in dates.items())
+        rows = []
+        for e, cleaned in self.pending_mappings:
+            cleaned = dates.get(e.tag, cleaned)
+            if cleaned != e.value:
+                rows.append((e, cleaned))
+        study = self.pending_study
+        self.pending_study = self.pending_mappings = None
+        self.log_mappings(study, self.pseudonymizer.uid(study.value), rows)
+
+    # Copies a file to quarantine or saves the cleaned dataset, returns the outcome and where the file went
+    def write_output(self, source_path, ident_dir, outcome, output, record=None):
+        if outcome == QUARANTINED:
+            destination = self.quarantine_file(source_path, ident_dir, output)
+            if record is not None:
+                record.lap('quarantine')
+                record.bytes_out = file_size(destination)
+            return QUARANTINED, destination
+        ds, clean_name = output
+        destination_dir = os.path.dirname(clean_name)
+        if not os.path.exists(destination_dir):
+            self.make_dirs(destination_dir)
+        try:
+            self.save_dataset(ds, clean_name, record)
+        except IOError:
+            logger.error('Error writing file %s' % clean_name)
+            return FAILED, None
+        if record is not None:
+            record.lap('save')
+            record.bytes_out = file_size(clean_name)
+        return CLEANED, clean_name
+
+    # With the stream engine a last element that was never read, the pixel data as a rule, is copied from the
+    # source file after the rest of the dataset is written, instead of being read into memory and encoded.
+    # Files re-encoded for output_syntax are always written whole.
+    def save_dataset(self, ds, clean_name, record=None):
+        data = self.encoded(ds, record)
+        if data is not None:
+            with open(clean_name, 'wb') as handle:
+                handle.write(data)
+            return
+        if self.engine == 'stream' and len(ds) > 0 and isinstance(ds.filename, str):
+            last = max(ds.keys())
+            raw = dict.__getitem__(ds, last)
+            if is_deferred(raw) and raw.length % 2 == 0:
+                del ds[last]
+                with open(clean_name, 'wb') as handle:
+                    ds.save_as(handle)
+                    splice_element(ds.filename, raw, handle)
+                return
+        ds.save_as(clean_name)
+
+    # The cleaned file in output_syntax, None when it is written as it is. Runs wherever files are saved, in the
+    # workers or the writer threads when there are any.
+    def encoded(self, ds, record=None):
+        data = encode_dataset(ds, self.output_syntax)
+        if data is not None and record is not None:
+            record.lap('encode')
+        return data
 
-                # Recover relative dates
-                if self.relative_dates is not None:
-                    for tag in self.relative_dates:
-                        if audit_date_correct != study_pk and tag in AUDIT.keys():
-                            self.audit.update(ds[tag], obfusc_dates[tag].strftime('%Y%m%d'), study_pk)
-                        ds[tag].value = obfusc_dates[tag].strftime('%Y%m%d')
-                    audit_date_correct = study_pk
-
-                # Restore CSA Header
-                if len(csa_headers) > 0:
-                    for tag in csa_headers:
-                        ds[tag] = csa_headers[tag]
-
-                # Set Patient Identity Removed to YES
-                t = Tag((0x12, 0x62))
-                ds[t] = DataElement(t, 'CS', 'YES')
-
-                # Set the De-identification method code sequence
-                method_ds = Dataset()
-                t = dicom.tag.Tag((0x8, 0x102))
-                if self.profile == 'clean':
-                    method_ds[t] = DataElement(t, 'DS', MultiValue(DS, ['113100', '113105']))
-                else:
-                    method_ds[t] = DataElement(t, 'DS', MultiValue(DS, ['113100']))
-                t = dicom.tag.Tag((0x12, 0x64))
-                ds[t] = DataElement(t, 'SQ', Sequence([method_ds]))
+    def run(self, ident_dir, clean_dir):
+        if is_archive(ident_dir) or is_archive(clean_dir) or is_archive(self.quarantine):
+            return self.run_archive(ident_dir, clean_dir)
+        for hook in self.hooks:
+            hook.run_started()
+        self.date_adjust = None
+        self.quarantined = dict()
+        studies = None
+        # One header-only pass over all files finds the first dates, the files to quarantine and the studies
+        if self.catalog_file is not None or self.relative_dates is not None or self.group_by is not None:
+            studies = self.load_catalog(self.build_catalog(ident_dir))
+        if studies is not None:
+            return self.run_groups(ident_dir, clean_dir, self.groups(ident_dir, studies, clean_dir))
+        if self.workers > 1:
+            return self.run_parallel(ident_dir, clean_dir)
+        if self.read_threads > 0 or self.write_threads > 0:
+            return self.run_pipeline(ident_dir, clean_dir)
+        for source_path in self.inputs(ident_dir, clean_dir):
+            outcome, destination = self.process_file(source_path, ident_dir, clean_dir,
+                                                     self.quarantined.get(os.path.relpath(source_path, ident_dir)))
+            self.file_done(source_path, ident_dir, outcome, destination, self.record)
+            if outcome == FAILED:
+                self.close_all()
+                return False
+
+        self.close_all()
+        return True
 
-                out_filename = ds[SOP_INSTANCE_UID].value if self.rename else filename
-                clean_name = os.path.join(destination_dir, out_filename)
+    # Files under ident_dir that still need to be processed
+    def inputs(self, ident_dir, clean_dir=None):
+        skipped = 0
+        if self.duplicates != 'process' and self.duplicate_index is None:
+            self.duplicate_index = DuplicateIndex(self.duplicate_index_file or ':memory:')
+            self.duplicate_counts = {'files': 0, 'bytes': 0}
+        for source_path in self.walk(ident_dir):
+            if self.manifest is not None and \
+                    self.manifest.is_unchanged(os.path.relpath(source_path, ident_dir), source_path):
+                skipped += 1
+                continue
+            if self.duplicate_index is not None and self.is_duplicate(source_path, ident_dir, clean_dir):
+                continue
+            yield source_path
+        if skipped:
+            logger.info('Skipped %d files that are unchanged since they were last processed' % skipped)
+
+    # Whether source_path is another copy of a file the duplicate index already has, only the header is read
+    def is_duplicate(self, source_path, ident_dir, clean_dir):
+        try:
+            sop_uid = DuplicateIndex.sop_instance_uid(source_path)
+        except (IOError, InvalidDicomError):
+            return False
+        if not sop_uid:
+            return False
+        size = file_size(source_path)
+        first = self.duplicate_index.first_copy(os.path.relpath(source_path, ident_dir), str(sop_uid),
+                                                DuplicateIndex.fingerprint(source_path, size))
+        if first is None:
+            return False
+        sop_uid, fingerprint, first_path = first
+        logger.info('%s is a copy of %s, skipped' % (source_path, first_path))
+        self.duplicate_counts['files'] += 1
+        self.duplicate_counts['bytes'] += size
+        if self.duplicates == 'link' and clean_dir is not None:
+            self.duplicate_links.append((source_path, ident_dir, clean_dir, sop_uid, fingerprint))
+        return True
+
+    # Gives every copy a hard link to the cleaned file of its first copy where its own cleaned file would have
+    # been, or a copy of it where hard links cannot be made. First copies that were not cleaned get nothing.
+    def link_duplicates(self):
+        linked = 0
+        for source_path, ident_dir, clean_dir, sop_uid, fingerprint in self.duplicate_links:
+            cleaned_path = self.duplicate_index.cleaned_path(sop_uid, fingerprint)
+            if cleaned_path is None or not os.path.exists(cleaned_path):
+                continue
+            name = os.path.basename(cleaned_path) if self.rename else os.path.basename(source_path)
+            target = os.path.join(self.destination(source_path, clean_dir, ident_dir), name)
+            if target == cleaned_path:
+                continue
+            if not os.path.exists(os.path.dirname(target)):
+                self.make_dirs(os.path.dirname(target))
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(cleaned_path, target)
+            except OSError:
+                shutil.copyfile(cleaned_path, target)
+            linked += 1
+        self.duplicate_links = []
+        return linked
+
+    def close_duplicates(self):
+        linked = self.link_duplicates()
+        self.duplicate_index.close()
+        self.duplicate_index = None
+        logger.info('Skipped %d copies of files already processed, %.1f MB not read again, %d linked' %
+                    (self.duplicate_counts['files'], self.duplicate_counts['bytes'] / 1048576.0, linked))
+
+    def file_done(self, source_path, ident_dir, outcome, destination, record=None):
+        if record is not None:
+            record.destination = destination
+            for hook in self.hooks:
+                hook.file_done(record)
+        if self.duplicate_index is not None:
+            self.duplicate_index.done(os.path.relpath(source_path, ident_dir), outcome, destination)
+        committed = self.audit.checkpoint()
+        if self.manifest is not None:
+            if outcome != FAILED:
+                self.manifest.record(os.path.relpath(source_path, ident_dir), source_path, outcome, destination)
+            # Only claim files whose audit rows are safely written
+            if committed:
+                self.manifest.flush()
+
+    # Service mode: keeps this instance, with its spec, white list and audit file, loaded and anonymizes files
+    # as they become complete in spool_dir, see Spool. Cleaned and quarantined files are written like run
+    # writes them, then the audit rows are committed and the spooled file is deleted. Files that fail, for any
+    # reason, are left in the spool and tried again once they change. Runs until stop, a threading.Event, is set
+    # or the process is interrupted.
+    def watch(self, spool_dir, clean_dir, poll_seconds=1.0, settle_seconds=5.0, stop=None):
+        if self.relative_dates is not None or self.group_by is not None or self.workers > 1 or \
+                self.read_threads > 0 or self.write_threads > 0 or self.duplicates != 'process':
+            raise Exception('A spool cannot be used with relative dates, group_by, workers, read or write threads '
+                            'or duplicate detection')
+        if stop is None:
+            stop = threading.Event()
+        spool = Spool(spool_dir, settle_seconds)
+        for hook in self.hooks:
+            hook.run_started()
+        self.date_adjust = None
+        self.quarantined = dict()
+        logger.info('Watching %s %s' % (spool_dir, 'with inotify' if spool.notifier is not None else 'by polling'))
+        try:
+            while not stop.is_set():
+                ready = spool.ready()
+                if not ready:
+                    spool.wait(poll_seconds)
+                for source_path in ready:
+                    try:
+                        outcome, destination = self.process_file(source_path, spool_dir, clean_dir)
+                    except Exception:
+                        # One broken file must not stop the service, it stays in the spool like a failed read
+                        logger.exception('Error processing file %s' % source_path)
+                        outcome, destination = FAILED, None
+                        if self.record is not None:
+                            self.record.finish(outcome)
+                    # Every file is committed on its own, its source is deleted once it is done
+                    self.audit.flush()
+                    if self.audit_log is not None:
+                        self.audit_log.flush()
+                    latency = time.time() - spool.arrived(source_path)
+                    spool.done(source_path, outcome == FAILED)
+                    logger.info('%s %s %.3f seconds after it arrived, %d files waiting' %
+                                (source_path, outcome, latency, spool.queued()))
+                    if self.record is not None:
+                        self.record.latency = latency
+                        self.record.queued = spool.queued()
+                    self.file_done(source_path, spool_dir, outcome, destination, self.record)
+                    # Moved already when quarantined with --quarantine_mode move
+                    if outcome != FAILED and os.path.exists(source_path):
+                        os.remove(source_path)
+                    if stop.is_set():
+                        break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            spool.close()
+            self.close_all()
+
+    # Streams the files of a tar or zip source through anonymization one at a time, without unpacking it.
+    # The source, clean_dir and the quarantine can each be an archive or a directory, archives get the
+    # same layout destination gives directories. Only serial runs are supported.
+    def run_archive(self, ident_dir, clean_dir):
+        if self.workers > 1 or self.group_by is not None or self.read_threads > 0 or self.write_threads > 0 or \
+                self.manifest is not None or self.duplicates != 'process':
+            raise Exception('Archives cannot be used with workers, group_by, read or write threads, a manifest or '
+                            'duplicate detection')
+        for hook in self.hooks:
+            hook.run_started()
+        self.date_adjust = None
+        self.quarantined = dict()
+        if self.catalog_file is not None or self.relative_dates is not None:
+            if is_archive(ident_dir):
+                self.load_catalog(self.build_archive_catalog(ident_dir))
+            else:
+                self.load_catalog(self.build_catalog(ident_dir))
+        clean_sink = ArchiveWriter(clean_dir) if is_archive(clean_dir) else None
+        quarantine_sink = ArchiveWriter(self.quarantine) if is_archive(self.quarantine) else None
+        try:
+            for name, data in self.members(ident_dir):
+                source_path = os.path.join(ident_dir, name)
+                outcome, destination = self.process_member(source_path, data, ident_dir, clean_dir, clean_sink,
+                                                           quarantine_sink, self.quarantined.get(name))
+                self.file_done(source_path, ident_dir, outcome, destination, self.record)
+                if outcome == FAILED:
+                    return False
+            return True
+        finally:
+            for sink in [clean_sink, quarantine_sink]:
+                if sink is not None:
+                    sink.close()
+            self.close_all()
+
+    # Yields (name relative to ident_dir, data) for the files of an archive or a directory,
+    # data is None for files that cannot be read
+    @staticmethod
+    def members(ident_dir):
+        if is_archive(ident_dir):
+            for name, _, data in ArchiveReader(ident_dir).members():
+                yield name, data
+        else:
+            for source_path in DicomAnon.walk(ident_dir):
                 try:
-                    ds.save_as(clean_name)
+                    with open(source_path, 'rb') as handle:
+                        data = handle.read()
                 except IOError:
-                    logger.error('Error writing file %s' % clean_name)
-                    self.close_all()
-                    return False
-
+                    data = None
+                yield os.path.relpath(source_path, ident_dir), data
+
+    # process_file for a file that is already in memory. Output goes to the archives given as sinks,
+    # or to the clean and quarantine directories for sinks that are None.
+    def process_member(self, source_path, data, ident_dir, clean_dir, clean_sink, quarantine_sink, reason=None):
+        if self.timing:
+            self.record = FileRecord(source_path)
+            self.record.bytes = len(data or b'')
+        if data is None:
+            logger.error('Error reading file %s' % source_path)
+            outcome, destination = FAILED, None
+        else:
+            ds = None
+            if reason is None:
+                try:
+                    ds = self.read_dataset(source_path, self.record, data)
+                except InvalidDicomError:  # DICOM formatting error
+                    reason = 'Could not read DICOM file.'
+            outcome, output = self.transform(ds, source_path, ident_dir, clean_dir, reason, self.record)
+            outcome, destination = self.write_member(source_path, data, ident_dir, clean_dir, outcome, output,
+                                                     clean_sink, quarantine_sink)
+        if self.timing:
+            self.record.finish(outcome)
+        return outcome, destination
+
+    def write_member(self, source_path, data, ident_dir, clean_dir, outcome, output, clean_sink, quarantine_sink):
+        if outcome == QUARANTINED:
+            quarantine_name = os.path.join(self.destination(source_path, self.quarantine, ident_dir),
+                                           os.path.basename(source_path))
+            logger.info('%s will be moved to quarantine due to: %s' % (source_path, output))
+            if quarantine_sink is not None:
+                destination = quarantine_sink.add(os.path.relpath(quarantine_name, self.quarantine), data)
+            else:
+                if not os.path.exists(os.path.dirname(quarantine_name)):
+                    self.make_dirs(os.path.dirname(quarantine_name))
+                with open(quarantine_name, 'wb') as handle:
+                    handle.write(data)
+                destination = quarantine_name
+            if self.record is not None:
+                self.record.lap('quarantine')
+                self.record.bytes_out = len(data)
+            return QUARANTINED, destination
+        if clean_sink is None:
+            return self.write_output(source_path, ident_dir, outcome, output, self.record)
+        ds, clean_name = output
+        cleaned = self.encoded(ds, self.record)
+        if cleaned is None:
+            buffer = BytesIO()
+            ds.save_as(buffer)
+            cleaned = buffer.getvalue()
+        destination = clean_sink.add(os.path.relpath(clean_name, clean_dir), cleaned)
+        if self.record is not None:
+            self.record.lap('save')
+            self.record.bytes_out = len(cleaned)
+        return CLEANED, destination
+
+    def pipeline_reader(self, pending_files):
+        while True:
+            pending = pending_files.get()
+            if pending is None:
+                return
+            try:
+                # The whole file is read here, values left deferred would be read from the file again on the
+                # anonymizer thread, and the budget counts the file as held in memory
+                with open(pending.source_path, 'rb') as handle:
+                    data = handle.read()
+                pending.ds = self.read_dataset(pending.source_path, pending.record, data)
+            except (IOError, InvalidDicomError) as e:
+                pending.read_error = e
+            except Exception as e:
+                pending.exception = e
+            pending.read.set()
+
+    def pipeline_writer(self, outputs, written, budget):
+        while True:
+            job = outputs.get()
+            if job is None:
+                return
+            pending, outcome, output = job
+            if pending.record is not None:
+                pending.record.last = time.time()
+            try:
+                pending.outcome, pending.destination = self.write_output(pending.source_path, pending.ident_dir,
+                                                                         outcome, output, pending.record)
+            except Exception as e:
+                pending.exception = e
+                pending.outcome = FAILED
+            if pending.record is not None:
+                pending.record.finish(pending.outcome)
+            budget.release(pending.size)
+            written.put(pending)
+
+    # Runs the reads and writes of a serial run on threads, so slow storage is read and written while the
+    # main thread anonymizes. Files are anonymized in input order, so the results match a plain serial run.
+    # Up to queue_depth files, and queue_memory megabytes of them, are read ahead.
+    def run_pipeline(self, ident_dir, clean_dir):
+        pending_files = Queue.Queue()
+        outputs = Queue.Queue(max(self.queue_depth, 1))
+        written = Queue.Queue()
+        budget = ByteBudget(self.queue_memory * 1024 * 1024)
+        threads = [threading.Thread(target=self.pipeline_reader, args=(pending_files,))
+                   for _ in range(max(self.read_threads, 1))]
+        threads += [threading.Thread(target=self.pipeline_writer, args=(outputs, written, budget))
+                    for _ in range(max(self.write_threads, 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        inputs = self.inputs(ident_dir, clean_dir)
+        waiting = None
+        read_ahead = deque()
+        failed = False
+        error = None
+        try:
+            while not failed:
+                # Keep the readers busy, only waiting for memory when there is nothing else to do
+                while len(read_ahead) < max(self.queue_depth, 1):
+                    if waiting is None:
+                        source_path = next(inputs, None)
+                        if source_path is None:
+                            break
+                        waiting = PendingFile(source_path, ident_dir,
+                                              self.quarantined.get(os.path.relpath(source_path, ident_dir)),
+                                              FileRecord(source_path) if self.timing else None)
+                    if not budget.acquire(waiting.size, block=not read_ahead):
+                        break
+                    read_ahead.append(waiting)
+                    if waiting.reason is None:
+                        pending_files.put(waiting)
+                    else:
+                        waiting.read.set()
+                    waiting = None
+                if not read_ahead:
+                    break
+
+                pending = read_ahead.popleft()
+                pending.read.wait()
+                if pending.exception is not None:
+                    raise pending.exception
+                reason = pending.reason
+                if isinstance(pending.read_error, IOError):
+                    logger.error('Error reading file %s' % pending.source_path)
+                    budget.release(pending.size)
+                    failed = True
+                    break
+                elif pending.read_error is not None:
+                    reason = 'Could not read DICOM file.'
+                self.record = pending.record
+                if self.record is not None:
+                    self.record.last = time.time()
+                outcome, output = self.transform(pending.ds, pending.source_path, ident_dir, clean_dir, reason,
+                                                 self.record)
+                pending.ds = None
+                outputs.put((pending, outcome, output))
+                failed = self.pipeline_done(written, ident_dir)
+        except Exception as e:
+            error = e
+        finally:
+            for pending in read_ahead:
+                pending.read.wait()
+            for _ in range(max(self.read_threads, 1)):
+                pending_files.put(None)
+            for _ in range(max(self.write_threads, 1)):
+                outputs.put(None)
+            for thread in threads:
+                thread.join()
+            failed = self.pipeline_done(written, ident_dir) or failed
+            self.close_all()
+        if error is not None:
+            raise error
+        return not failed
+
+    # Hands the files the writers have finished to file_done, returns True if one of them failed
+    def pipeline_done(self, written, ident_dir):
+        failed = False
+        while True:
+            try:
+                pending = written.get_nowait()
+            except Queue.Empty:
+                return failed
+            if pending.exception is not None:
+                raise pending.exception
+            self.file_done(pending.source_path, ident_dir, pending.outcome, pending.destination, pending.record)
+            failed = failed or pending.outcome == FAILED
+
+    # Hands the audit database to a single AuditService process and starts the worker pool,
+    # every worker talks to the service so there is still only one writer
+    def start_workers(self):
+        self.audit.close()
+        manager = AuditManager()
+        manager.start()
+        service = manager.AuditService(self.audit_file, self.audit_cache_size, self.audit_batch_files,
+                                       self.audit_batch_seconds, self.audit_backend, self.audit_shards)
+        self.audit = AuditClient(service)
+        lock = multiprocessing.RLock()
+        # Workers queue their mappings for the audit log thread of this process
+        if self.pseudonymizer is not None:
+            self.stop_audit_log()
+            self.start_audit_log(multiprocessing.JoinableQueue(AUDIT_LOG_QUEUE_SIZE))
+        pool = multiprocessing.Pool(self.workers, _init_worker,
+                                    (self.options, service, lock, self.date_adjust, self.timing, self.audit_log_queue))
+        return manager, pool
+
+    def stop_workers(self, manager, pool, completed):
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
         self.close_all()
-        return True
+        manager.shutdown()
+
+    # Spreads files over a pool of worker processes
+    def run_parallel(self, ident_dir, clean_dir):
+        manager, pool = self.start_workers()
+        completed = False
+        try:
+            jobs = ((source_path, ident_dir, clean_dir, self.quarantined.get(os.path.relpath(source_path, ident_dir)))
+                    for source_path in self.inputs(ident_dir, clean_dir))
+            for source_path, outcome, destination, record in pool.imap_unordered(_process_file, jobs,
+                                                                                 chunksize=16):
+                self.file_done(source_path, ident_dir, outcome, destination, record)
+                if outcome == FAILED:
+                    break
+            else:
+                completed = True
+        finally:
+            self.stop_workers(manager, pool, completed)
+        return completed
+
+    # Splits the input files into studies, or into patients with their studies one after the other.
+    # Returns lists of (source_path, known quarantine reason), files that could not be read on their own.
+    def groups(self, ident_dir, studies, clean_dir=None):
+        units = dict()
+        for source_path in self.inputs(ident_dir, clean_dir):
+            key = os.path.relpath(source_path, ident_dir)
+            patient_id, study_uid = studies.get(key, (None, None))
+            if study_uid is None:
+                unit = ('file', key)
+            elif self.group_by == 'patient':
+                unit = ('patient', patient_id or '')
+            else:
+                unit = ('study', study_uid)
+            units.setdefault(unit, []).append((study_uid or '', source_path, self.quarantined.get(key)))
+        return [[(source_path, reason) for _, source_path, reason in sorted(units[unit])] for unit in sorted(units)]
+
+    # Cleans the files of one study or patient in order. A file that fails, or an unexpected error,
+    # stops the rest of the group but not the run. Returns (source_path, outcome, destination, record)
+    # for every file that was tried.
+    def process_group(self, files, ident_dir, clean_dir):
+        results = []
+        for source_path, reason in files:
+            self.record = None
+            try:
+                outcome, destination = self.process_file(source_path, ident_dir, clean_dir, reason)
+            except Exception as e:
+                logger.error('Error cleaning %s: %s' % (source_path, e))
+                outcome, destination = FAILED, None
+            results.append((source_path, outcome, destination, self.record))
+            if outcome == FAILED:
+                logger.error('Skipping the other %d files of the group of %s' % (len(files) - len(results),
+                                                                                 source_path))
+                break
+        return results
+
+    # Processes one study or patient at a time, in parallel with --workers, and commits the audit rows
+    # of each group together. Groups that fail leave the others alone, run then returns False.
+    def run_groups(self, ident_dir, clean_dir, groups):
+        manager = pool = None
+        failed = 0
+        completed = False
+        try:
+            jobs = ((files, ident_dir, clean_dir) for files in groups)
+            if self.workers > 1:
+                manager, pool = self.start_workers()
+                results = pool.imap_unordered(_process_group, jobs)
+            else:
+                results = (self.process_group(*job) for job in jobs)
+            for group in results:
+                for source_path, outcome, destination, record in group:
+                    self.file_done(source_path, ident_dir, outcome, destination, record)
+                self.audit.flush()
+                if self.manifest is not None:
+                    self.manifest.flush()
+                if group[-1][1] == FAILED:
+                    failed += 1
+            completed = True
+        finally:
+            if pool is not None:
+                self.stop_workers(manager, pool, completed)
+            else:
+                self.close_all()
+        if failed:
+            logger.error('%d %s groups failed' % (failed, self.group_by))
+        return failed == 0
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument(dest='ident_dir', type=str)
-    parser.add_argument(dest='clean_dir', type=str)
+    parser.add_argument(dest='ident_dir', type=str, nargs='?')
+    parser.add_argument(dest='clean_dir', type=str, nargs='?')
     parser.add_argument('-q', '--quarantine', type=str, default='quarantine', help='Quarantine directory')
     parser.add_argument('-w', '--white_list', type=str, default=None, help='White list json file')
     parser.add_argument('-a', '--audit_file', type=str, default='identity.db', help='Name of sqlite audit file')
@@ -680,12 +3831,200 @@ if __name__ == '__main__':
                         help='Specification file that describes the anonymization strategy.')
     parser.add_argument('-e', '--relative_dates', type=str, nargs=2, action='append', default=None,
                         help='Dicom tags for date fields that should be made relative, rather than replaced.')
+    parser.add_argument('--date_offsets', type=str, default='global', choices=DATE_OFFSET_SCOPES,
+                        help='How relative dates are shifted. global (the default) moves the first date of each '
+                             'tag over all files to 19700101. patient and study give every patient or study one '
+                             'offset for all relative date tags, moving its first date to 19700101, and keep the '
+                             'offsets in the audit file so later runs shift the same patient or study alike.')
+    parser.add_argument('--audit_cache_size', type=int, default=10000,
+                        help='Number of audit lookups to keep in memory. 0 turns the cache and write batching off. '
+                             'The sharded backend is never cached.')
+    parser.add_argument('--audit_batch_files', type=int, default=100,
+                        help='Commit new audit rows after this many files. Defaults to 100')
+    parser.add_argument('--audit_batch_seconds', type=float, default=5.0,
+                        help='Commit new audit rows at least this often, in seconds. Defaults to 5')
+    parser.add_argument('--audit_backend', type=str, default='sqlite', choices=['sqlite', 'memory', 'sharded'],
+                        help='Where the audit trail is kept. "sqlite" (the default) uses the --audit_file, "memory" '
+                             'keeps nothing after the run and "sharded" splits it by study over --audit_shards '
+                             'files named after the audit file (identity.0.db, identity.1.db, ...).')
+    parser.add_argument('--audit_shards', type=int, default=4,
+                        help='Number of shard files of a sharded audit trail. Defaults to 4')
+    parser.add_argument('--merge_audit', type=str, default=None,
+                        help='Combine the --audit_shards shards of the sharded --audit_file into this new audit '
+                             'file, then exit.')
+    parser.add_argument('--quarantine_mode', type=str, default='copy', choices=['copy', 'hardlink', 'reflink', 'move'],
+                        help='How files get into quarantine. "copy" (the default) copies them, "hardlink" and '
+                             '"reflink" share the data with the source file where the file system allows it and '
+                             'copy otherwise, "move" takes them out of the source directory.')
+    parser.add_argument('--quarantine_index', type=str, default=None,
+                        help='sqlite file listing every quarantined file with its destination, reason and a '
+                             'summary of its header (modality, manufacturer, series description, size, UIDs)')
+    parser.add_argument('--quarantine_rules', type=str, default=None,
+                        help='JSON file with the quarantine rules to use instead of the built in ones')
+    parser.add_argument('--defer_size', type=int, default=64 * 1024,
+                        help='Values larger than this many bytes are only read from disk when needed. '
+                             'Defaults to 65536')
+    parser.add_argument('--engine', type=str, choices=ENGINES, default='dataset',
+                        help='dataset reads every element of a cleaned file and writes it back out. stream leaves '
+                             'values larger than --defer_size that are deleted or kept unchanged, pixel data above '
+                             'all, in the source file: deleted ones are never read and the pixel data is copied '
+                             'into the cleaned file in 1 MB chunks. Defaults to dataset')
+    parser.add_argument('--output_syntax', type=str, choices=OUTPUT_SYNTAXES, default='keep',
+                        help='keep writes cleaned files in the transfer syntax they came in. deflate writes files '
+                             'that came in a native little endian syntax as Deflated Explicit VR Little Endian, rle '
+                             'compresses their pixel data losslessly as RLE Lossless when it has one sample per pixel '
+                             'of 8, 16 or 32 bits. Other files keep their transfer syntax. Files are encoded where '
+                             'they are saved, in the workers with --workers. Defaults to keep')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='sqlite file recording which input files have been processed. Files that are '
+                             'unchanged since they were recorded are skipped, so an interrupted or incremental run '
+                             'only processes what is left or new.')
+    parser.add_argument('--manifest_hash', action='store_true', default=False,
+                        help='Also record a SHA-1 of each input, so files whose modification time changed but whose '
+                             'content did not are still skipped.')
+    parser.add_argument('--duplicates', type=str, default='process', choices=DUPLICATE_MODES,
+                        help='What to do with further copies of an input file, the same SOP Instance UID with the '
+                             'same size and first and last 16 KB. "process" (the default) cleans every copy, "skip" '
+                             'cleans only the first and "link" also hard links each copy to the first copy\'s '
+                             'cleaned file when the run ends. Only the header of a copy is read.')
+    parser.add_argument('--duplicate_index', type=str, default=None,
+                        help='sqlite file keeping the first copies seen by --duplicates, so copies are also found '
+                             'in later runs. Kept in memory for one run without this option.')
+    parser.add_argument('-u', '--uid_scheme', type=str, default='counter', choices=['counter', 'uuid'],
+                        help='How new UIDs are made. "counter" (the default) numbers them under the org root, '
+                             'reserving blocks of numbers in the audit file. "uuid" uses 2.25.<random UUID>.')
+    parser.add_argument('--pseudonym_key', type=str, default=None,
+                        help='File holding a secret key of at least 16 bytes. UIDs and audited values are then '
+                             'derived from the original values with an HMAC of this key instead of looked up in the '
+                             'audit file, so the same key always gives the same cleaned values. The audit file '
+                             'becomes a log written in the background, --audit_backend memory turns it off. Start '
+                             'a new audit file for keyed runs.')
+    parser.add_argument('--catalog', type=str, default=None,
+                        help='Keep a catalog of header fields (study, patient, modality, dates, quarantine decision) '
+                             'in this sqlite file. Headers are read in one pre-scan, in parallel with --workers, '
+                             'and only files that changed since are read again when the catalog is reused. '
+                             'Relative dates always use a pre-scan, in memory without this option.')
+    parser.add_argument('--group_by', type=str, default=None, choices=['study', 'patient'],
+                        help='Process the files one study, or one patient, at a time instead of in directory '
+                             'order. The studies are found by a header-only pre-scan, see --catalog. Each group '
+                             'goes to one worker and its audit rows are committed together. A group that fails '
+                             'is skipped and the run goes on with the other groups.')
+    parser.add_argument('--read_threads', type=int, default=0,
+                        help='Read files ahead on this many threads while the main thread anonymizes, useful on '
+                             'network storage. Only used without --workers and --group_by.')
+    parser.add_argument('--write_threads', type=int, default=None,
+                        help='Write cleaned and quarantined files on this many threads, defaults to --read_threads')
+    parser.add_argument('--queue_depth', type=int, default=16,
+                        help='How many files the reader and writer threads may run ahead of the main thread')
+    parser.add_argument('--queue_memory', type=int, default=256,
+                        help='How many megabytes of files the reader and writer threads may hold at once')
+    parser.add_argument('--stats', type=str, default=None,
+                        help='Write the wall time of each processing stage (read, quarantine, relative_dates, '
+                             'anonymize, save) to this file, in total, per modality and per audit hit or miss as '
+                             'JSON, or one row per file if the name ends in .csv')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Service mode: keep running and anonymize files as they arrive in ident_dir, which is '
+                             'used as a spool. Files are deleted from the spool once they are cleaned or '
+                             'quarantined. Stop with Ctrl-C or SIGTERM.')
+    parser.add_argument('--poll_seconds', type=float, default=1.0,
+                        help='How often the spool is checked for new files with --watch. Defaults to 1')
+    parser.add_argument('--settle_seconds', type=float, default=5.0,
+                        help='A spooled file is complete once it has not changed for this many seconds, or as soon '
+                             'as it is closed when pyinotify is installed. Defaults to 5')
+    parser.add_argument('--status', type=str, default=None,
+                        help='With --watch, keep the number of waiting files, the outcomes and the latency from '
+                             'arrival to output in this JSON file, rewritten after every file')
+    parser.add_argument('--progress', type=float, default=None,
+                        help='Log the files done, files and MB per second, the share quarantined and the time left '
+                             'every this many seconds. The input files are counted first, on a separate thread.')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Keep the progress numbers, files by outcome, bytes read and written and audit hits and '
+                             'misses in this file in the Prometheus text format, rewritten with every --progress '
+                             'report (every 30 seconds by default), for the textfile collector of a node exporter')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of worker processes to spread files over. Defaults to 1 (no parallelism)')
+    parser.add_argument('--migrate_audit', action='store_true', default=False,
+                        help='Convert the audit file given by --audit_file from the one table per tag layout of '
+                             'earlier versions to the current schema, then exit.')
+    parser.add_argument('--dump_plan', type=str, default=None,
+                        help='Write what will be done to each tag, as compiled from the spec file, white list and '
+                             'options, to this JSON file, then exit.')
+    parser.add_argument('--scan', type=str, default=None,
+                        help='Dry run: read only the headers in ident_dir and write what a run would do, the '
+                             'outcomes, quarantine reasons, new audit rows and white list checks, to this JSON '
+                             'file, then exit. Nothing is written to clean_dir, the quarantine or the audit file.')
+    parser.add_argument('--lookup', type=str, default=None,
+                        help='Re-identify: write every audit row whose cleaned value is listed, one per line, in '
+                             'this file as CSV to standard output, then exit. See --lookup_original.')
+    parser.add_argument('--export_studies', type=str, default=None,
+                        help='Write every audit row of the studies whose cleaned Study Instance UIDs are listed, '
+                             'one per line, in this file as CSV to standard output, then exit. See '
+                             '--lookup_original.')
+    parser.add_argument('--lookup_original', action='store_true', default=False,
+                        help='Match the values given to --lookup or --export_studies against the original '
+                             'instead of the cleaned values')
     args = parser.parse_args()
     if args.relative_dates is not None:
         args.relative_dates = [tuple([int(item[0], 16), int(item[1], 16)]) for item in args.relative_dates]
-    i_dir = args.ident_dir
-    c_dir = args.clean_dir
-    del args.ident_dir
-    del args.clean_dir
-    da = DicomAnon(**vars(args))
-    da.run(i_dir, c_dir)
+    if args.migrate_audit:
+        logger.addHandler(logging.StreamHandler())
+        migrate_audit(args.audit_file)
+    elif args.merge_audit:
+        logger.addHandler(logging.StreamHandler())
+        merge_audit(args.merge_audit, shard_files(args.audit_file, args.audit_shards))
+    elif args.lookup or args.export_studies:
+        logger.addHandler(logging.StreamHandler())
+        reader = AuditReader(audit_files(args.audit_file, args.audit_backend, args.audit_shards))
+        if not reader.dbs:
+            parser.error('audit file %s not found' % args.audit_file)
+        column = 'original' if args.lookup_original else 'cleaned'
+        if args.lookup:
+            write_mapping(reader.lookup(read_values(args.lookup), column), sys.stdout)
+        else:
+            write_mapping(reader.export(read_values(args.export_studies), column), sys.stdout)
+        reader.close()
+    elif args.dump_plan:
+        dump_file = args.dump_plan
+        del args.ident_dir, args.clean_dir, args.migrate_audit, args.dump_plan, args.stats, args.watch, \
+            args.poll_seconds, args.settle_seconds, args.status, args.merge_audit, args.quarantine_index, args.scan, \
+            args.lookup, args.export_studies, args.lookup_original, args.progress, args.metrics
+        args.audit_backend = 'memory'
+        with open(dump_file, 'w') as handle:
+            DicomAnon(**vars(args)).dump_plan(handle)
+    elif args.scan:
+        if args.ident_dir is None:
+            parser.error('ident_dir is required')
+        i_dir, report_file = args.ident_dir, args.scan
+        del args.ident_dir, args.clean_dir, args.migrate_audit, args.dump_plan, args.stats, args.watch, \
+            args.poll_seconds, args.settle_seconds, args.status, args.merge_audit, args.quarantine_index, args.scan, \
+            args.lookup, args.export_studies, args.lookup_original, args.progress, args.metrics
+        # The audit file is only read, by the scan itself
+        DicomAnon(audit=MemoryAudit(), **vars(args)).scan(i_dir, report_file)
+    else:
+        if args.ident_dir is None or args.clean_dir is None:
+            parser.error('ident_dir and clean_dir are required')
+        i_dir = args.ident_dir
+        c_dir = args.clean_dir
+        del args.ident_dir
+        del args.clean_dir
+        del args.migrate_audit
+        del args.dump_plan
+        del args.merge_audit
+        del args.scan
+        del args.lookup, args.export_studies, args.lookup_original
+        watch, poll_seconds, settle_seconds = args.watch, args.poll_seconds, args.settle_seconds
+        args.hooks = []
+        if args.status is not None:
+            args.hooks.append(SpoolStatus(args.status))
+        if args.progress is not None or args.metrics is not None:
+            # A spool has no end to count towards and archives are not walked
+            args.hooks.append(Progress(None if watch or is_archive(i_dir) else i_dir, args.metrics,
+                                        args.progress or 30.0))
+        del args.watch, args.poll_seconds, args.settle_seconds, args.status, args.progress, args.metrics
+        da = DicomAnon(**vars(args))
+        if watch:
+            stopped = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+            da.watch(i_dir, c_dir, poll_seconds, settle_seconds, stopped)
+        else:
+            da.run(i_dir, c_dir)
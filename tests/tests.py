@@ -1,13 +1,91 @@
+import json
+import multiprocessing
+import os
+import Queue
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
+from datetime import datetime
+from io import BytesIO
 import dicom
+from dicom.dataelem import DataElement
+from dicom.dataset import Dataset
+from dicom.valuerep import PersonName
 import dicom_anon
 
 
+def allocate_uids(filename):
+    audit = dicom_anon.Audit(filename)
+    allocator = dicom_anon.UIDAllocator('1.2.3', audit, block_size=7)
+    uids = [allocator.generate() for i in range(100)]
+    audit.close()
+    return uids
+
+
+class RecordingHook(dicom_anon.Hook):
+
+    def __init__(self):
+        self.records = []
+
+    def file_done(self, record):
+        self.records.append(record)
+
+
+class StoppingHook(RecordingHook):
+
+    def __init__(self, stop, files):
+        RecordingHook.__init__(self)
+        self.stop = stop
+        self.files = files
+
+    def file_done(self, record):
+        RecordingHook.file_done(self, record)
+        if len(self.records) == self.files:
+            self.stop.set()
+
+
+class NoLookupAudit(dicom_anon.MemoryAudit):
+    def get(self, tag, study_uid_pk=None):
+        raise AssertionError('looked up %s' % tag.name)
+
+
 class TestDICOMAnon(unittest.TestCase):
 
     def setUp(self):
         pass
 
+    # Writes a small Explicit VR Little Endian MR instance to path and returns it. elements are set by keyword
+    # on top of the defaults, add_new holds (tag, VR, value) for elements that need their VR spelled out.
+    @staticmethod
+    def write_dataset(path, add_new=(), **elements):
+        ds = dicom.dataset.FileDataset(path, {}, file_meta=Dataset(), preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.Modality = 'MR'
+        ds.StudyInstanceUID = '1.2.3'
+        ds.SOPInstanceUID = '1.2.3.4'
+        for keyword, value in elements.items():
+            setattr(ds, keyword, value)
+        for tag, vr, value in add_new:
+            ds.add_new(tag, vr, value)
+        ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.ImplementationClassUID = '1.2.3'
+        ds.save_as(path)
+        return ds
+
+    # A temporary directory with a samples directory holding one identified CR instance, like tests/samples
+    def write_samples(self):
+        root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(root, 'samples'))
+        self.write_dataset(os.path.join(root, 'samples', 'test_wrist_cr1.dcm'), Modality='CR', StudyID='1234',
+                           PatientName=PersonName('Identified Patient'), PatientID='PID1',
+                           StudyDescription='WRIST^RIGHT', SeriesDescription='WRIST PA')
+        return root
+
     def test_basic(self):
         ds = dicom.read_file("tests/samples/test_wrist_cr1.dcm")
         self.assertEqual(ds.PatientName, "Identified Patient")
@@ -40,5 +118,691 @@ class TestDICOMAnon(unittest.TestCase):
         # Series Description was not in white list
         self.assertFalse(dicom_anon.SERIES_DESCR in ds)
 
+    def test_workers(self):
+        root = self.write_samples()
+        da = dicom_anon.DicomAnon(quarantine=os.path.join(root, "quarantine"),
+                                  audit_file=os.path.join(root, "identity.db"),
+                                  modalities=["us", "cr", "ct", "mr", "pr"], org_root="1.2.826.0.1.3680043.8.1008",
+                                  white_list="white_list.json", log_file=None, rename=False, profile="basic",
+                                  overlay=False, workers=2)
+        self.assertTrue(da.run(os.path.join(root, "samples"), os.path.join(root, "clean")))
+        ds = dicom.read_file(os.path.join(root, "clean", "test_wrist_cr1.dcm"))
+        self.assertEqual(ds.PatientName, "Patient's Name 1")
+        self.assertEqual(ds.PatientID, "Patient ID 1")
+        self.assertEqual(ds.StudyID, "CLEANED")
+        shutil.rmtree(root)
+
+    def test_pipeline(self):
+        root = self.write_samples()
+        da = dicom_anon.DicomAnon(quarantine=os.path.join(root, "quarantine"),
+                                  audit_file=os.path.join(root, "identity.db"),
+                                  modalities=["us", "cr", "ct", "mr", "pr"], org_root="1.2.826.0.1.3680043.8.1008",
+                                  white_list="white_list.json", log_file=None, rename=False, profile="basic",
+                                  overlay=False, read_threads=2, queue_depth=4)
+        self.assertTrue(da.run(os.path.join(root, "samples"), os.path.join(root, "clean")))
+        ds = dicom.read_file(os.path.join(root, "clean", "test_wrist_cr1.dcm"))
+        self.assertEqual(ds.PatientName, "Patient's Name 1")
+        self.assertEqual(ds.PatientID, "Patient ID 1")
+        self.assertEqual(ds.StudyID, "CLEANED")
+        shutil.rmtree(root)
+
+    def test_pipeline_reader(self):
+        root = self.write_samples()
+        da = dicom_anon.DicomAnon(quarantine=os.path.join(root, "quarantine"),
+                                  audit_file=os.path.join(root, "identity.db"), white_list="white_list.json",
+                                  log_file=None, defer_size=4)
+        pending = dicom_anon.PendingFile(os.path.join(root, "samples", "test_wrist_cr1.dcm"), root, None, None)
+        pending_files = Queue.Queue()
+        pending_files.put(pending)
+        pending_files.put(None)
+        da.pipeline_reader(pending_files)
+        da.close_all()
+        # Nothing is left deferred for the anonymizer thread to read from storage
+        self.assertEqual(pending.ds.StudyDescription, "WRIST^RIGHT")
+        self.assertFalse(any(dicom_anon.is_deferred(dict.__getitem__(pending.ds, tag)) for tag in pending.ds.keys()))
+        shutil.rmtree(root)
+
+    def test_byte_budget(self):
+        budget = dicom_anon.ByteBudget(100)
+        self.assertTrue(budget.acquire(60))
+        self.assertFalse(budget.acquire(60, block=False))
+        budget.release(60)
+        # A file bigger than the whole budget still gets through on its own
+        self.assertTrue(budget.acquire(500, block=False))
+        self.assertFalse(budget.acquire(1, block=False))
+
+    def test_cached_audit(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        os.remove(filename)
+        audit = dicom_anon.CachedAudit(dicom_anon.Audit(filename), size=2, batch_files=2, batch_seconds=60)
+        patient_id = DataElement((0x10, 0x20), 'LO', 'PID1')
+        self.assertEqual(audit.get_next_pk(patient_id), 1)
+        audit.save(patient_id, 'Patient ID 1', study_uid_pk=1)
+        self.assertEqual(audit.get(patient_id, study_uid_pk=1), 'Patient ID 1')
+        self.assertEqual(audit.get_next_pk(patient_id), 2)
+        # Buffered until the second file is done
+        self.assertIsNone(audit.audit.get(patient_id, study_uid_pk=1))
+        self.assertFalse(audit.checkpoint())
+        self.assertTrue(audit.checkpoint())
+        self.assertEqual(audit.audit.get(patient_id, study_uid_pk=1), 'Patient ID 1')
+        audit.close()
+        os.remove(filename)
+
+    def check_backend(self, audit, uids=('1.2.0', '1.2.1', '1.2.2', '1.2.3')):
+        study_uids = [DataElement((0x20, 0xD), 'UI', uid) for uid in uids]
+        patient_id = DataElement((0x10, 0x20), 'LO', 'PID1')
+        study_pks = []
+        for number, study_uid in enumerate(study_uids):
+            self.assertIsNone(audit.get(study_uid))
+            audit.save(study_uid, '5.555.5.%d' % number)
+            self.assertEqual(audit.get(study_uid), '5.555.5.%d' % number)
+            study_pks.append(audit.get_study_pk('5.555.5.%d' % number))
+            audit.save(patient_id, 'Patient ID %d' % audit.get_next_pk(patient_id, study_pks[-1]),
+                       study_uid_pk=study_pks[-1])
+        self.assertEqual(len(set(study_pks)), 4)
+        cleaned = [audit.get(patient_id, study_uid_pk=study_pk) for study_pk in study_pks]
+        self.assertEqual(len(set(cleaned)), 4)
+        audit.update(DataElement((0x10, 0x20), 'LO', str(cleaned[0])), 'Patient ID 0', study_pks[0])
+        self.assertEqual(audit.get(patient_id, study_uid_pk=study_pks[0]), 'Patient ID 0')
+        self.assertEqual(audit.get(patient_id, study_uid_pk=study_pks[1]), cleaned[1])
+        return cleaned
+
+    def test_memory_audit(self):
+        audit = dicom_anon.MemoryAudit()
+        self.assertEqual(self.check_backend(audit), ['Patient ID 1', 'Patient ID 2', 'Patient ID 3', 'Patient ID 4'])
+        self.assertEqual(audit.reserve_uids(10)[1], 1)
+        self.assertEqual(audit.reserve_uids(10)[1], 11)
+        # A backend that leaves out part of the interface fails when it is created, not halfway through a run
+        self.assertRaises(TypeError, type('PartialAudit', (dicom_anon.AuditBackend,), {'get': lambda *args: None}))
+
+    def test_sharded_audit(self):
+        root = tempfile.mkdtemp()
+        filename = os.path.join(root, 'identity.db')
+        shards = dicom_anon.shard_files(filename, 3)
+        self.assertEqual(shards[1], os.path.join(root, 'identity.1.db'))
+        audit = dicom_anon.open_audit(filename, cache_size=10, backend='sharded', shards=3)
+        # Two studies share shard 0, the others are in shards 1 and 2
+        uids = ['1.2.3', '1.2.4', '1.2.5', '1.2.7']
+        self.assertEqual(len(set(audit.shard_of(uid) for uid in uids)), 3)
+        cleaned = self.check_backend(audit, uids)
+        # Numbers are interleaved by shard, the second study of shard 0 skips what shards 1 and 2 hand out
+        self.assertEqual(cleaned, ['Patient ID 2', 'Patient ID 1', 'Patient ID 3', 'Patient ID 4'])
+        # Workers share the backend, so the lookups of two studies interleave
+        patient_id = DataElement((0x10, 0x20), 'LO', 'PID2')
+        study_pks = []
+        for uid in ['1.2.8', '1.2.10']:
+            audit.save(DataElement((0x20, 0xD), 'UI', uid), '5.555.6.%s' % uid)
+            study_pks.append(audit.get_study_pk('5.555.6.%s' % uid))
+        first = 'Patient ID %d' % audit.get_next_pk(patient_id, study_pks[0])
+        audit.save(patient_id, first, study_uid_pk=study_pks[0])
+        self.assertNotEqual('Patient ID %d' % audit.get_next_pk(patient_id, study_pks[1]), first)
+        # Another node on the same files sees those rows right away and never repeats a number
+        node = dicom_anon.open_audit(filename, cache_size=10, backend='sharded', shards=3)
+        self.assertEqual(node.get(patient_id, study_uid_pk=study_pks[0]), first)
+        self.assertNotEqual(node.get_next_pk(patient_id, study_pks[0]), audit.get_next_pk(patient_id, study_pks[0]))
+        # The row saved first stays
+        node.save(patient_id, 'Patient ID 99', study_uid_pk=study_pks[0])
+        self.assertEqual(audit.get(patient_id, study_uid_pk=study_pks[0]), first)
+        node.close()
+        audit.close()
+        merged = os.path.join(root, 'merged.db')
+        contents = [open(shard, 'rb').read() for shard in shards]
+        dicom_anon.merge_audit(merged, shards)
+        # The shards are only read
+        self.assertEqual([open(shard, 'rb').read() for shard in shards], contents)
+        audit = dicom_anon.Audit(merged)
+        patient_id = DataElement((0x10, 0x20), 'LO', 'PID1')
+        for number, uid in enumerate(uids):
+            study_pk = audit.get_study_pk(audit.get(DataElement((0x20, 0xD), 'UI', uid)))
+            self.assertEqual(audit.get(patient_id, study_uid_pk=study_pk),
+                             cleaned[number] if number else 'Patient ID 0')
+        # Numbering carries on past everything the shards handed out
+        used = [int(value.split()[-1]) for value in cleaned]
+        self.assertGreater(audit.get_next_pk(patient_id), max(used))
+        audit.close()
+        self.assertRaises(Exception, dicom_anon.merge_audit, merged, shards)
+        for name in os.listdir(root):
+            os.remove(os.path.join(root, name))
+        os.rmdir(root)
+
+    def test_audit_lookup(self):
+        root = tempfile.mkdtemp()
+        filename = os.path.join(root, 'identity.db')
+        audit = dicom_anon.Audit(filename)
+        audit.save_many([((0x20, 0xD), '1.2.1', '5.5.1', None), ((0x20, 0xD), '1.2.2', '5.5.2', None)])
+        first, second = audit.get_study_pk('5.5.1'), audit.get_study_pk('5.5.2')
+        audit.save_many([((0x10, 0x20), 'PID1', 'Patient ID 1', first), ((0x10, 0x20), 'PID1', 'Patient ID 2', second),
+                         ((0x8, 0x18), '1.2.1.1', '5.5.1.1', first)])
+        audit.save_date_offsets('patient', {'PID1': 10})
+        audit.save_date_offsets('patient', {'PID1': 20, 'PID2': 30})
+        self.assertEqual(audit.get_date_offsets('patient'), {'PID1': 10, 'PID2': 30})
+        self.assertEqual(audit.get_date_offsets('study'), {})
+        audit.close()
+        reader = dicom_anon.AuditReader([filename, os.path.join(root, 'missing.db')])
+        self.assertEqual(list(reader.lookup(['Patient ID 2', 'unknown'], batch=1)),
+                         [(0x10, 0x20, 'PID1', 'Patient ID 2', '1.2.2', '5.5.2')])
+        self.assertEqual(sorted(row[3] for row in reader.lookup(['PID1'], 'original')),
+                         ['Patient ID 1', 'Patient ID 2'])
+        self.assertEqual(list(reader.export(['1.2.1'], 'original')),
+                         [(0x20, 0xD, '1.2.1', '5.5.1', None, None),
+                          (0x10, 0x20, 'PID1', 'Patient ID 1', '1.2.1', '5.5.1'),
+                          (0x8, 0x18, '1.2.1.1', '5.5.1.1', '1.2.1', '5.5.1')])
+        handle = BytesIO()
+        dicom_anon.write_mapping(reader.export(['5.5.2']), handle)
+        self.assertEqual(handle.getvalue().splitlines()[-1], b'"0010,0020",Patient ID,PID1,Patient ID 2,1.2.2,5.5.2')
+        reader.close()
+        for name in os.listdir(root):
+            os.remove(os.path.join(root, name))
+        os.rmdir(root)
+
+    def test_white_list(self):
+        white_list = dicom_anon.DicomAnon.convert_json_white_list({'0008,1030': [
+            'WRIST- MIN 3V UNILAT', {'prefix': 'CT Head'}, {'regex': 'MRI BRAIN( W/?O)?'}]})
+        matcher = white_list[(0x8, 0x1030)]
+        self.assertTrue(matcher.matches(' Wrist  MIN 3V, UNILAT'))
+        self.assertTrue(matcher.matches('CT HEAD W/O'))
+        self.assertFalse(matcher.matches('CT HEA'))
+        self.assertTrue(matcher.matches('mri brain w/o'))
+        # Regular expressions match the whole value
+        self.assertFalse(matcher.matches('MRI BRAIN WITH'))
+        self.assertEqual(matcher.memo['CT HEAD W/O'], True)
+        self.assertRaises(Exception, dicom_anon.WhiteListMatcher, [{'exact': 'CT'}])
+        self.assertRaises(Exception, dicom_anon.WhiteListMatcher, [{'regex': 'CT ('}])
+
+    def test_migrate_audit(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        db = sqlite3.connect(filename)
+        with db:
+            db.execute(dicom_anon.LEGACY_CREATE_NON_LINKED_TABLE % 'studyinstanceuid')
+            db.execute(dicom_anon.LEGACY_CREATE_LINKED_TABLE % 'patientid')
+            db.execute('INSERT INTO studyinstanceuid (original, cleaned) VALUES (?, ?)', ('1.2.3', '5.555.5.1'))
+            db.execute('INSERT INTO patientid (original, cleaned, study) VALUES (?, ?, ?)', ('PID1', 'Patient ID 1', 1))
+        db.close()
+        self.assertRaises(Exception, dicom_anon.Audit, filename)
+        dicom_anon.migrate_audit(filename)
+        audit = dicom_anon.Audit(filename)
+        study_pk = audit.get_study_pk('5.555.5.1')
+        self.assertEqual(audit.get(DataElement((0x10, 0x20), 'LO', 'PID1'), study_uid_pk=study_pk), 'Patient ID 1')
+        self.assertEqual(audit.get_next_pk(DataElement((0x10, 0x20), 'LO', 'PID2')), 2)
+        audit.close()
+        os.remove(filename)
+
+    def test_quarantine_rules(self):
+        da = dicom_anon.DicomAnon(audit_file=":memory:", modalities=["mr"], log_file=None)
+        ds = Dataset()
+        self.assertEqual(da.check_quarantine(ds), (True, 'Modality missing'))
+        ds.Modality = 'MR'
+        self.assertEqual(da.check_quarantine(ds), (False, ''))
+        ds.Manufacturer = 'PACSGEAR'
+        ds.BurnedInAnnotation = 'YES'
+        # Rules are applied in order, burnt-in comes before the manufacturer check
+        self.assertEqual(da.check_quarantine(ds), (True, 'burnt-in data'))
+        ds.Modality = 'US'
+        self.assertEqual(da.check_quarantine(ds), (True, 'modality not allowed'))
+
+    def test_quarantine_modes(self):
+        ident_dir = tempfile.mkdtemp()
+        quarantine = tempfile.mkdtemp()
+        source = os.path.join(ident_dir, 'a.dcm')
+        for mode in ['copy', 'hardlink', 'reflink', 'move']:
+            with open(source, 'w') as handle:
+                handle.write(mode)
+            da = dicom_anon.DicomAnon(audit_file=':memory:', log_file=None, quarantine=quarantine, quarantine_mode=mode)
+            target = da.quarantine_file(source, ident_dir, 'testing')
+            with open(target) as handle:
+                self.assertEqual(handle.read(), mode)
+            self.assertEqual(os.stat(target).st_nlink, 2 if mode == 'hardlink' else 1)
+            self.assertEqual(os.path.exists(source), mode != 'move')
+        self.assertRaises(Exception, dicom_anon.DicomAnon, audit_file=':memory:', log_file=None,
+                          quarantine_mode='move', manifest=os.path.join(ident_dir, 'manifest.db'))
+        os.remove(target)
+        os.rmdir(quarantine)
+        os.rmdir(ident_dir)
+
+    def test_quarantine_index(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        index = dicom_anon.QuarantineIndex(filename, batch=2)
+        index.run_started()
+        ds = Dataset()
+        ds.Modality = 'US'
+        ds.Rows = 480
+        ds.ImageType = ['ORIGINAL', 'PRIMARY']
+        for name, outcome in [('a.dcm', dicom_anon.QUARANTINED), ('b.dcm', dicom_anon.CLEANED),
+                              ('c.dcm', dicom_anon.QUARANTINED)]:
+            record = dicom_anon.FileRecord(name)
+            record.outcome = outcome
+            record.destination = 'quarantine/' + name
+            record.reason = 'modality not allowed'
+            record.summary = dicom_anon.DicomAnon.header_summary(ds)
+            index.file_done(record)
+        index.run_done()
+        db = sqlite3.connect(filename)
+        rows = db.execute('SELECT path, destination, reason, modality, rows, columns FROM quarantine').fetchall()
+        self.assertEqual(rows, [('a.dcm', 'quarantine/a.dcm', 'modality not allowed', 'US', 480, None),
+                                ('c.dcm', 'quarantine/c.dcm', 'modality not allowed', 'US', 480, None)])
+        db.close()
+        os.remove(filename)
+
+    def test_plan(self):
+        da = dicom_anon.DicomAnon(audit_file=":memory:", white_list="white_list.json", log_file=None,
+                                  profile="clean")
+        self.assertEqual(da.plan[dicom_anon.Tag((0x10, 0x10))], ('Z', False, True))
+        self.assertEqual(da.plan[dicom_anon.Tag(dicom_anon.STUDY_DESCR)], ('X', True, False))
+        self.assertEqual(da.default_action(dicom_anon.Tag((0x6002, 0x4000)), 'LT'), dicom_anon.DELETE)
+        self.assertEqual(da.default_action(dicom_anon.Tag((0x9, 0x1001)), 'US'), dicom_anon.DELETE)
+        self.assertEqual(da.default_action(dicom_anon.Tag((0x28, 0x10)), 'US'), dicom_anon.KEEP)
+        da = dicom_anon.DicomAnon(audit_file=":memory:", log_file=None, relative_dates=[(0x10, 0x30), (0x8, 0x21)])
+        handle = BytesIO()
+        da.dump_plan(handle)
+        self.assertEqual(json.loads(handle.getvalue())['relative_dates'],
+                         {'0010,0030': 'shift', '0008,0021': dicom_anon.DELETE})
+
+    def test_manifest(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        manifest = dicom_anon.Manifest(filename, use_hash=True)
+        self.assertFalse(manifest.is_unchanged('white_list.json', 'white_list.json'))
+        manifest.record('white_list.json', 'white_list.json', dicom_anon.CLEANED, 'clean/white_list.json')
+        manifest.flush()
+        self.assertTrue(manifest.is_unchanged('white_list.json', 'white_list.json'))
+        self.assertFalse(manifest.is_unchanged('white_list.json', 'README.md'))
+        manifest.close()
+        # Workers leave the manifest and the log handlers to the main process
+        da = dicom_anon.DicomAnon(audit=dicom_anon.MemoryAudit(), log_file=None, manifest=filename, workers=2)
+        handlers = list(dicom_anon.logger.handlers)
+        worker = dicom_anon.DicomAnon(audit=dicom_anon.MemoryAudit(), **da.options)
+        self.assertIsNone(worker.manifest)
+        self.assertEqual(dicom_anon.logger.handlers, handlers)
+        da.close_all()
+        os.remove(filename)
+
+    def test_uid_allocator(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        os.remove(filename)
+        dicom_anon.Audit(filename).close()
+        pool = multiprocessing.Pool(4)
+        uids = sum(pool.map(allocate_uids, [filename] * 8), [])
+        pool.close()
+        pool.join()
+        self.assertEqual(len(uids), 800)
+        self.assertEqual(len(set(uids)), 800)
+        self.assertTrue(all(len(uid) <= 64 for uid in uids))
+        self.assertTrue(dicom_anon.UUIDAllocator.generate().startswith('2.25.'))
+        os.remove(filename)
+
+    def test_hooks(self):
+        root = self.write_samples()
+        hook = RecordingHook()
+        da = dicom_anon.DicomAnon(quarantine=os.path.join(root, "quarantine"),
+                                  audit_file=os.path.join(root, "identity.db"),
+                                  modalities=["us", "cr", "ct", "mr", "pr"], org_root="1.2.826.0.1.3680043.8.1008",
+                                  white_list="white_list.json", log_file=None, rename=False, profile="basic",
+                                  overlay=False, hooks=[hook])
+        self.assertTrue(da.run(os.path.join(root, "samples"), os.path.join(root, "clean")))
+        self.assertEqual(len(hook.records), 1)
+        record = hook.records[0]
+        self.assertEqual(record.outcome, dicom_anon.CLEANED)
+        self.assertEqual(record.modality, "CR")
+        self.assertEqual(sorted(record.stages), ["anonymize", "quarantine", "read", "save"])
+        ds = dicom.read_file(os.path.join(root, "clean", "test_wrist_cr1.dcm"))
+        self.assertEqual(ds.PatientName, "Patient's Name 1")
+        shutil.rmtree(root)
+
+    def test_stage_stats(self):
+        stats = dicom_anon.StageStats()
+        for outcome in [dicom_anon.CLEANED, dicom_anon.QUARANTINED]:
+            record = dicom_anon.FileRecord('README.md')
+            record.modality = 'MR'
+            record.lap('read')
+            record.audit_lookup(outcome == dicom_anon.CLEANED)
+            record.finish(outcome)
+            stats.file_done(record)
+        summary = stats.summary()
+        self.assertEqual(summary['run']['files'], 2)
+        self.assertEqual(summary['run']['stages']['read']['files'], 2)
+        self.assertEqual(summary['by_modality']['MR']['outcomes'], {'cleaned': 1, 'quarantined': 1})
+        self.assertEqual(summary['by_audit']['hit']['files'], 1)
+        self.assertEqual(summary['by_audit']['miss']['files'], 1)
+
+    def test_progress(self):
+        handle, metrics_file = tempfile.mkstemp(suffix='.prom')
+        os.close(handle)
+        progress = dicom_anon.Progress(metrics_file=metrics_file, interval=3600)
+        progress.run_started()
+        progress.input_files, progress.input_bytes = 4, 4 * dicom_anon.file_size('README.md')
+        for outcome in [dicom_anon.CLEANED, dicom_anon.QUARANTINED]:
+            record = dicom_anon.FileRecord('README.md')
+            record.audit_lookup(outcome == dicom_anon.CLEANED)
+            record.destination = 'README.md'
+            record.bytes_out = dicom_anon.file_size('README.md')
+            record.finish(outcome)
+            progress.file_done(record)
+        # Nothing is written before the interval is up
+        self.assertEqual(os.path.getsize(metrics_file), 0)
+        rates = progress.rates(progress.started + 10)
+        self.assertEqual(rates['quarantine_ratio'], 0.5)
+        self.assertEqual(rates['audit_hit_ratio'], 0.5)
+        self.assertAlmostEqual(rates['remaining_seconds'], 10)
+        progress.run_done()
+        with open(metrics_file) as handle:
+            metrics = handle.read().splitlines()
+        self.assertTrue('dicom_anon_files_total{outcome="quarantined"} 1' in metrics)
+        self.assertTrue('dicom_anon_bytes_written_total %d' % (2 * dicom_anon.file_size('README.md')) in metrics)
+        self.assertTrue('dicom_anon_input_files 4.0' in metrics)
+        os.remove(metrics_file)
+
+    def test_catalog(self):
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        catalog = dicom_anon.Catalog(filename, 'first')
+        study_date = (0x0008, 0x0020)
+        catalog.save_many([
+            ('a.dcm', 10, 1.0, '1.2.3', 'PID1', 'MR', None, {study_date: '20040305'}),
+            ('b.dcm', 10, 1.0, '1.2.3', 'PID1', 'MR', None, {study_date: '20040101'}),
+            ('c.dcm', 10, 1.0, '1.2.4', 'PID2', 'US', 'modality not allowed', {study_date: '19990101'}),
+            ('d.dcm', 10, 1.0, '1.2.4', 'PID2', 'MR', None, {study_date: ''}),
+        ])
+        # Quarantined files and invalid dates do not count
+        self.assertEqual(catalog.first_dates([study_date]), {study_date: datetime(2004, 1, 1)})
+        self.assertEqual(catalog.first_dates([(0x0010, 0x0030)]), {(0x0010, 0x0030): None})
+        self.assertEqual(catalog.quarantined(), {'c.dcm': 'modality not allowed'})
+        self.assertEqual(catalog.files()['a.dcm'], (10, 1.0))
+        catalog.close()
+        catalog = dicom_anon.Catalog(filename, 'first')
+        self.assertEqual(len(catalog.files()), 4)
+        catalog.close()
+        # Different source directory or rules, start over
+        catalog = dicom_anon.Catalog(filename, 'second')
+        self.assertEqual(catalog.files(), {})
+        catalog.close()
+        os.remove(filename)
+        # Files deleted from the source directory leave the catalog and their dates stop counting
+        ident_dir = tempfile.mkdtemp()
+        self.write_dataset(os.path.join(ident_dir, 'a.dcm'), StudyDate='20040305')
+        self.write_dataset(os.path.join(ident_dir, 'b.dcm'), StudyDate='20040101')
+        da = dicom_anon.DicomAnon(audit=dicom_anon.MemoryAudit(), log_file=None, catalog=filename)
+        da.build_catalog(ident_dir).close()
+        os.remove(os.path.join(ident_dir, 'b.dcm'))
+        catalog = da.build_catalog(ident_dir)
+        self.assertEqual(sorted(catalog.files()), ['a.dcm'])
+        self.assertEqual(catalog.first_dates([study_date]), {study_date: datetime(2004, 3, 5)})
+        catalog.close()
+        shutil.rmtree(ident_dir)
+        os.remove(filename)
+
+    def test_date_offsets(self):
+        self.assertEqual(dicom_anon.shift_date('20040305', 'DA', 31), '20040203')
+        self.assertEqual(dicom_anon.shift_date('20040305101500.5', 'DT', -1), '20040306101500.5')
+        self.assertEqual(dicom_anon.shift_date('101500', 'TM', 31), '101500')
+        self.assertEqual(dicom_anon.shift_date('', 'DA', 31), None)
+        handle, filename = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        catalog = dicom_anon.Catalog(filename, 'first')
+        study_date, birth_date = (0x0008, 0x0020), (0x0010, 0x0030)
+        catalog.save_many([
+            ('a.dcm', 10, 1.0, '1.2.3', 'PID1', 'MR', None, {study_date: '20040305', birth_date: '19700102'}),
+            ('b.dcm', 10, 1.0, '1.2.4', 'PID1', 'MR', None, {study_date: '20040101120000', birth_date: ''}),
+            ('c.dcm', 10, 1.0, '1.2.5', 'PID2', 'MR', 'modality not allowed', {study_date: '19990101'}),
+        ])
+        self.assertEqual(catalog.first_dates_by('patient', [study_date, birth_date]), {'PID1': datetime(1970, 1, 2)})
+        self.assertEqual(catalog.first_dates_by('study', [study_date]),
+                         {'1.2.3': datetime(2004, 3, 5), '1.2.4': datetime(2004, 1, 1)})
+        catalog.close()
+        os.remove(filename)
+        da = dicom_anon.DicomAnon(audit=dicom_anon.MemoryAudit(), log_file=None, date_offsets='study')
+        self.assertEqual(da.load_date_offsets({'1.2.3': datetime(1970, 1, 11)}), {'1.2.3': 10})
+        # Stored offsets win over a new first date
+        self.assertEqual(da.load_date_offsets({'1.2.3': datetime(1970, 1, 2), '1.2.4': datetime(1970, 1, 3)}),
+                         {'1.2.3': 10, '1.2.4': 2})
+        self.assertRaises(Exception, dicom_anon.DicomAnon, audit=dicom_anon.MemoryAudit(), log_file=None,
+                          date_offsets='series')
+
+    def test_removed_relative_dates(self):
+        root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(root, 'samples'))
+        self.write_dataset(os.path.join(root, 'samples', 'a.dcm'), StudyDate='20040305', SeriesDate='20040306')
+        study_date, series_date = (0x0008, 0x0020), (0x0008, 0x0021)
+        da = dicom_anon.DicomAnon(audit=dicom_anon.MemoryAudit(), log_file=None,
+                                  quarantine=os.path.join(root, 'quarantine'), relative_dates=[study_date, series_date])
+        self.assertEqual(da.removed_relative_dates(), [series_date])
+        self.assertTrue(da.run(os.path.join(root, 'samples'), os.path.join(root, 'clean')))
+        ds = dicom.read_file(os.path.join(root, 'clean', 'a.dcm'))
+        # The first study date becomes the epoch, the series date the spec removes is not written back
+        self.assertEqual(ds.StudyDate, '19700101')
+        self.assertFalse(series_date in ds)
+        shutil.rmtree(root)
+
+    def test_groups(self):
+        ident_dir = tempfile.mkdtemp()
+        for name in ['a.dcm', 'b.dcm', 'c.dcm', 'd.dcm', 'e.dcm']:
+            open(os.path.join(ident_dir, name), 'w').close()
+        studies = {'a.dcm': ('PID2', '1.2.3'), 'b.dcm': ('PID1', '1.2.4'), 'c.dcm': ('PID2', '1.2.5'),
+                   'd.dcm': ('PID2', '1.2.3'), 'e.dcm': (None, None)}
+        names = lambda groups: [[os.path.basename(path) for path, reason in files] for files in groups]
+        da = dicom_anon.DicomAnon(audit_file=':memory:', log_file=None, group_by='study')
+        self.assertEqual(names(da.groups(ident_dir, studies)), [['e.dcm'], ['a.dcm', 'd.dcm'], ['b.dcm'], ['c.dcm']])
+        da = dicom_anon.DicomAnon(audit_file=':memory:', log_file=None, group_by='patient')
+        da.quarantined = {'c.dcm': 'modality not allowed'}
+        groups = da.groups(ident_dir, studies)
+        self.assertEqual(names(groups), [['e.dcm'], ['b.dcm'], ['a.dcm', 'd.dcm', 'c.dcm']])
+        self.assertEqual(groups[2][2][1], 'modality not allowed')
+        for name in os.listdir(ident_dir):
+            os.remove(os.path.join(ident_dir, name))
+        os.rmdir(ident_dir)
+
+    def test_archives(self):
+        root = tempfile.mkdtemp()
+        for suffix in ['.tar', '.tar.gz', '.tbz2', '.zip']:
+            filename = os.path.join(root, 'bundle' + suffix)
+            writer = dicom_anon.ArchiveWriter(filename)
+            self.assertEqual(writer.add('study/a.dcm', b'first'), os.path.join(filename, 'study/a.dcm'))
+            writer.add('study/.hidden', b'skipped')
+            writer.add('../outside.dcm', b'skipped')
+            writer.add('b.dcm', b'')
+            writer.close()
+            self.assertTrue(dicom_anon.is_archive(filename))
+            members = [(name, data) for name, mtime, data in dicom_anon.ArchiveReader(filename).members()]
+            self.assertEqual(members, [('study/a.dcm', b'first'), ('b.dcm', b'')])
+            os.remove(filename)
+        os.rmdir(root)
+        self.assertFalse(dicom_anon.is_archive('tests/samples'))
+
+    def test_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        path = os.path.join(spool_dir, 'a.dcm')
+        with open(path, 'w') as handle:
+            handle.write('part')
+        os.utime(path, (1000.0, 1000.0))
+        open(os.path.join(spool_dir, '.b.dcm'), 'w').close()
+        spool = dicom_anon.Spool(spool_dir, settle_seconds=5.0, use_inotify=False)
+        # Unchanged for long enough, hidden files are never ready
+        self.assertEqual(spool.ready(now=1004.0), [])
+        self.assertEqual(spool.ready(now=1005.0), [path])
+        self.assertEqual(spool.queued(), 1)
+        # Still being written, the wait starts over
+        with open(path, 'a') as handle:
+            handle.write('more')
+        os.utime(path, (1010.0, 1010.0))
+        self.assertEqual(spool.ready(now=1012.0), [])
+        self.assertEqual(spool.ready(now=1015.0), [path])
+        self.assertEqual(spool.arrived(path), 1010.0)
+        # Failed files wait until they change
+        spool.done(path, failed=True)
+        self.assertEqual(spool.ready(now=1100.0), [])
+        self.assertEqual(spool.queued(), 0)
+        os.utime(path, (1100.0, 1100.0))
+        self.assertEqual(spool.ready(now=1105.0), [path])
+        spool.close()
+        for name in os.listdir(spool_dir):
+            os.remove(os.path.join(spool_dir, name))
+        os.rmdir(spool_dir)
+
+    def test_watch(self):
+        root = tempfile.mkdtemp()
+        spool_dir = os.path.join(root, 'spool')
+        os.mkdir(spool_dir)
+        # No Study Instance UID, anonymizing it raises a KeyError
+        broken = self.write_dataset(os.path.join(spool_dir, 'a.dcm'), Modality='CR', PatientID='PID1')
+        del broken.StudyInstanceUID
+        broken.save_as(os.path.join(spool_dir, 'a.dcm'))
+        os.utime(os.path.join(spool_dir, 'a.dcm'), (1000.0, 1000.0))
+        self.write_dataset(os.path.join(spool_dir, 'b.dcm'), Modality='CR', PatientID='PID2')
+        os.utime(os.path.join(spool_dir, 'b.dcm'), (1001.0, 1001.0))
+        stop = threading.Event()
+        hook = StoppingHook(stop, 2)
+        da = dicom_anon.DicomAnon(quarantine=os.path.join(root, "quarantine"),
+                                  audit_file=os.path.join(root, "identity.db"), modalities=["cr"],
+                                  white_list="white_list.json", log_file=None, hooks=[hook])
+        da.watch(spool_dir, os.path.join(root, "clean"), poll_seconds=0.01, settle_seconds=0.0, stop=stop)
+        self.assertEqual([record.outcome for record in hook.records], [dicom_anon.FAILED, dicom_anon.CLEANED])
+        # The broken file waits in the spool, the next one was cleaned
+        self.assertEqual(os.listdir(spool_dir), ['a.dcm'])
+        self.assertEqual(dicom.read_file(os.path.join(root, "clean", "b.dcm")).PatientID, "Patient ID 1")
+        shutil.rmtree(root)
+
+    def test_scan(self):
+        ident_dir = tempfile.mkdtemp()
+        self.write_dataset(os.path.join(ident_dir, 'a.dcm'), [((0x9, 0x1001), 'LO', 'private')],
+                           StudyDescription='NECK STUDY', SeriesDescription='MY SERIES')
+        with open(os.path.join(ident_dir, 'b.dcm'), 'w') as handle:
+            handle.write('not dicom')
+        da = dicom_anon.DicomAnon(audit_file=":memory:", white_list="white_list.json", log_file=None,
+                                  profile="clean")
+        report = da.scan(ident_dir)
+        self.assertEqual(report['files'], 2)
+        self.assertEqual(report['outcomes'], {dicom_anon.CLEANED: 1, dicom_anon.QUARANTINED: 1})
+        self.assertEqual(report['quarantine_reasons'], {'Could not read DICOM file.': 1})
+        self.assertEqual(report['new_studies'], 1)
+        self.assertEqual(report['new_audit_rows'], {'SOP Instance UID': 1})
+        self.assertEqual(report['white_list']['Study Description'], {'kept': 1, 'removed': 0, 'removed_values': {}})
+        self.assertEqual(report['white_list']['Series Description'],
+                         {'kept': 0, 'removed': 1, 'removed_values': {'MY SERIES': 1}})
+        self.assertEqual(report['elements'][dicom_anon.DELETE], 1)
+        self.assertEqual(sorted(os.listdir(ident_dir)), ['a.dcm', 'b.dcm'])
+        for name in os.listdir(ident_dir):
+            os.remove(os.path.join(ident_dir, name))
+        os.rmdir(ident_dir)
+
+    def test_stream_engine(self):
+        ident_dir = tempfile.mkdtemp()
+        clean_dir = tempfile.mkdtemp()
+        path = os.path.join(ident_dir, 'a.dcm')
+        self.write_dataset(path, [((0x9, 0x1002), 'OB', b'\1' * 512), (dicom_anon.PIXEL_DATA, 'OW', b'\2\3' * 1024)])
+        da = dicom_anon.DicomAnon(audit_file=":memory:", log_file=None, engine='stream', defer_size=256)
+        outcome, destination = da.process_file(path, ident_dir, clean_dir)
+        self.assertEqual(outcome, dicom_anon.CLEANED)
+        cleaned = dicom.read_file(destination)
+        self.assertEqual(cleaned.PixelData, b'\2\3' * 1024)
+        self.assertFalse((0x9, 0x1002) in cleaned)
+        self.assertEqual(cleaned.PatientIdentityRemoved, 'YES')
+        self.assertRaises(Exception, dicom_anon.DicomAnon, audit_file=":memory:", log_file=None, engine='mmap')
+        os.remove(path)
+        os.remove(destination)
+        os.rmdir(ident_dir)
+        os.rmdir(clean_dir)
+
+    def test_pseudonyms(self):
+        ident_dir = tempfile.mkdtemp()
+        clean_dir = tempfile.mkdtemp()
+        path = os.path.join(ident_dir, 'a.dcm')
+        ds = self.write_dataset(path, PatientID='PID1')
+        handle, key_file = tempfile.mkstemp()
+        os.write(handle, b'0123456789abcdef-test-key\n')
+        os.close(handle)
+        handle, audit_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        pseudonymizer = dicom_anon.Pseudonymizer(b'0123456789abcdef-test-key', '5.555.5')
+        cleaned = []
+        for run in range(2):
+            da = dicom_anon.DicomAnon(audit=NoLookupAudit(), audit_file=audit_file, log_file=None,
+                                      pseudonym_key=key_file, org_root='5.555.5')
+            outcome, destination = da.process_file(path, ident_dir, clean_dir)
+            self.assertEqual(outcome, dicom_anon.CLEANED)
+            da.close_all()
+            cleaned.append(dicom.read_file(destination))
+            os.remove(destination)
+        self.assertEqual(cleaned[0].StudyInstanceUID, pseudonymizer.uid('1.2.3'))
+        self.assertEqual(cleaned[0].SOPInstanceUID, pseudonymizer.uid('1.2.3.4'))
+        self.assertTrue(cleaned[0].StudyInstanceUID.startswith('5.555.5.'))
+        self.assertEqual(cleaned[0].PatientID, cleaned[1].PatientID)
+        self.assertTrue(cleaned[0].PatientID.startswith('Patient ID '))
+        # The same value in another study gets another token
+        self.assertNotEqual(pseudonymizer.token(ds.data_element('PatientID'), '1.2.4'), cleaned[0].PatientID)
+        # Logged once, the second run finds its rows
+        reader = dicom_anon.AuditReader([audit_file])
+        self.assertEqual(sorted(row[2] for row in reader.export(['1.2.3'], 'original')),
+                         ['1.2.3', '1.2.3.4', 'PID1'])
+        reader.close()
+        self.assertRaises(Exception, dicom_anon.Pseudonymizer, b'short', '5.555.5')
+        for name in [path, key_file, audit_file]:
+            os.remove(name)
+        os.rmdir(ident_dir)
+        os.rmdir(clean_dir)
+
+    def test_duplicates(self):
+        ident_dir = tempfile.mkdtemp()
+        clean_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(ident_dir, 'b'))
+        for name, description in [('a.dcm', 'NECK'), ('b/a.dcm', 'NECK'), ('b/c.dcm', 'HEAD')]:
+            path = os.path.join(ident_dir, name)
+            self.write_dataset(path, StudyDescription=description)
+        da = dicom_anon.DicomAnon(audit_file=":memory:", log_file=None, duplicates='link')
+        self.assertTrue(da.run(ident_dir, clean_dir))
+        # b/c.dcm shares the SOP Instance UID but not the content
+        self.assertEqual(da.duplicate_counts['files'], 1)
+        cleaned = [os.path.join(clean_dir, name) for name in ['a.dcm', 'b/a.dcm', 'b/c.dcm']]
+        self.assertEqual(len(set(os.stat(path).st_ino for path in cleaned)), 2)
+        self.assertRaises(Exception, dicom_anon.DicomAnon, audit_file=":memory:", log_file=None,
+                          duplicates='merge')
+        # A first copy that fails is forgotten, the next copy to come along is cleaned instead
+        index = dicom_anon.DuplicateIndex(':memory:')
+        self.assertIsNone(index.first_copy('a.dcm', '1.2.3.4', 'f'))
+        self.assertEqual(index.first_copy('b/a.dcm', '1.2.3.4', 'f'), ('1.2.3.4', 'f', 'a.dcm'))
+        index.done('a.dcm', dicom_anon.FAILED, None)
+        self.assertIsNone(index.first_copy('b/a.dcm', '1.2.3.4', 'f'))
+        index.close()
+        for root in [ident_dir, clean_dir]:
+            for name in ['a.dcm', 'b/a.dcm', 'b/c.dcm']:
+                os.remove(os.path.join(root, name))
+            os.rmdir(os.path.join(root, 'b'))
+            os.rmdir(root)
+
+    def test_output_syntax(self):
+        self.assertEqual(dicom_anon.packbits(b'\0' * 10 + b'abc'), b'\xf7\0\x02abc')
+        ident_dir = tempfile.mkdtemp()
+        path = os.path.join(ident_dir, 'a.dcm')
+        ds = self.write_dataset(path, [(dicom_anon.PIXEL_DATA, 'OW', b'\2\0' * 256 + b'\3\1' * 256)],
+                                SamplesPerPixel=1, Rows=16, Columns=32, BitsAllocated=16)
+        for output_syntax, transfer_syntax in [('deflate', dicom_anon.DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN),
+                                               ('rle', dicom_anon.RLE_LOSSLESS)]:
+            clean_dir = tempfile.mkdtemp()
+            da = dicom_anon.DicomAnon(audit_file=":memory:", log_file=None, output_syntax=output_syntax)
+            outcome, destination = da.process_file(path, ident_dir, clean_dir)
+            self.assertEqual(outcome, dicom_anon.CLEANED)
+            self.assertTrue(os.path.getsize(destination) < os.path.getsize(path))
+            cleaned = dicom.read_file(destination)
+            self.assertEqual(cleaned.file_meta.TransferSyntaxUID, transfer_syntax)
+            self.assertEqual(cleaned.PatientIdentityRemoved, 'YES')
+            if output_syntax == 'deflate':
+                self.assertEqual(cleaned.PixelData, ds.PixelData)
+            else:
+                # Empty offset table, then one fragment with a segment for the high and one for the low bytes
+                fragment = cleaned.PixelData[16:]
+                self.assertEqual(cleaned.PixelData[:8], b'\xfe\xff\0\xe0\0\0\0\0')
+                self.assertEqual(fragment[:12], b'\2\0\0\0\x40\0\0\0\x60\0\0\0')
+                self.assertEqual(fragment[64:68], b'\xe1\0\xe1\0')
+                self.assertEqual(fragment[96:100], b'\xe1\2\xe1\2')
+            os.remove(destination)
+            os.rmdir(clean_dir)
+        self.assertRaises(Exception, dicom_anon.DicomAnon, audit_file=":memory:", log_file=None,
+                          output_syntax='jpeg')
+        os.remove(path)
+        os.rmdir(ident_dir)
+
+
 if __name__ == '__main__':
     unittest.main()